@@ -14,15 +14,20 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
+from lib.BNIDatabase import BNIDatabase
 from lib.BNIEncodingDaemon import BNIEncodingDaemon
+from lib.BNIReelPriority import get_reel_path, set_reel_priority
+from lib.BNISchemaMigrator import BNISchemaMigrator
 from lib.simpleDaemon import Daemon
 from optparse import OptionParser
+import configparser
+import logging
 from os import path as path
 import sys
 
 
 def check_options(options, parser):
-    if options.action_start:
+    if options.action_start or options.action_migrate or options.reel_path:
         if options.config_file is None or not path.exists(options.config_file):
             parser.print_help()
             print("\nERROR: Cannot read configuration file! (--config)")
@@ -31,10 +36,16 @@ def check_options(options, parser):
             (
                     options.action_start,
                     options.action_stop,
+                    options.action_migrate,
+                    options.reel_path,
             )
     ):
         parser.print_help()
-        print("\nERROR: Please specify ONE of [--start, --stop]")
+        print("\nERROR: Please specify ONE of [--start, --stop, --migrate, --prioritize]")
+        sys.exit(2)
+    if not 0 <= options.priority <= 255:
+        parser.print_help()
+        print("\nERROR: --priority must be between 0 and 255.")
         sys.exit(2)
 
 
@@ -60,6 +71,26 @@ def init_options():
         default=False,
         help="Stop the encoding daemon.",
     )
+    option_parser.add_option(
+        "--migrate",
+        dest="action_migrate",
+        action="store_true",
+        default=False,
+        help="Apply any pending database schema migrations.",
+    )
+    option_parser.add_option(
+        "--prioritize",
+        dest="reel_path",
+        default=None,
+        help="Set the scheduling priority of a reel directory's queued and future pages (see --priority).",
+    )
+    option_parser.add_option(
+        "--priority",
+        dest="priority",
+        type="int",
+        default=100,
+        help="Priority given by --prioritize, 0-255, higher is processed sooner (Default: 100, queued pages: 0).",
+    )
     option_parser.add_option(
         "--pidfile",
         dest="pid_filepath",
@@ -83,6 +114,33 @@ def init_options():
     return options
 
 
+def init_migrator(config_filepath):
+    config = configparser.ConfigParser()
+    config.read(config_filepath)
+    logger = logging.getLogger('bni_migrate')
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    return BNISchemaMigrator(config, logger)
+
+
+def prioritize_reel(config_filepath, reel_path, priority):
+    config = configparser.ConfigParser()
+    config.read(config_filepath)
+    logger = logging.getLogger('bni_prioritize')
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    database = BNIDatabase(config, logger)
+    try:
+        set_reel_priority(
+            database,
+            logger,
+            get_reel_path(reel_path, config.get('Locations', 'input_path')),
+            priority
+        )
+    finally:
+        database.close()
+
+
 def one_is_true(iterable):
     it = iter(iterable)
     return any(it) and not any(it)
@@ -97,7 +155,15 @@ if __name__ == "__main__":
             options.pid_filepath,
         )
         daemon.stop()
+    elif options.action_migrate:
+        init_migrator(options.config_file).migrate()
+    elif options.reel_path:
+        prioritize_reel(options.config_file, options.reel_path, options.priority)
     elif options.action_start:
+        pending_migrations = init_migrator(options.config_file).get_pending_migrations()
+        if pending_migrations:
+            print("ERROR: The database schema is %s migration(s) behind. Run with --migrate first." % len(pending_migrations))
+            sys.exit(2)
         print("Starting " + sys.argv[0])
         daemon = BNIEncodingDaemon(
             options.pid_filepath,
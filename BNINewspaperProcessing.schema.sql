@@ -1,3 +1,17 @@
+CREATE TABLE schema_version (
+  version SMALLINT UNSIGNED NOT NULL PRIMARY KEY,
+  name VARCHAR(128),
+  applied_datestamp DATETIME
+) ENGINE = InnoDB;
+
+INSERT INTO schema_version (version,name,applied_datestamp) VALUES
+(1,'claims_and_stage_timings',NOW()),
+(2,'innodb_path_hash',NOW()),
+(3,'claim_leases',NOW()),
+(4,'reel_priority',NOW()),
+(5,'header_validation',NOW()),
+(6,'claim_attempts',NOW());
+
 CREATE TABLE configuration (
   config_id MEDIUMINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
   hostname VARCHAR(128),
@@ -8,28 +22,64 @@ CREATE TABLE configuration (
   gm_version VARCHAR(64),
   tesseract_version VARCHAR(128),
   tesseract_language VARCHAR(32),
-  gm_surrogate_convert_options VARCHAR(256)
-);
+  gm_surrogate_convert_options VARCHAR(256),
+  omp_thread_limit SMALLINT UNSIGNED,
+  cpu_count SMALLINT UNSIGNED,
+  memory_mb INT UNSIGNED,
+  load_average FLOAT,
+  available_memory_mb INT UNSIGNED
+) ENGINE = InnoDB;
 
 CREATE TABLE images (
   id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
   config_id MEDIUMINT UNSIGNED,
   filepath VARCHAR(512),
+  path_hash BINARY(20) NOT NULL,
+  directory_hash BINARY(20) NOT NULL,
   status_id TINYINT UNSIGNED,
+  priority TINYINT UNSIGNED NOT NULL DEFAULT 0,
+  claim_token CHAR(32),
+  lease_config_id MEDIUMINT UNSIGNED,
+  lease_worker_id SMALLINT UNSIGNED,
+  lease_expires DATETIME,
+  attempts TINYINT UNSIGNED NOT NULL DEFAULT 0,
   glacier_vault VARCHAR(128),
   glacier_description VARCHAR(512),
   queue_datestamp DATETIME,
   start_datestamp DATETIME,
   latest_datestamp DATETIME
-) ENGINE = MYISAM;
-ALTER TABLE images ADD INDEX (filepath);
-ALTER TABLE images ADD INDEX (status_id);
-ALTER TABLE images ADD INDEX (id,status_id);
+) ENGINE = InnoDB;
+ALTER TABLE images ADD UNIQUE INDEX path_hash (path_hash);
+ALTER TABLE images ADD INDEX status_claim (status_id, priority, id);
+ALTER TABLE images ADD INDEX directory_claim (status_id, directory_hash, priority, id);
+ALTER TABLE images ADD INDEX (claim_token);
+ALTER TABLE images ADD INDEX lease_expires (lease_expires);
+ALTER TABLE images ADD INDEX lease_owner (lease_config_id, lease_worker_id);
+ALTER TABLE images ADD INDEX directory_lease (directory_hash, lease_expires);
+
+CREATE TABLE reel_priorities (
+  directory_hash BINARY(20) NOT NULL PRIMARY KEY,
+  reel_path VARCHAR(512),
+  priority TINYINT UNSIGNED NOT NULL,
+  updated_datestamp DATETIME
+) ENGINE = InnoDB;
+
+CREATE TABLE stage_timings (
+  id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+  image_id INT NOT NULL,
+  status_id TINYINT UNSIGNED,
+  duration_ms INT UNSIGNED,
+  worker_id SMALLINT UNSIGNED,
+  config_id MEDIUMINT UNSIGNED,
+  recorded_datestamp DATETIME
+) ENGINE = InnoDB;
+ALTER TABLE stage_timings ADD INDEX (image_id);
+ALTER TABLE stage_timings ADD INDEX (recorded_datestamp);
 
 CREATE TABLE status (
   status_id TINYINT UNSIGNED NOT NULL PRIMARY KEY,
   status_string VARCHAR(16)
-);
+) ENGINE = InnoDB;
 
 INSERT INTO status (status_id,status_string) VALUES
 (1,'QUEUED'),
@@ -59,4 +109,8 @@ INSERT INTO status (status_id,status_string) VALUES
 (25,'REMOVEORIGINAL'),
 (26,'PROCESSINGCOMPLETE'),
 (27,'ARCHIVEDASSUCCESS'),
-(28,'ARCHIVEDASFAIL');
+(28,'ARCHIVEDASFAIL'),
+(29,'FAILHEADERTIF'),
+(30,'FAILHEADERJPG'),
+(31,'FAILDIMENSIONS'),
+(32,'FAILATTEMPTS');
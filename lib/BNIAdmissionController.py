@@ -0,0 +1,132 @@
+"""BNIAdmissionController
+
+Host-wide admission control for the memory and scratch space used by in-flight pages.
+
+The footprint of GraphicsMagick and Tesseract grows with the size of the master, so a few oversized TIFs
+picked up at once can exhaust memory even though the pool was sized for typical pages. Before generating a
+page's hOCR, a worker reserves the page's estimated memory and scratch space against budgets shared by every
+worker on the host, waiting until the pages already in flight leave room for it. A page is always admitted
+when nothing else is in flight, so one page larger than the budget cannot stall the host.
+
+TIFs larger than large_tif_mb take the large-page lane instead. Only large_page_lanes of them run at once, and
+GraphicsMagick runs them under the gm_large_page_options resource limits, spilling its pixel cache to tmp_path
+rather than holding it in memory. Their memory reservation is capped at large_page_memory_mb accordingly, and
+the remainder is reserved as scratch space.
+
+The controller is created by the daemon before its workers fork. Reservations are kept per worker, so when a
+worker dies holding one (the OOM killer included), the daemon hands it back with release_worker(). Waiting
+workers poll the shared reservations under a plain lock rather than sleeping on a condition variable, since a
+worker killed while waiting on one leaves it in a state that blocks the next notify_all() forever.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import multiprocessing
+import os
+import shutil
+import time
+
+
+class BNIAdmissionController(object):
+    def __init__(self, config, logger, worker_slots, memory_mb, scratch_path):
+        self.logger = logger
+        self.memory_budget_mb = self.get_budget(
+            config.get('Admission', 'admission_memory_mb', fallback='auto'),
+            memory_mb * 3 // 4
+        )
+        self.scratch_budget_mb = self.get_budget(
+            config.get('Admission', 'admission_scratch_mb', fallback='auto'),
+            int(shutil.disk_usage(scratch_path).free * 0.9) // 1048576
+        )
+        self.page_memory_base_mb = config.getint('Admission', 'page_memory_base_mb', fallback=256)
+        self.page_memory_per_tif_mb = config.getfloat('Admission', 'page_memory_per_tif_mb', fallback=4.0)
+        self.page_scratch_per_tif_mb = config.getfloat('Admission', 'page_scratch_per_tif_mb', fallback=0.25)
+        self.large_tif_mb = config.getint('Admission', 'large_tif_mb', fallback=250)
+        self.large_page_lanes = max(1, config.getint('Admission', 'large_page_lanes', fallback=1))
+        self.large_page_memory_mb = config.getint('Admission', 'large_page_memory_mb', fallback=2048)
+        self.admission_poll_interval = config.getfloat('Admission', 'admission_poll_interval', fallback=0.5)
+        self.lock = multiprocessing.Lock()
+        self.reserved_memory_mb = multiprocessing.Array('q', worker_slots, lock=False)
+        self.reserved_scratch_mb = multiprocessing.Array('q', worker_slots, lock=False)
+        self.reserved_pages = multiprocessing.Array('q', worker_slots, lock=False)
+        self.reserved_large_pages = multiprocessing.Array('q', worker_slots, lock=False)
+        self.logger.info('Daemon admitting pages within %s MB of memory and %s MB of scratch space.',
+                         self.memory_budget_mb, self.scratch_budget_mb)
+
+    def get_budget(self, budget_value, auto_budget_mb):
+        if budget_value == 'auto':
+            return auto_budget_mb
+        return int(budget_value)
+
+    def is_large_page(self, tif_filepath):
+        return self.large_tif_mb > 0 and os.path.getsize(tif_filepath) // 1048576 >= self.large_tif_mb
+
+    def get_page_estimate(self, tif_filepath):
+        """Return the (memory MB, scratch MB, large page) reservation for a TIF."""
+        tif_mb = os.path.getsize(tif_filepath) / 1048576.0
+        memory_mb = int(self.page_memory_base_mb + tif_mb * self.page_memory_per_tif_mb)
+        scratch_mb = int(tif_mb * self.page_scratch_per_tif_mb)
+        if not self.is_large_page(tif_filepath):
+            return memory_mb, scratch_mb, False
+        large_memory_mb = min(memory_mb, self.large_page_memory_mb)
+        return large_memory_mb, scratch_mb + memory_mb - large_memory_mb, True
+
+    def admit(self, worker, tif_filepath):
+        """Block until the page fits within the budgets, then reserve it. Returns the reservation to release."""
+        memory_mb, scratch_mb, large_page = self.get_page_estimate(tif_filepath)
+        slot = worker.worker_id
+        waiting = False
+        while True:
+            with self.lock:
+                if self.fits(memory_mb, scratch_mb, large_page):
+                    self.reserved_memory_mb[slot] += memory_mb
+                    self.reserved_scratch_mb[slot] += scratch_mb
+                    self.reserved_pages[slot] += 1
+                    self.reserved_large_pages[slot] += int(large_page)
+                    break
+            if not waiting:
+                self.logger.info('Worker %s waiting for %s MB of memory and %s MB of scratch space to process %s.',
+                                 worker.worker_id, memory_mb, scratch_mb, tif_filepath)
+                waiting = True
+            time.sleep(self.admission_poll_interval)
+        if large_page:
+            self.logger.info('Worker %s processing %s in the large page lane.', worker.worker_id, tif_filepath)
+        return slot, memory_mb, scratch_mb, large_page
+
+    def release(self, reservation):
+        slot, memory_mb, scratch_mb, large_page = reservation
+        with self.lock:
+            self.reserved_memory_mb[slot] -= memory_mb
+            self.reserved_scratch_mb[slot] -= scratch_mb
+            self.reserved_pages[slot] -= 1
+            self.reserved_large_pages[slot] -= int(large_page)
+
+    def release_worker(self, slot):
+        """Hand back everything reserved by a worker that has exited."""
+        with self.lock:
+            if self.reserved_pages[slot] > 0:
+                self.logger.warning('Daemon reclaiming %s MB of memory and %s MB of scratch space held by worker %s.',
+                                    self.reserved_memory_mb[slot], self.reserved_scratch_mb[slot], slot)
+            self.reserved_memory_mb[slot] = 0
+            self.reserved_scratch_mb[slot] = 0
+            self.reserved_pages[slot] = 0
+            self.reserved_large_pages[slot] = 0
+
+    def fits(self, memory_mb, scratch_mb, large_page):
+        if large_page and sum(self.reserved_large_pages) >= self.large_page_lanes:
+            return False
+        if sum(self.reserved_pages) == 0:
+            return True
+        return (sum(self.reserved_memory_mb) + memory_mb <= self.memory_budget_mb and
+                sum(self.reserved_scratch_mb) + scratch_mb <= self.scratch_budget_mb)
+
+    def get_stats(self):
+        """Return the pages, large pages, memory and scratch space currently reserved."""
+        with self.lock:
+            return {
+                'pages': sum(self.reserved_pages),
+                'large_pages': sum(self.reserved_large_pages),
+                'memory_mb': sum(self.reserved_memory_mb),
+                'scratch_mb': sum(self.reserved_scratch_mb),
+            }
@@ -0,0 +1,274 @@
+"""BNIArchiver
+
+In-process replacement for the 'rsync -a -L --relative' calls used to archive processed images.
+
+Files are copied below the output path keeping their relative path, written to a temporary name and renamed
+into place once the whole set has been synced. The SHA1 of each file is computed from the same read that
+feeds the copy, so the archived files never need to be read back to build their manifests.
+
+When several output paths are archived to at once, each source file is read a single time and written to
+every destination that needs it. Destinations sharing a filesystem receive a reflink or hardlink of the first
+copy instead of a second write.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import collections
+import errno
+import fcntl
+import hashlib
+import io
+import os
+import threading
+import time
+import uuid
+
+
+# From linux/fs.h, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+class BNIArchiveTimeout(Exception):
+    pass
+
+
+class BNIArchiver(object):
+    def __init__(self, config, logger):
+        self.config = config
+        self.logger = logger
+        self.buffer_size = self.config.getint('Archive', 'archive_buffer_size', fallback=1048576)
+        self.copy_method = self.config.get('Archive', 'archive_copy_method', fallback='auto')
+        self.fsync = self.config.getboolean('Archive', 'archive_fsync', fallback=True)
+        self.max_open_dirs = self.config.getint('Archive', 'archive_max_open_dirs', fallback=64)
+        self.link_mode = self.config.get('Archive', 'archive_link_mode', fallback='reflink')
+        self.kernel_copy_available = self.copy_method == 'auto'
+        self.dir_fds = collections.OrderedDict()
+        self.dir_lock = threading.Lock()
+
+    def archive(self, source_root, relative_paths, output_path, timeout):
+        """Copy source_root/<relative path> to output_path/<relative path> for each of relative_paths.
+
+        Returns a dict of relative path to SHA1 hex digest. Raises BNIArchiveTimeout if the copy outlives
+        timeout seconds, and OSError on any failure. Nothing is renamed into place unless every file copied.
+        """
+        return self.archive_fanout(source_root, [(output_path, relative_paths)], timeout)[0]
+
+    def archive_fanout(self, source_root, destinations, timeout):
+        """Archive to several (output_path, relative_paths) destinations, reading each source file once.
+
+        Returns one digest dict per destination, as archive() does.
+        """
+        deadline = time.monotonic() + timeout
+        target_filepaths = collections.OrderedDict()
+        for output_path, relative_paths in destinations:
+            for relative_path in relative_paths:
+                cur_targets = target_filepaths.setdefault(relative_path, [])
+                cur_target = os.path.join(output_path, relative_path)
+                if cur_target not in cur_targets:
+                    cur_targets.append(cur_target)
+
+        pending_files = []
+        digests = {}
+        try:
+            for relative_path, cur_targets in target_filepaths.items():
+                digests[relative_path] = self.copy_to_temps(
+                    os.path.join(source_root, relative_path),
+                    cur_targets,
+                    pending_files,
+                    deadline
+                )
+            self.commit_pending_files(pending_files)
+        except Exception:
+            self.discard_pending_files(pending_files)
+            raise
+        return [
+            dict((relative_path, digests[relative_path]) for relative_path in relative_paths)
+            for output_path, relative_paths in destinations
+        ]
+
+    def copy_to_temps(self, source_filepath, target_filepaths, pending_files, deadline):
+        written_files = []
+        linked_files = []
+        written_by_device = {}
+        for target_filepath in target_filepaths:
+            pending_file = self.open_temp(target_filepath)
+            pending_files.append(pending_file)
+            first_written = written_by_device.get(pending_file['device'])
+            if first_written is None or self.link_mode == 'copy':
+                written_by_device.setdefault(pending_file['device'], pending_file)
+                written_files.append(pending_file)
+            else:
+                linked_files.append((pending_file, first_written))
+
+        with io.open(source_filepath, 'rb', buffering=0) as source_p:
+            source_stat = os.fstat(source_p.fileno())
+            sha1 = self.copy_data(source_p, [written_file['fd'] for written_file in written_files], deadline)
+
+        # Match what rsync -a keeps: permissions and timestamps.
+        for written_file in written_files:
+            self.copy_metadata(written_file['fd'], source_stat)
+        for linked_file, first_written in linked_files:
+            self.link_temp(first_written, linked_file, source_stat, deadline)
+        return sha1
+
+    def open_temp(self, target_filepath):
+        dir_fd = self.get_dir_fd(os.path.dirname(target_filepath))
+        target_name = os.path.basename(target_filepath)
+        temp_name = '.' + target_name + '.' + uuid.uuid4().hex[:8] + '.tmp'
+        return {
+            'dir_fd': dir_fd,
+            'device': os.fstat(dir_fd).st_dev,
+            'temp_name': temp_name,
+            'target_name': target_name,
+            'fd': os.open(temp_name, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600, dir_fd=dir_fd),
+        }
+
+    def copy_metadata(self, target_fd, source_stat):
+        os.fchmod(target_fd, source_stat.st_mode & 0o7777)
+        os.utime(target_fd, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+
+    def link_temp(self, first_written, linked_file, source_stat, deadline):
+        """Give linked_file the contents of first_written, which lives on the same filesystem, without a copy.
+
+        Filesystems without reflinks (ext4, for one) fall back to hardlinks, and only filesystems that cannot
+        hardlink either fall back to a second copy.
+        """
+        if self.link_mode == 'reflink':
+            try:
+                fcntl.ioctl(linked_file['fd'], FICLONE, first_written['fd'])
+                self.copy_metadata(linked_file['fd'], source_stat)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF):
+                    raise
+                if e.errno == errno.EXDEV:
+                    self.logger.info('Reflinking archive copies failed (%s), copying from now on.', e)
+                    self.link_mode = 'copy'
+                else:
+                    self.logger.info('Reflinking archive copies failed (%s), hardlinking from now on.', e)
+                    self.link_mode = 'hardlink'
+        if self.link_mode == 'hardlink':
+            try:
+                os.close(linked_file['fd'])
+                linked_file['fd'] = None
+                os.unlink(linked_file['temp_name'], dir_fd=linked_file['dir_fd'])
+                os.link(
+                    first_written['temp_name'],
+                    linked_file['temp_name'],
+                    src_dir_fd=first_written['dir_fd'],
+                    dst_dir_fd=linked_file['dir_fd']
+                )
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP):
+                    raise
+                self.logger.info('Hardlinking archive copies failed (%s), copying from now on.', e)
+                self.link_mode = 'copy'
+                linked_file['fd'] = os.open(linked_file['temp_name'], os.O_RDWR | os.O_CREAT, 0o600, dir_fd=linked_file['dir_fd'])
+
+        # The first copy was just written, so this reads it back out of the page cache.
+        with io.open(os.dup(first_written['fd']), 'rb', buffering=0) as first_written_p:
+            first_written_p.seek(0)
+            self.copy_data(first_written_p, [linked_file['fd']], deadline)
+        self.copy_metadata(linked_file['fd'], source_stat)
+
+    def copy_data(self, source_p, target_fds, deadline):
+        sha1 = hashlib.sha1()
+        read_buffer = bytearray(self.buffer_size)
+        read_view = memoryview(read_buffer)
+        source_offset = 0
+        while True:
+            if time.monotonic() > deadline:
+                raise BNIArchiveTimeout('Timed out copying ' + str(source_p.name))
+            bytes_read = source_p.readinto(read_buffer)
+            if not bytes_read:
+                break
+            sha1.update(read_view[:bytes_read])
+            for target_fd in target_fds:
+                bytes_copied = 0
+                if self.kernel_copy_available:
+                    # The chunk was just read, so the kernel copies it out of the page cache.
+                    bytes_copied = self.kernel_copy(source_p.fileno(), target_fd, source_offset, bytes_read)
+                self.write_all(target_fd, read_view[bytes_copied:bytes_read])
+            source_offset += bytes_read
+        return sha1.hexdigest()
+
+    def kernel_copy(self, source_fd, target_fd, source_offset, count):
+        bytes_copied = 0
+        try:
+            while bytes_copied < count:
+                if hasattr(os, 'copy_file_range'):
+                    copied = os.copy_file_range(source_fd, target_fd, count - bytes_copied, source_offset + bytes_copied)
+                else:
+                    copied = os.sendfile(target_fd, source_fd, source_offset + bytes_copied, count - bytes_copied)
+                if copied == 0:
+                    break
+                bytes_copied += copied
+        except OSError as e:
+            if e.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+                raise
+            self.logger.info('Kernel file copy unavailable (%s), falling back to buffered copies.', e)
+            self.kernel_copy_available = False
+        return bytes_copied
+
+    def write_all(self, target_fd, data_view):
+        while len(data_view) > 0:
+            bytes_written = os.write(target_fd, data_view)
+            data_view = data_view[bytes_written:]
+
+    def commit_pending_files(self, pending_files):
+        # Sync all the file data first, then rename everything into place and sync each directory once.
+        for pending_file in pending_files:
+            if pending_file['fd'] is None:
+                continue
+            if self.fsync:
+                os.fsync(pending_file['fd'])
+            os.close(pending_file['fd'])
+            pending_file['fd'] = None
+        synced_dir_fds = set()
+        for pending_file in pending_files:
+            os.replace(
+                pending_file['temp_name'],
+                pending_file['target_name'],
+                src_dir_fd=pending_file['dir_fd'],
+                dst_dir_fd=pending_file['dir_fd']
+            )
+            pending_file['temp_name'] = None
+            synced_dir_fds.add(pending_file['dir_fd'])
+        if self.fsync:
+            for dir_fd in synced_dir_fds:
+                os.fsync(dir_fd)
+
+    def discard_pending_files(self, pending_files):
+        for pending_file in pending_files:
+            if pending_file['fd'] is not None:
+                os.close(pending_file['fd'])
+            if pending_file['temp_name'] is not None:
+                try:
+                    os.unlink(pending_file['temp_name'], dir_fd=pending_file['dir_fd'])
+                except OSError:
+                    pass
+
+    def get_dir_fd(self, dir_path):
+        with self.dir_lock:
+            if dir_path in self.dir_fds:
+                self.dir_fds.move_to_end(dir_path)
+                return self.dir_fds[dir_path]
+            try:
+                os.makedirs(dir_path)
+            except OSError as exc:
+                if not (exc.errno == errno.EEXIST and os.path.isdir(dir_path)):
+                    raise
+            dir_fd = os.open(dir_path, os.O_RDONLY | os.O_DIRECTORY)
+            self.dir_fds[dir_path] = dir_fd
+            while len(self.dir_fds) > self.max_open_dirs:
+                evicted_path, evicted_fd = self.dir_fds.popitem(last=False)
+                os.close(evicted_fd)
+            return dir_fd
+
+    def close(self):
+        with self.dir_lock:
+            while self.dir_fds:
+                dir_path, dir_fd = self.dir_fds.popitem(last=False)
+                os.close(dir_fd)
@@ -0,0 +1,133 @@
+"""BNIDatabase
+
+Per-process pool of MySQL connections shared by the daemon, its workers and their helper threads.
+
+Connections are opened lazily and returned to the pool after use, instead of being opened and closed around
+every operation. The pool belongs to the process that opened its connections: a forked worker never touches
+the sockets it inherited from the daemon, and starts a pool of its own. Connections that sat idle longer than
+the ping interval are checked (and reopened if the server dropped them) before being handed out, and a
+connection that fails mid-operation is discarded rather than returned.
+
+Operations that are safe to repeat can be run through run_with_retry(), which retries them on a fresh
+connection when the server goes away or the connection is lost.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import collections
+import contextlib
+import os
+import threading
+import time
+import pymysql
+from pymysql.constants import SERVER_STATUS
+
+# CR_CONN_HOST_ERROR, CR_SERVER_GONE_ERROR, CR_SERVER_LOST, CR_SERVER_LOST_EXTENDED, ER_LOCK_DEADLOCK
+RETRYABLE_ERRORS = frozenset((2003, 2006, 2013, 2055, 1213))
+
+
+class BNIDatabase(object):
+    def __init__(self, config, logger):
+        self.config = config
+        self.logger = logger
+        self.pool_size = config.getint('MySQL', 'mysql_pool_size', fallback=4)
+        self.connect_timeout = config.getint('MySQL', 'mysql_connect_timeout', fallback=10)
+        self.ping_interval = config.getfloat('MySQL', 'mysql_ping_interval', fallback=60.0)
+        self.retries = config.getint('MySQL', 'mysql_retries', fallback=3)
+        self.retry_delay = config.getfloat('MySQL', 'mysql_retry_delay', fallback=2.0)
+        self.pool_lock = threading.Lock()
+        self.idle_connections = collections.deque()
+        self.pool_pid = os.getpid()
+
+    def connect(self):
+        return pymysql.connect(
+            host=self.config.get('MySQL', 'mysql_host'),
+            user=self.config.get('MySQL', 'mysql_user'),
+            passwd=self.config.get('MySQL', 'mysql_pw'),
+            db=self.config.get('MySQL', 'mysql_db'),
+            charset="utf8",
+            connect_timeout=self.connect_timeout
+        )
+
+    def acquire(self):
+        with self.pool_lock:
+            if os.getpid() != self.pool_pid:
+                # Inherited across a fork: the parent still owns these sockets, so only drop our references.
+                self.idle_connections = collections.deque()
+                self.pool_pid = os.getpid()
+            idle_connection = self.idle_connections.pop() if self.idle_connections else None
+        if idle_connection is None:
+            return self.connect()
+        db, released_time = idle_connection
+        if time.monotonic() - released_time > self.ping_interval:
+            db.ping(reconnect=True)
+        return db
+
+    def release(self, db):
+        if db.open and db.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+            # End the transaction a read left open, as closing the connection used to, so the next borrower
+            # does not see a stale InnoDB snapshot.
+            try:
+                db.rollback()
+            except pymysql.MySQLError:
+                self.discard(db)
+                return
+        with self.pool_lock:
+            if os.getpid() == self.pool_pid and db.open and len(self.idle_connections) < self.pool_size:
+                self.idle_connections.append((db, time.monotonic()))
+                return
+        self.discard(db)
+
+    def discard(self, db):
+        try:
+            db.close()
+        except Exception:
+            pass
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a connection from the pool for the duration of the block.
+
+        Anything left uncommitted when the block ends is rolled back; a connection-level failure discards
+        the connection instead of returning it.
+        """
+        db = self.acquire()
+        try:
+            yield db
+        except pymysql.OperationalError:
+            self.discard(db)
+            raise
+        except Exception:
+            self.release(db)
+            raise
+        self.release(db)
+
+    def run_with_retry(self, operation, description):
+        """Run operation(db) in a transaction, retrying on a new connection if the connection fails.
+
+        Only for operations that give the same result when repeated after an unknown outcome.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                with self.connection() as db:
+                    operation_result = operation(db)
+                    db.commit()
+                    return operation_result
+            except pymysql.OperationalError as e:
+                if attempt > self.retries or e.args[0] not in RETRYABLE_ERRORS:
+                    raise
+                self.logger.warning(
+                    'Database %s failed (attempt %s of %s), retrying. Exception : %s',
+                    description, attempt, self.retries + 1, e
+                )
+                time.sleep(self.retry_delay * attempt)
+
+    def close(self):
+        with self.pool_lock:
+            idle_connections = self.idle_connections if os.getpid() == self.pool_pid else []
+            self.idle_connections = collections.deque()
+        for db, released_time in idle_connections:
+            self.discard(db)
@@ -0,0 +1,130 @@
+"""BNIDirectoryScanner
+
+Incremental scan of the input tree for new TIFs, built on os.scandir.
+
+Each directory's mtime and entry count are kept in a small SQLite cache once all of its TIFs have been handled.
+A directory whose mtime is unchanged on a later pass is not listed again; only its cached list
+of subdirectories is followed, since changes further down the tree do not touch the parent's mtime. Directories
+modified within the last couple of seconds are not cached, as filesystems with coarse mtime granularity (NFS in
+particular) could otherwise hide a change made in the same tick as the listing.
+
+The walk stops as soon as the batch limit is reached. A directory that was only partly queued is not cached, so
+the next pass picks up where this one stopped.
+
+Removing the cache file forces a full scan.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import json
+import os
+import sqlite3
+import time
+
+
+class BNIDirectoryScanner(object):
+    # Coarsest directory mtime resolution expected on the input share (NFSv3 servers may report whole seconds).
+    MTIME_GRANULARITY_NS = 2000000000
+
+    def __init__(self, config, logger, input_path):
+        self.logger = logger
+        self.input_path = input_path
+        self.cache_path = config.get('Intake', 'scan_cache_path', fallback='') or ':memory:'
+        self.cache_db = None
+
+    def open_cache(self):
+        if self.cache_db is None:
+            self.cache_db = sqlite3.connect(self.cache_path)
+            self.cache_db.execute(
+                "CREATE TABLE IF NOT EXISTS directories ("
+                "path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, entry_count INTEGER NOT NULL, subdirs TEXT NOT NULL)"
+            )
+            self.cache_db.commit()
+        return self.cache_db
+
+    def save_changes(self):
+        if self.cache_db is not None:
+            self.cache_db.commit()
+
+    def discard_changes(self):
+        if self.cache_db is not None:
+            self.cache_db.rollback()
+
+    def forget_directory(self, dir_path):
+        """Have the next pass list dir_path again, for files passed over by this one."""
+        self.open_cache().execute("DELETE FROM directories WHERE path=?", (dir_path,))
+
+    def close(self):
+        if self.cache_db is not None:
+            self.cache_db.close()
+            self.cache_db = None
+
+    def scan(self, select_new_files, limit):
+        """Return up to limit new TIFs from the input tree.
+
+        select_new_files is called with the TIFs of each changed directory and returns those not yet queued.
+        Directories are only remembered once save_changes() is called, after the new files have been queued.
+        """
+        cache_db = self.open_cache()
+        new_files = []
+        dirs_listed = 0
+        dirs_skipped = 0
+        entries_skipped = 0
+        dir_paths = [self.input_path]
+
+        while dir_paths and len(new_files) < limit:
+            dir_path = dir_paths.pop()
+            try:
+                dir_mtime_ns = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                continue
+            cached_dir = cache_db.execute(
+                "SELECT mtime_ns, entry_count, subdirs FROM directories WHERE path=?", (dir_path,)
+            ).fetchone()
+
+            if cached_dir is not None and cached_dir[0] == dir_mtime_ns:
+                dirs_skipped += 1
+                entries_skipped += cached_dir[1]
+                subdirs = json.loads(cached_dir[2])
+                dir_paths.extend(os.path.join(dir_path, subdir) for subdir in reversed(subdirs))
+                continue
+
+            subdirs = []
+            tif_files = []
+            entry_count = 0
+            try:
+                with os.scandir(dir_path) as dir_entries:
+                    for dir_entry in dir_entries:
+                        entry_count += 1
+                        if dir_entry.is_dir(follow_symlinks=False):
+                            subdirs.append(dir_entry.name)
+                        elif dir_entry.name.endswith('.tif'):
+                            tif_files.append(dir_entry.path)
+            except OSError as e:
+                self.logger.warning('Scanner could not list %s. Exception : %s', dir_path, e)
+                continue
+            dirs_listed += 1
+            subdirs.sort()
+            dir_paths.extend(os.path.join(dir_path, subdir) for subdir in reversed(subdirs))
+
+            if tif_files:
+                dir_new_files = select_new_files(sorted(tif_files))
+                dir_capacity = limit - len(new_files)
+                new_files.extend(dir_new_files[0:dir_capacity])
+                if len(dir_new_files) > dir_capacity:
+                    continue
+            if time.time_ns() - dir_mtime_ns < self.MTIME_GRANULARITY_NS:
+                # Too recent to trust: a change within the same mtime tick would go unnoticed.
+                continue
+
+            cache_db.execute(
+                "REPLACE INTO directories (path, mtime_ns, entry_count, subdirs) VALUES (?, ?, ?, ?)",
+                (dir_path, dir_mtime_ns, entry_count, json.dumps(subdirs))
+            )
+
+        self.logger.info(
+            'Scanner listed %s directories and skipped %s unchanged ones (%s entries).',
+            dirs_listed, dirs_skipped, entries_skipped
+        )
+        return new_files
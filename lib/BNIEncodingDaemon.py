@@ -6,16 +6,29 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
+import collections
 import configparser
+import hashlib
+import io
 import logging
 from lib.simpleDaemon import Daemon
+from lib.BNIAdmissionController import BNIAdmissionController
+from lib.BNIDatabase import BNIDatabase
+from lib.BNIDirectoryScanner import BNIDirectoryScanner
 from lib.BNIEncodingWorker import BNIEncodingWorker
+from lib.BNIImageValidator import BNIImageValidator
+from lib.BNIInotifyIntake import BNIInotifyIntake
+from lib.BNILeaseKeeper import reap_expired_leases
+from lib.BNIMetricsServer import BNIMetricsServer
+from lib.BNIOcrBackend import init_ocr_backend
+from lib.BNIOcrCache import BNIOcrCache
+from lib.BNIReelPriority import get_directory_hash, get_reel_priorities
 import pymysql
 import os
 import platform
 import multiprocessing
-import time
 import socket
+import time
 import subprocess
 
 
@@ -28,33 +41,231 @@ class BNIEncodingDaemon(Daemon):
         self.init_logger()
         self.queue = set()
         self.mysql_config_id = None
-        self.max_workers = self.config.getint('Threading', 'number_workers')
+        self.cpu_count = len(os.sched_getaffinity(0))
+        self.memory_mb = self.get_meminfo_mb('MemTotal')
+        self.max_workers, self.omp_thread_limit = self.size_worker_pool()
+        self.target_workers = self.max_workers
+        self.max_load_average = self.config.getfloat('Threading', 'max_load_average', fallback=float(self.cpu_count))
+        self.min_available_memory_mb = self.config.getint('Threading', 'min_available_memory_mb', fallback=1024)
+        self.worker_memory_mb = self.config.getint('Threading', 'worker_memory_mb', fallback=1536)
+        # Inherited by every worker, and by the tesseract processes they start.
+        os.environ['OMP_THREAD_LIMIT'] = str(self.omp_thread_limit)
         self.sleep_time = self.config.getint('Threading', 'sleep_time')
+        self.persistent = self.config.getboolean('Threading', 'persistent', fallback=False)
+        self.stopping = False
+        self.worker_processes = dict()
         self.input_path = self.config.get('Locations', 'input_path')
+        self.database = BNIDatabase(self.config, self.logger)
+        self.tesseract_version = self.get_tesseract_version()
+        # Every worker builds its own backend; building one here stops the daemon on settings they cannot honour.
+        init_ocr_backend(self.config, self.logger)
+        self.admission_controller = None
+        if self.config.getboolean('Admission', 'admission_control', fallback=True):
+            self.admission_controller = BNIAdmissionController(
+                self.config,
+                self.logger,
+                self.max_workers,
+                self.memory_mb,
+                self.config.get('Locations', 'tmp_path')
+            )
+        self.metrics_server = BNIMetricsServer(
+            self.config,
+            self.logger,
+            self.database,
+            BNIOcrCache(self.config, self.logger, self.tesseract_version),
+            self.admission_controller
+        )
+        self.intake = None
+        self.scanner = BNIDirectoryScanner(self.config, self.logger, self.input_path)
+        self.validator = None
+        if self.config.getboolean('Validation', 'header_validation', fallback=True):
+            self.validator = BNIImageValidator(self.config, self.logger)
+        self.reconcile_interval = self.config.getint('Intake', 'reconcile_interval', fallback=3600)
+        self.lease_reap_interval = self.config.getint('Threading', 'lease_reap_interval', fallback=60)
+        self.max_claim_attempts = self.config.getint('Threading', 'max_claim_attempts', fallback=3)
+        self.last_reap_time = 0.0
+        self.last_adjust_time = 0.0
         self.log_daemon_config()
 
     def run(self):
-        worker_processes = dict()
-        self.logger.info('Updating Queue.')
-        self.update_queue()
-        self.logger.info('Daemon looking for jobs for workers.')
-        for worker_id in range(self.max_workers):
+        self.worker_processes = dict()
+        if self.metrics_server.port > 0:
+            self.metrics_server.start()
+        if self.persistent and self.config.get('Intake', 'intake_mode', fallback='scan') == 'inotify':
+            self.intake = BNIInotifyIntake(self.config, self.logger, self.input_path)
+            if not self.intake.start():
+                self.intake = None
+        while not self.stopping:
+            if self.intake is not None and not self.intake.watches_exhausted:
+                # New files arrive through inotify, so full scans are only needed to reconcile.
+                rescan_seconds = self.reconcile_interval
+            else:
+                rescan_seconds = self.sleep_time
+            try:
+                self.reap_leases()
+                self.logger.info('Updating Queue.')
+                self.update_queue()
+                self.logger.info('Daemon looking for jobs for workers.')
+                self.adjust_worker_pool()
+                self.fill_worker_pool()
+            except Exception as e:
+                if not self.persistent:
+                    raise
+                # A persistent daemon keeps supervising its workers through a database outage.
+                self.logger.error('Daemon failed to update the queue, retrying in %s seconds. Exception : %s',
+                                  self.sleep_time, e)
+                rescan_seconds = self.sleep_time
+            if not self.persistent:
+                break
+            self.supervise_workers(rescan_seconds)
+        if self.intake is not None:
+            self.intake.stop()
+        self.scanner.close()
+        if self.stopping:
+            self.drain_workers()
+        for cur_worker_id, cur_worker_process in self.worker_processes.items():
+            cur_worker_process.join()
+        self.metrics_server.stop()
+        self.database.close()
+        self.logger.info('All workers retired, stopping daemon.')
+
+    def handle_sigterm(self, signum, frame):
+        if not self.stopping:
+            self.logger.info('Daemon received SIGTERM, draining workers.')
+        self.stopping = True
+
+    def fill_worker_pool(self):
+        for worker_id in list(self.worker_processes.keys()):
+            # Workers retired by a pool shrink are not replaced.
+            if worker_id >= self.target_workers and not self.worker_processes[worker_id].is_alive():
+                self.worker_processes.pop(worker_id).join()
+                self.release_worker_admissions(worker_id)
+        for worker_id in range(self.target_workers):
+            cur_worker_process = self.worker_processes.get(worker_id)
+            if cur_worker_process is not None and cur_worker_process.is_alive():
+                continue
+            if cur_worker_process is not None:
+                cur_worker_process.join()
+                self.release_worker_admissions(worker_id)
+                if self.stopping:
+                    continue
+                self.logger.info('Worker %s exited with code %s, restarting.', worker_id, cur_worker_process.exitcode)
             self.logger.info('Daemon found job(s) - deploying to new worker %s.', worker_id)
             worker = BNIEncodingWorker(
                 worker_id,
                 self.config,
                 self.logger,
                 self.input_path,
+                self.mysql_config_id,
+                self.tesseract_version,
+                self.admission_controller,
             )
-            worker_processes[worker_id] = multiprocessing.Process(name='encodingworker-'+str(worker_id), target=worker.run)
-            worker_processes[worker_id].start()
-            # Sleep on initial worker spin-up to let previous worker get job from queue and stagger queue
-            # grabs. It currently is 'safe' but throw exceptions if two workers try to grab at the same time.
-            # Making it 100% thread safe with blocking is a whole thing, so we do this.
-            time.sleep(3)
-        for cur_worker_id, cur_worker_process in worker_processes.items():
-            cur_worker_process.join()
-        self.logger.info('All workers retired, stopping daemon.', self.sleep_time)
+            # Workers claim their images atomically, so they can all be started at once.
+            self.worker_processes[worker_id] = multiprocessing.Process(name='encodingworker-'+str(worker_id), target=worker.run)
+            self.worker_processes[worker_id].start()
+
+    def release_worker_admissions(self, worker_id):
+        # A worker killed mid-page, by the OOM killer for one, never releases what it reserved.
+        if self.admission_controller is not None:
+            self.admission_controller.release_worker(worker_id)
+
+    def supervise_workers(self, seconds):
+        """Keep the worker pool full until it is time to rescan the input path."""
+        rescan_time = time.monotonic() + seconds
+        while not self.stopping and time.monotonic() < rescan_time:
+            if self.intake is not None and self.intake.needs_reconcile:
+                self.intake.needs_reconcile = False
+                break
+            try:
+                if self.intake is not None:
+                    self.queue_files(self.intake.poll(1))
+                    if self.intake.needs_reconcile:
+                        continue
+                else:
+                    time.sleep(1)
+                if not self.stopping:
+                    # In inotify mode this loop can run for a whole reconcile interval, so load is checked here too.
+                    if time.monotonic() - self.last_adjust_time >= self.sleep_time:
+                        self.adjust_worker_pool()
+                    self.fill_worker_pool()
+                    if time.monotonic() - self.last_reap_time >= self.lease_reap_interval:
+                        self.reap_leases()
+            except Exception as e:
+                self.logger.error('Daemon failed while supervising workers, will retry. Exception : %s', e)
+                if self.intake is not None:
+                    # Files whose events were lost with the failure are picked up by the next scan.
+                    self.intake.needs_reconcile = True
+                time.sleep(1)
+
+    def reap_leases(self):
+        self.last_reap_time = time.monotonic()
+        try:
+            reap_expired_leases(self.database, self.logger, self.max_claim_attempts)
+        except Exception as e:
+            self.logger.error('Daemon failed to reap expired leases. Exception : %s', e)
+
+    def size_worker_pool(self):
+        """Choose the number of workers and the OpenMP threads each Tesseract may use.
+
+        'auto' workers fill the CPUs with single threaded Tesseract runs, limited by how many workers fit in
+        memory; 'auto' OpenMP threads share out whatever CPUs the workers leave idle.
+        """
+        number_workers = self.config.get('Threading', 'number_workers')
+        omp_thread_limit = self.config.get('Threading', 'omp_thread_limit', fallback='auto')
+        worker_memory_mb = self.config.getint('Threading', 'worker_memory_mb', fallback=1536)
+        ocr_per_worker = 1
+        if self.config.get('Threading', 'worker_mode', fallback='serial') == 'pipelined':
+            ocr_per_worker = self.config.getint('Threading', 'pipeline_ocr_threads', fallback=2)
+
+        if number_workers == 'auto':
+            threads_per_ocr = 1 if omp_thread_limit == 'auto' else int(omp_thread_limit)
+            max_workers = max(1, min(
+                self.cpu_count // (threads_per_ocr * ocr_per_worker),
+                self.memory_mb // worker_memory_mb
+            ))
+        else:
+            max_workers = int(number_workers)
+
+        if omp_thread_limit == 'auto':
+            omp_thread_limit = max(1, self.cpu_count // (max_workers * ocr_per_worker))
+        self.logger.info('Daemon sized pool to %s workers with OMP_THREAD_LIMIT=%s for %s CPUs and %s MB.',
+                         max_workers, omp_thread_limit, self.cpu_count, self.memory_mb)
+        return max_workers, int(omp_thread_limit)
+
+    def adjust_worker_pool(self):
+        """Shrink the pool under load or memory pressure, and grow it back towards max_workers once it clears."""
+        self.last_adjust_time = time.monotonic()
+        load_average = os.getloadavg()[0]
+        available_memory_mb = self.get_meminfo_mb('MemAvailable')
+        target_workers = self.target_workers
+        if load_average > self.max_load_average or available_memory_mb < self.min_available_memory_mb:
+            target_workers = max(1, self.target_workers - 1)
+        elif (load_average < self.max_load_average * 0.75 and
+              available_memory_mb > self.min_available_memory_mb + self.worker_memory_mb):
+            target_workers = min(self.max_workers, self.target_workers + 1)
+        if target_workers == self.target_workers:
+            return
+
+        self.logger.info('Daemon resizing pool from %s to %s workers (load %s, %s MB available).',
+                         self.target_workers, target_workers, load_average, available_memory_mb)
+        self.target_workers = target_workers
+        for worker_id, cur_worker_process in self.worker_processes.items():
+            if worker_id >= self.target_workers and cur_worker_process.is_alive():
+                cur_worker_process.terminate()
+        self.log_daemon_config(load_average, available_memory_mb)
+
+    def get_meminfo_mb(self, meminfo_key):
+        with io.open('/proc/meminfo', 'r') as meminfo_p:
+            for meminfo_line in meminfo_p:
+                if meminfo_line.startswith(meminfo_key + ':'):
+                    return int(meminfo_line.split()[1]) // 1024
+        return 0
+
+    def drain_workers(self):
+        for cur_worker_id, cur_worker_process in self.worker_processes.items():
+            if cur_worker_process.is_alive():
+                self.logger.info('Daemon asking worker %s to finish its current image and retire.', cur_worker_id)
+                cur_worker_process.terminate()
 
     def init_config(self, config_filepath):
         self.config = configparser.SafeConfigParser()
@@ -76,88 +287,206 @@ class BNIEncodingDaemon(Daemon):
     def update_queue(self):
         self.logger.info('Daemon looking for jobs for workers.')
 
-        self.db = self.init_mysql()
-        self.db_cur = self.db.cursor()
-        batch_image_counter = 0
-
-        for root, subFolders, files in os.walk(self.input_path):
-            files = [fi for fi in files if fi.endswith(".tif")]
-            if len(files) > 0:
-                for cur_file in files:
-                    if batch_image_counter < self.config.getint('Threading', 'images_per_batch'):
-                        if not self.file_already_queued(os.path.join(root, cur_file)):
-                            self.queue.update([os.path.join(root, cur_file)])
-                            batch_image_counter += 1
-
-        self.db_cur.close()
-        self.db.close()
-
-        if len(self.queue) > 0:
-            self.logger.info('Some images found, bulk loading queue with all new images.')
-            self.log_queue_insert(self.queue)
-
-    def init_mysql(self):
-        return pymysql.connect(
-            host=self.config.get('MySQL', 'mysql_host'),
-            user=self.config.get('MySQL', 'mysql_user'),
-            passwd=self.config.get('MySQL', 'mysql_pw'),
-            db=self.config.get('MySQL', 'mysql_db'),
-            charset="utf8"
+        images_per_batch = self.config.getint('Threading', 'images_per_batch')
+
+        try:
+            with self.database.connection() as self.db:
+                self.db_cur = self.db.cursor()
+                self.queue.update(self.scanner.scan(self.select_unqueued_files, images_per_batch))
+                self.db_cur.close()
+
+            if len(self.queue) > 0:
+                self.logger.info('Some images found, bulk loading queue with all new images.')
+                self.insert_validated_files(self.queue)
+        except Exception:
+            # Directories are only remembered as handled once their images are queued.
+            self.scanner.discard_changes()
+            raise
+        finally:
+            self.queue.clear()
+        self.scanner.save_changes()
+
+    def select_unqueued_files(self, filepaths):
+        queued_files = self.get_queued_filepaths(
+            [self.get_typeless_relative_path(cur_file) for cur_file in filepaths]
         )
+        return [cur_file for cur_file in filepaths if self.get_typeless_relative_path(cur_file) not in queued_files]
+
+    def queue_files(self, filepaths):
+        """Queue the given TIFs, skipping any already in the images table."""
+        if not filepaths:
+            return
+        with self.database.connection() as self.db:
+            self.db_cur = self.db.cursor()
+            new_files = self.select_unqueued_files(filepaths)
+            self.db_cur.close()
+
+        if len(new_files) > 0:
+            self.logger.info('Intake found %s new image(s), loading them into the queue.', len(new_files))
+            self.insert_validated_files(new_files)
+
+    def insert_validated_files(self, filepaths):
+        """Queue the given TIFs, inserting those failing header validation with their failure status instead.
+
+        Pages still being written are left out, and their directory is listed again by the next scan.
+        """
+        if self.validator is None:
+            self.log_queue_insert(filepaths)
+            return
+        files_by_status = collections.defaultdict(list)
+        for cur_file in filepaths:
+            status_id = self.validator.validate(cur_file)
+            if status_id is None:
+                self.scanner.forget_directory(os.path.dirname(cur_file))
+                continue
+            files_by_status[status_id].append(cur_file)
+        for status_id, status_files in sorted(files_by_status.items()):
+            self.log_queue_insert(status_files, status_id)
 
     def log_queue_insert(self, files, status_id=1):
-        self.db = self.init_mysql()
-        self.db_cur = self.db.cursor()
-        insert_queue_string = "INSERT INTO images (config_id, filepath, status_id, queue_datestamp, latest_datestamp) VALUES"
-
-        for cur_file in files:
-            file_stem = os.path.basename(cur_file)
-            cur_typeless_path = os.path.normpath(os.path.dirname(cur_file) + '/../')
-            cur_typeless_file = cur_typeless_path + '/' + file_stem
-            cur_typeless_relative = cur_typeless_file.replace(self.input_path + '/', '')
-            insert_queue_string += " (" + str(self.mysql_config_id) + "," + "'" + cur_typeless_relative + "'," + str(status_id) + "," + "NOW()," + "NOW()),"
-
-        self.db_cur.execute(insert_queue_string.rstrip(","))
-        self.db.commit()
-
-        self.db_cur.close()
-        self.db.close()
-
-    def log_daemon_config(self):
-        self.db = self.init_mysql()
-        self.db_cur = self.db.cursor()
-        os_lsb_data = platform.linux_distribution()
-        self.db_cur.execute("INSERT INTO configuration " +
-                        "(hostname, os_id, os_release, num_workers, sleep_time, gm_version, tesseract_version, tesseract_language, gm_surrogate_convert_options)" +
-                        " VALUES " +
-                        "(" +
-                        "'" + self.get_hostname() + "'," +
-                        "'" + os_lsb_data[0] + "'," +
-                        "'" + os_lsb_data[1] + "'," +
-                        self.config.get('Threading', 'number_workers') + "," +
-                        self.config.get('Threading', 'sleep_time') + "," +
-                        "'" + self.get_gm_version() + "'," +
-                        "'" + self.get_tesseract_version() + "'," +
-                        "'" + self.config.get('Tesseract', 'tesseract_language') + "'," +
-                        "'" + self.config.get('HOCR', 'gm_surrogate_convert_options') + "')"
+        insert_chunk_size = self.config.getint('Threading', 'insert_chunk_size', fallback=500)
+        insert_commit_interval = self.config.getint('Threading', 'insert_commit_interval', fallback=1)
+        insert_queue_query = (
+            "INSERT INTO images (config_id, filepath, path_hash, status_id, queue_datestamp, latest_datestamp, "
+            "directory_hash, priority) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
         )
-        self.db.commit()
-        self.mysql_config_id = self.db_cur.lastrowid
-        self.db_cur.close()
-        self.db.close()
+
+        with self.database.connection() as self.db:
+            self.db_cur = self.db.cursor()
+            # Use the server clock for the datestamps, as NOW() would, but keep the statement parameter only so
+            # executemany can send each chunk as a single multi-row INSERT.
+            self.db_cur.execute("SELECT NOW()")
+            queue_datestamp = self.db_cur.fetchone()[0]
+            typeless_relative_paths = [self.get_typeless_relative_path(cur_file) for cur_file in sorted(files)]
+            reel_priorities = get_reel_priorities(
+                self.db_cur,
+                set(get_directory_hash(typeless_relative_path) for typeless_relative_path in typeless_relative_paths)
+            )
+            queue_rows = []
+            for typeless_relative_path in typeless_relative_paths:
+                directory_hash = get_directory_hash(typeless_relative_path)
+                queue_rows.append((
+                    self.mysql_config_id,
+                    typeless_relative_path,
+                    self.get_path_hash(typeless_relative_path),
+                    status_id,
+                    queue_datestamp,
+                    queue_datestamp,
+                    directory_hash,
+                    reel_priorities.get(directory_hash, 0),
+                ))
+
+            inserted_rows = 0
+            rejected_rows = 0
+            for chunk_number, chunk_start in enumerate(range(0, len(queue_rows), insert_chunk_size), 1):
+                chunk = queue_rows[chunk_start:chunk_start + insert_chunk_size]
+                try:
+                    self.db_cur.executemany(insert_queue_query, chunk)
+                    inserted_rows += len(chunk)
+                except pymysql.MySQLError as e:
+                    self.logger.warning('Bulk queue insert of %s images failed, retrying individually. Exception : %s', len(chunk), e)
+                    chunk_inserted, chunk_rejected = self.log_queue_insert_rows(insert_queue_query, chunk)
+                    inserted_rows += chunk_inserted
+                    rejected_rows += chunk_rejected
+                if chunk_number % insert_commit_interval == 0:
+                    self.db.commit()
+            self.db.commit()
+            self.db_cur.close()
+
+        self.logger.info('Queue insert complete : %s images inserted, %s images rejected.', inserted_rows, rejected_rows)
+        return inserted_rows, rejected_rows
+
+    def log_queue_insert_rows(self, insert_queue_query, queue_rows):
+        """Insert queue rows one at a time so a single bad row cannot reject its whole chunk.
+
+        Rows queued meanwhile by another daemon would fail the unique path_hash index, so rows that are already
+        present are counted as inserted rather than rejected.
+        """
+        inserted_rows = 0
+        rejected_rows = 0
+        queued_filepaths = self.get_queued_filepaths([queue_row[1] for queue_row in queue_rows])
+        for queue_row in queue_rows:
+            if queue_row[1] in queued_filepaths:
+                inserted_rows += 1
+                continue
+            try:
+                self.db_cur.execute(insert_queue_query, queue_row)
+                inserted_rows += 1
+            except pymysql.MySQLError as e:
+                self.logger.error('Rejected queue insert of %s. Exception : %s', queue_row[1], e)
+                rejected_rows += 1
+        return inserted_rows, rejected_rows
+
+    def log_daemon_config(self, load_average=None, available_memory_mb=None):
+        """Record the daemon's configuration. The first row logged identifies the run for its whole life.
+
+        Rows logged on a pool resize only record the new size: the run's config_id must stay fixed, as workers
+        and their leases are identified by it.
+        """
+        os_lsb_data = self.get_os_release()
+        with self.database.connection() as self.db:
+            self.db_cur = self.db.cursor()
+            self.db_cur.execute(
+                "INSERT INTO configuration "
+                "(hostname, os_id, os_release, num_workers, sleep_time, gm_version, tesseract_version, tesseract_language, gm_surrogate_convert_options, "
+                "omp_thread_limit, cpu_count, memory_mb, load_average, available_memory_mb)"
+                " VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                (
+                    self.get_hostname(),
+                    os_lsb_data[0],
+                    os_lsb_data[1],
+                    self.target_workers,
+                    self.config.get('Threading', 'sleep_time'),
+                    self.get_gm_version(),
+                    self.tesseract_version,
+                    self.config.get('Tesseract', 'tesseract_language'),
+                    self.config.get('HOCR', 'gm_surrogate_convert_options'),
+                    self.omp_thread_limit,
+                    self.cpu_count,
+                    self.memory_mb,
+                    load_average,
+                    available_memory_mb,
+                )
+            )
+            self.db.commit()
+            if self.mysql_config_id is None:
+                self.mysql_config_id = self.db_cur.lastrowid
+            self.db_cur.close()
         return True
 
-    def file_already_queued(self, filepath):
+    def get_queued_filepaths(self, typeless_relative_paths):
+        """Return the subset of the given typeless paths that already exist in the images table.
+
+        Paths are looked up by their path_hash, with one IN() query per chunk rather than one query per file.
+        """
+        queued_filepaths = set()
+        chunk_size = self.config.getint('Threading', 'queue_lookup_chunk_size', fallback=500)
+        for chunk_start in range(0, len(typeless_relative_paths), chunk_size):
+            chunk = typeless_relative_paths[chunk_start:chunk_start + chunk_size]
+            self.db_cur.execute(
+                "SELECT filepath FROM images WHERE path_hash IN (" + ','.join(['%s'] * len(chunk)) + ")",
+                [self.get_path_hash(typeless_relative_path) for typeless_relative_path in chunk]
+            )
+            queued_filepaths.update(row[0] for row in self.db_cur.fetchall())
+        return queued_filepaths
+
+    def get_path_hash(self, typeless_relative_path):
+        # Matches UNHEX(SHA1(filepath)) computed by the server over the utf8 column.
+        return hashlib.sha1(typeless_relative_path.encode('utf-8')).digest()
+
+    def get_typeless_relative_path(self, filepath):
         file_stem = os.path.basename(filepath)
         cur_typeless_path = os.path.normpath(os.path.dirname(filepath) + '/../')
         cur_typeless_file = cur_typeless_path + '/' + file_stem
-        cur_typeless_relative = cur_typeless_file.replace(self.input_path + '/', '')
-        check_queued_query = "SELECT COUNT(1) FROM images WHERE filepath = '" + cur_typeless_relative + "'"
+        return cur_typeless_file.replace(self.input_path + '/', '')
 
-        self.db_cur.execute(check_queued_query)
-        if self.db_cur.fetchone()[0] > 0:
-            return True
-        return False
+    def get_os_release(self):
+        # platform.linux_distribution() no longer exists as of Python 3.8.
+        try:
+            os_release = platform.freedesktop_os_release()
+        except (AttributeError, OSError):
+            return '', ''
+        return os_release.get('ID', ''), os_release.get('VERSION_ID', '')
 
     def get_hostname(self):
         return socket.getfqdn()
@@ -168,4 +497,5 @@ class BNIEncodingDaemon(Daemon):
     def get_tesseract_version(self):
         sub_p = subprocess.Popen([self.config.get('Tesseract', 'tesseract_bin_path'),'--version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         (tesseract_stdout, tesseract_stderr) = sub_p.communicate()
-        return tesseract_stderr.strip().decode('utf-8').replace("\n", ' ')
+        # Older releases print the version to stderr, newer ones to stdout.
+        return (tesseract_stdout.strip() or tesseract_stderr.strip()).decode('utf-8').replace("\n", ' ')
@@ -0,0 +1,110 @@
+"""BNIEncodingPipeline
+
+Pipelined processing mode for BNIEncodingWorker.
+
+Each image passes through a series of stages, every stage being serviced by its own pool of threads and fed
+by a bounded queue. This lets the CPU bound stages (GraphicsMagick, Tesseract) of one image overlap with the
+I/O bound stages (archiving, checksums, cleanup) of its neighbours.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import queue
+import threading
+
+
+class BNIEncodingPipeline(object):
+    # Stage name, worker method run for each image, default number of threads.
+    STAGES = (
+        ('validate', 'validate_files', 1),
+        ('ocr', 'encode_files', 2),
+        ('archive', 'archive_outputs', 1),
+        ('cleanup', 'complete_file', 1),
+    )
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.config = worker.config
+        self.logger = worker.logger
+        self.worker_id = worker.worker_id
+        self.queue_size = self.config.getint('Threading', 'pipeline_queue_size', fallback=2)
+        self.stage_queues = []
+        self.stage_threads = []
+
+    def run(self):
+        self.start_stages()
+        self.feed_images()
+        self.stop_stages()
+        self.logger.info('Worker %s pipeline drained, retiring.', self.worker_id)
+
+    def start_stages(self):
+        self.stage_queues = [queue.Queue(maxsize=self.queue_size) for stage in self.STAGES]
+        for stage_index, (stage_name, stage_method, default_threads) in enumerate(self.STAGES):
+            num_threads = self.config.getint('Threading', 'pipeline_' + stage_name + '_threads', fallback=default_threads)
+            threads = []
+            for thread_number in range(max(1, num_threads)):
+                cur_thread = threading.Thread(
+                    name='encodingworker-' + str(self.worker_id) + '-' + stage_name + '-' + str(thread_number),
+                    target=self.run_stage,
+                    args=(stage_index,),
+                )
+                cur_thread.daemon = True
+                cur_thread.start()
+                threads.append(cur_thread)
+            self.stage_threads.append(threads)
+            self.logger.info('Worker %s started %s %s stage thread(s).', self.worker_id, len(threads), stage_name)
+
+    def feed_images(self):
+        while not self.worker.stopping:
+            page = self.worker.page_context()
+            try:
+                has_image = page.setup_next_image()
+            except Exception as e:
+                self.logger.error('Worker %s excepted out while setting up an image with %s.', self.worker_id, e)
+                claim_failed = page.cur_image_id is None
+                page.abandon_image()
+                if claim_failed:
+                    self.worker.idle_wait(self.worker.sleep_time)
+                continue
+            if not has_image:
+                if not self.worker.persistent:
+                    self.logger.info('Worker %s could not find any more queue items, draining pipeline.', self.worker_id)
+                    break
+                self.logger.info('Worker %s could not find any queue items, waiting %s seconds.', self.worker_id, self.worker.sleep_time)
+                self.worker.idle_wait(self.worker.sleep_time)
+                continue
+            self.logger.info('Worker %s set to work on %s.', self.worker_id, page.cur_tif)
+            # Blocks while the first stage is full, which keeps the worker from claiming far ahead of itself.
+            self.stage_queues[0].put(page)
+
+    def stop_stages(self):
+        # Stages are stopped in order, so every image queued ahead of a sentinel is finished downstream.
+        for stage_queue, threads in zip(self.stage_queues, self.stage_threads):
+            for cur_thread in threads:
+                stage_queue.put(None)
+            for cur_thread in threads:
+                cur_thread.join()
+
+    def run_stage(self, stage_index):
+        stage_name, stage_method, default_threads = self.STAGES[stage_index]
+        in_queue = self.stage_queues[stage_index]
+        out_queue = None
+        if stage_index + 1 < len(self.stage_queues):
+            out_queue = self.stage_queues[stage_index + 1]
+
+        while True:
+            page = in_queue.get()
+            if page is None:
+                break
+            try:
+                stage_passed = getattr(page, stage_method)()
+            except Exception as e:
+                self.logger.info('Worker %s %s stage excepted out on %s with %s.', self.worker_id, stage_name, page.cur_tif, e)
+                # Hand the image back, or it would stay in progress, its lease renewed for as long as this worker lives.
+                page.abandon_image()
+                continue
+            if not stage_passed:
+                page.remove_tempfiles()
+            elif out_queue is not None:
+                out_queue.put(page)
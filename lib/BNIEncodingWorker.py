@@ -6,18 +6,29 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
-from bs4 import BeautifulSoup
+from lib.BNIArchiver import BNIArchiver
+from lib.BNIDatabase import BNIDatabase
+from lib.BNIEncodingPipeline import BNIEncodingPipeline
+from lib.BNIHocrDistiller import BNIHocrDistiller
+from lib.BNILeaseKeeper import BNILeaseKeeper
+from lib.BNIOcrBackend import init_ocr_backend
+from lib.BNIOcrCache import BNIOcrCache
+from lib.BNIPageCheckpoint import BNIPageCheckpoint
+from lib.BNIStatusWriter import BNIStatusWriter
+import collections
+import copy
 import errno
-import pymysql
 import io
 import os
 import re
-import subprocess
+import signal
 import threading
+import time
 
 
 class BNIEncodingWorker(object):
-    def __init__(self, worker_id, config, logger, tree_base_path):
+    def __init__(self, worker_id, config, logger, tree_base_path, config_id=None, tesseract_version='',
+                 admission_controller=None):
         threading.Thread.__init__(self)
         self.init_config(config)
         self.logger = None
@@ -31,106 +42,264 @@ class BNIEncodingWorker(object):
         self.tmp_file_dir = ''
         self.tree_target_dir = ''
         self.file_stem = ''
-        self.db = self.init_mysql()
-        self.db_cur = self.db.cursor()
+        self.cur_image_id = None
+        self.cur_status_id = None
+        self.config_id = config_id
+        self.claimed_items = collections.deque()
         self.tree_base_path = tree_base_path
         self.worker_id = worker_id
         self.init_logger(logger)
+        self.database = BNIDatabase(self.config, self.logger)
+        self.lease_keeper = BNILeaseKeeper(self.config, self.logger, self.database, self.config_id, self.worker_id)
         self.tmp_path = self.config.get('Locations', 'tmp_path')
         self.bni_output_path = self.config.get('Locations', 'bni_output_path')
         self.lib_output_path = self.config.get('Locations', 'lib_output_path')
         self.language = self.config.get('Tesseract', 'tesseract_language')
+        self.ocr_backend = init_ocr_backend(self.config, self.logger)
         self.tmp_root = self.config.get('Locations', 'tmp_path')
+        self.images_per_claim = self.config.getint('Threading', 'images_per_claim', fallback=1)
+        self.persistent = self.config.getboolean('Threading', 'persistent', fallback=False)
+        self.sleep_time = self.config.getint('Threading', 'sleep_time')
+        self.worker_mode = self.config.get('Threading', 'worker_mode', fallback='serial')
+        self.sha1_buffer_size = self.config.getint('SHA1Sum', 'sha1sum_buffer_size', fallback=1048576)
+        self.archive_timeout = self.config.getfloat(
+            'Archive',
+            'archive_timeout',
+            fallback=self.config.getfloat('RSync', 'rsync_timeout', fallback=120.0)
+        )
+        self.archiver = BNIArchiver(self.config, self.logger)
+        self.ocr_cache = BNIOcrCache(self.config, self.logger, tesseract_version)
+        self.ocr_cache_key = None
+        self.admission_controller = admission_controller
+        self.large_page = False
+        self.checkpoint_pages = self.config.getboolean('Threading', 'checkpoint_pages', fallback=False)
+        self.checkpoint = None
+        self.resume_status_id = 0
+        self.status_writer = BNIStatusWriter(
+            self.config,
+            self.logger,
+            self.database,
+            (self.config_id, self.worker_id)
+        )
+        self.stopping = False
 
     def run(self):
         self.logger.info('Worker %s Initializing MySQL Connection.', self.worker_id)
-        while True:
+        signal.signal(signal.SIGTERM, self.handle_sigterm)
+        self.status_writer.start()
+        self.lease_keeper.start()
+        if self.worker_mode == 'pipelined':
+            BNIEncodingPipeline(self).run()
+        else:
+            self.run_serial()
+        self.retire()
+
+    def run_serial(self):
+        while not self.stopping:
             self.logger.info('Worker %s does not have a task assigned. Looking for one.', self.worker_id)
             try:
-                self.setup_next_image()
+                if not self.setup_next_image():
+                    if not self.persistent:
+                        self.logger.info('Worker %s could not find any more queue items, retiring.', self.worker_id)
+                        break
+                    self.logger.info('Worker %s could not find any queue items, waiting %s seconds.', self.worker_id, self.sleep_time)
+                    self.idle_wait(self.sleep_time)
+                    continue
                 self.logger.info('Worker %s set to work on %s.', self.worker_id, self.cur_tif)
                 self.process_file()
             except Exception as e:
-                self.logger.info('Worker %s excepted out with %s.', self.worker_id, e)
+                self.logger.error('Worker %s excepted out with %s.', self.worker_id, e)
+                claim_failed = self.cur_image_id is None
+                self.abandon_image()
+                if claim_failed:
+                    # Nothing was claimed, most likely the database is unreachable, so back off before retrying.
+                    self.idle_wait(self.sleep_time)
+
+    def abandon_image(self):
+        """Hand back the current image after an exception instead of leaving it leased to this worker.
+
+        The image is re-queued for another attempt, keeping its checkpointed outputs for that attempt to resume
+        from, or failed once it has used up max_claim_attempts.
+        """
+        if self.cur_image_id is None:
+            return
+        self.remove_working_files()
+        try:
+            # Statuses logged before the exception must land before the lease is given up.
+            self.status_writer.flush()
+            if self.lease_keeper.abandon(self.cur_image_id):
+                self.logger.info('Worker %s re-queued %s for another attempt.', self.worker_id, self.cur_tif)
+            else:
+                self.logger.error('Worker %s failed %s, which has used up its attempts.', self.worker_id, self.cur_tif)
                 self.remove_tempfiles()
-                break
+        except Exception as e:
+            self.logger.error('Worker %s could not hand back %s. Exception : %s', self.worker_id, self.cur_tif, e)
+
+    def retire(self):
+        try:
+            self.status_writer.stop()
+        except Exception as e:
+            self.logger.error('Worker %s failed to write its final statuses. Exception : %s', self.worker_id, e)
+        self.release_claimed_items()
+        self.lease_keeper.stop()
+        self.database.close()
+
+    def handle_sigterm(self, signum, frame):
+        # Let the current image finish, then retire at the top of the run loop.
+        self.logger.info('Worker %s received SIGTERM, retiring after the current image.', self.worker_id)
+        self.stopping = True
+
+    def idle_wait(self, seconds):
+        wait_until = time.monotonic() + seconds
+        while not self.stopping and time.monotonic() < wait_until:
+            time.sleep(1)
 
     def process_file(self):
-        if (self.check_tif_size() and
-            self.check_jpg_exits() and
-            self.check_jpg_size() and
-            self.generate_hocr() and
-            self.generate_ocr() and
-            self.archive_files(self.bni_output_path, ['txt', 'tif']) and
-            self.archive_files(self.lib_output_path, ['hocr', 'txt', 'jpg'])
+        if (self.validate_files() and
+            self.encode_files() and
+            self.archive_outputs()
         ):
+            self.complete_file()
+        else:
+            # Every stage returns False only after logging a terminal failure status.
             self.remove_tempfiles()
-            self.remove_originals()
-            self.log_worker_stage(26)
 
-    def generate_hocr(self):
-        self.logger.info('Worker %s generating HOCR for %s.', self.worker_id, self.cur_tif)
-        self.hocr_surrogate_filepath = os.path.join(
-            self.tmp_root,
-            self.tree_target_dir,
-            self.file_stem + '-grayscale.tif'
-        )
-        gm_call = [
-            self.config.get('GraphicsMagick', 'gm_bin_path'),
-            "convert",
-            self.tmp_tif
-        ]
-        self.log_worker_stage(9)
-        self.append_additional_encode_options(gm_call, 'gm_surrogate_convert_options', 'GraphicsMagick')
-        gm_call.append(self.hocr_surrogate_filepath)
+    def validate_files(self):
+        if self.resume_status_id:
+            # Validated before the checkpoint was written, and the checkpoint has confirmed the sources are unchanged.
+            return True
+        return (self.time_stage(self.check_tif_size) and
+                self.time_stage(self.check_jpg_exits) and
+                self.time_stage(self.check_jpg_size))
 
+    def encode_files(self):
+        if self.resume_status_id >= 18:
+            return True
+        if self.resume_status_id < 15 and self.fetch_cached_ocr():
+            self.record_checkpoint(15, ['hocr'])
+            self.record_checkpoint(18, ['txt'])
+            return True
+        if self.resume_status_id < 15 and not self.time_stage(self.generate_hocr):
+            return False
+        self.record_checkpoint(15, ['hocr'])
+        if not self.time_stage(self.generate_ocr):
+            return False
+        self.record_checkpoint(18, ['txt'])
+        self.store_cached_ocr()
+        return True
+
+    def fetch_cached_ocr(self):
+        """Place a cached hOCR and txt for an identical TIF, skipping gm and tesseract. Returns True on a hit."""
+        self.ocr_cache_key = None
+        if not self.ocr_cache.enabled:
+            return False
         try:
-            gm_return = subprocess.call(gm_call, timeout=float(self.config.get('GraphicsMagick', 'gm_timeout')))
+            self.ocr_cache_key = self.ocr_cache.get_key(self.cur_tif)
+            if not self.ocr_cache.fetch(self.ocr_cache_key, self.tmp_filepath_stem):
+                return False
         except Exception as e:
-            self.logger.info('Worker %s failed encoding HOCR surrogate to tesseract input file %s. Exception : %s',
-                             self.worker_id,
-                             self.hocr_surrogate_filepath,
-                             e)
-            self.log_worker_stage(11)
+            self.logger.warning('Worker %s could not read the OCR cache for %s. Exception : %s', self.worker_id, self.cur_tif, e)
             return False
+        self.logger.info('Worker %s found cached OCR for %s.', self.worker_id, self.cur_tif)
+        self.log_worker_stage(15)
+        self.log_worker_stage(18)
+        return True
 
-        if gm_return == 0:
-            self.log_encode_success()
-            self.logger.info('Worker %s succeeded in encoding HOCR surrogate to tesseract input file %s.',
-                             self.worker_id,
-                             self.hocr_surrogate_filepath)
-            self.log_worker_stage(10)
-        else:
-            self.logger.info('Worker %s failed encoding HOCR surrogate to tesseract input file %s.',
-                             self.worker_id,
-                             self.hocr_surrogate_filepath)
-            self.log_worker_stage(11)
+    def store_cached_ocr(self):
+        if not self.ocr_cache.enabled:
+            return
+        try:
+            if self.ocr_cache_key is None:
+                # A page resumed after PASSHOCR never looked the cache up, so its key was never computed.
+                self.ocr_cache_key = self.ocr_cache.get_key(self.cur_tif)
+            self.ocr_cache.store(self.ocr_cache_key, self.tmp_filepath_stem)
+        except Exception as e:
+            self.logger.warning('Worker %s could not add %s to the OCR cache. Exception : %s', self.worker_id, self.cur_tif, e)
+
+    def archive_outputs(self):
+        if self.resume_status_id >= 23:
+            return True
+        if not self.time_stage(
+            self.archive_files,
+            [
+                (self.bni_output_path, ['txt', 'tif']),
+                (self.lib_output_path, ['hocr', 'txt', 'jpg']),
+            ]
+        ):
             return False
+        self.record_checkpoint(23, [])
+        return True
 
-        self.log_worker_stage(12)
-        tesseract_call = [
-            self.config.get('Tesseract', 'tesseract_bin_path'),
-            self.hocr_surrogate_filepath,
-            self.tmp_filepath_stem,
-            "-l", self.language,
-            'hocr',
-        ]
+    def load_checkpoint(self):
+        """Find how far a previous attempt at the current image got, so finished stages are not redone."""
+        self.resume_status_id = 0
+        self.checkpoint = None
+        self.ocr_cache_key = None
+        if not self.checkpoint_pages:
+            return
+        self.checkpoint = BNIPageCheckpoint(
+            '.'.join((self.tmp_filepath_stem, 'checkpoint')),
+            [self.cur_tif, self.cur_jpg],
+            self.logger,
+            self.sha1_buffer_size
+        )
+        self.resume_status_id = self.checkpoint.load()
+        if self.resume_status_id:
+            self.logger.info('Worker %s resuming %s after status %s.', self.worker_id, self.cur_tif, self.resume_status_id)
+
+    def record_checkpoint(self, status_id, extensions, data=None):
+        if self.checkpoint is None or self.resume_status_id >= status_id:
+            return
+        self.checkpoint.record(
+            status_id,
+            ['.'.join((self.tmp_filepath_stem, cur_extension)) for cur_extension in extensions],
+            data
+        )
 
-        self.log_encode_begin()
+    def complete_file(self):
+        self.time_stage(self.remove_files)
+        self.log_worker_stage(26)
+        return True
+
+    def remove_files(self):
+        self.remove_tempfiles()
+        return self.remove_originals()
 
+    def time_stage(self, stage_function, *args):
+        """Run a processing stage, recording its duration against the last status the stage logged."""
+        stage_start = time.monotonic()
         try:
-            tesseract_return = subprocess.call(tesseract_call, timeout=float(self.config.get('Tesseract', 'tesseract_timeout')))
-        except Exception as e:
-            self.log_tesseract_fail(e)
-            self.log_worker_stage(13)
-            return False
+            return stage_function(*args)
+        finally:
+            self.status_writer.record_timing(
+                self.cur_image_id,
+                self.cur_status_id,
+                int((time.monotonic() - stage_start) * 1000),
+                self.worker_id,
+                self.config_id
+            )
 
-        if tesseract_return is 0:
-            self.log_worker_stage(15)
-            return True
-        self.log_encode_fail()
-        self.log_worker_stage(14)
-        return False
+    def page_context(self):
+        """Return a copy of this worker that carries a single image through the pipelined stages.
+
+        The copy shares the configuration, logger, database connection and claimed items with this worker.
+        """
+        page = copy.copy(self)
+        page.hocr_surrogate_filepath = ''
+        return page
+
+    def generate_hocr(self):
+        if self.admission_controller is None:
+            self.logger.info('Worker %s generating HOCR for %s.', self.worker_id, self.cur_tif)
+            return self.ocr_backend.generate_hocr(self)
+        admission = self.admission_controller.admit(self, self.cur_tif)
+        self.large_page = admission[3]
+        try:
+            self.logger.info('Worker %s generating HOCR for %s.', self.worker_id, self.cur_tif)
+            return self.ocr_backend.generate_hocr(self)
+        finally:
+            self.large_page = False
+            self.admission_controller.release(admission)
 
     def init_config(self, config):
         self.config = config
@@ -139,74 +308,77 @@ class BNIEncodingWorker(object):
         self.logger = logger
         self.logger.info('Worker %s appears!', self.worker_id)
 
-    def archive_files(self, output_path, extensions):
-        sha1_files_to_check=[]
-        rsyncCall = [
-            'rsync',
-            '-a',
-            '-L',
-            '--relative',
-        ]
-        for cur_extension in extensions:
-            rsyncCall.append('.'.join((self.relative_tmp_filepath_stem, cur_extension)))
-            sha1_files_to_check.append('.'.join((self.file_stem, cur_extension)))
-
-        rsyncCall.append(output_path + '/')
+    def archive_files(self, destinations):
+        """Archive the current image to each (output_path, extensions) destination, reading every file once."""
+        relative_destinations = []
+        for output_path, extensions in destinations:
+            relative_destinations.append((
+                output_path,
+                ['.'.join((self.relative_tmp_filepath_stem, cur_extension)) for cur_extension in extensions]
+            ))
         self.log_worker_stage(19)
 
-        try:
-            rsync_return = subprocess.call(rsyncCall, cwd=self.tmp_path, timeout=float(self.config.get('RSync', 'rsync_timeout')))
-        except Exception as e:
-            self.logger.info('Worker %s failed RSync to archive, Exception : %s.',
-                             self.worker_id,
-                             e)
-            self.log_worker_stage(21)
-            return False
+        if self.resume_status_id >= 20:
+            archived_digests = self.checkpoint.stage_data[20]
+        else:
+            try:
+                archived_digests = self.archiver.archive_fanout(self.tmp_path, relative_destinations, self.archive_timeout)
+            except Exception as e:
+                self.logger.info('Worker %s failed to archive files, Exception : %s.',
+                                 self.worker_id,
+                                 e)
+                self.log_worker_stage(21)
+                return False
+        self.log_worker_stage(20)
+        if self.checkpoint is not None and self.resume_status_id < 20:
+            self.checkpoint.record(
+                20,
+                [
+                    os.path.join(output_path, relative_filepath)
+                    for output_path, relative_filepaths in relative_destinations
+                    for relative_filepath in relative_filepaths
+                ],
+                archived_digests,
+                hash_artifacts=False
+            )
 
-        if rsync_return == 0:
-            self.log_worker_stage(20)
-            return self.generate_sha1(
+        for destination_index, (output_path, extensions) in enumerate(destinations):
+            relative_filepaths = relative_destinations[destination_index][1]
+            cur_digests = archived_digests[destination_index]
+            if not self.generate_sha1(
                 output_path + '/' + self.tree_target_dir,
                 '.'.join((self.file_stem, 'sha1')),
-                sha1_files_to_check
-            )
-        self.log_worker_stage(21)
-        return False
-
-    def generate_sha1(self, path, output_file, filenames):
-        sha1sum_filep = io.open(os.path.join(path,output_file), "w")
-
-        sha1sum_call = [
-            '/usr/bin/sha1sum',
-        ]
+                ['.'.join((self.file_stem, cur_extension)) for cur_extension in extensions],
+                [cur_digests[relative_filepath] for relative_filepath in relative_filepaths]
+            ):
+                return False
+        return True
 
+    def generate_sha1(self, path, output_file, filenames, digests):
         self.log_worker_stage(22)
-        sha1sum_call.extend(filenames)
 
         try:
-            sha1sum_return = subprocess.call(sha1sum_call, stdout=sha1sum_filep, cwd=path, timeout=float(self.config.get('SHA1Sum', 'sha1sum_timeout')))
-        except Exception as e:
+            sha1sum_lines = []
+            for filename, digest in zip(filenames, digests):
+                sha1sum_lines.append(digest + '  ' + filename + '\n')
+            with io.open(os.path.join(path, output_file), 'w') as sha1sum_filep:
+                sha1sum_filep.writelines(sha1sum_lines)
+        except (IOError, OSError) as e:
             self.log_worker_stage(24)
             self.logger.info('Worker %s failed in calculating SHA1sum of files for %s. Exception : %s', self.worker_id, path, e)
             return False
 
-        if sha1sum_return == 0:
-            self.log_worker_stage(23)
-            self.logger.info('Worker %s succeded in calculating SHA1sum of files for %s.', self.worker_id, path)
-            return True
-        self.log_worker_stage(24)
-        self.logger.info('Worker %s failed in calculating SHA1sum of files for %s.', self.worker_id, path)
-        return False
+        self.log_worker_stage(23)
+        self.logger.info('Worker %s succeded in calculating SHA1sum of files for %s.', self.worker_id, path)
+        return True
 
     def generate_ocr(self):
         self.log_worker_stage(16)
 
         with io.open('.'.join((self.tmp_filepath_stem, 'hocr')), "r") as hocr_file_p:
-            hocr_file_string = hocr_file_p.read().replace('\n', '')
-        self.log_worker_stage(17)
-
-        with io.open('.'.join((self.tmp_filepath_stem, 'txt')), 'w') as ocr_file_p:
-            ocr_file_p.write(self.distill_hocr_to_ocr(hocr_file_string))
+            with io.open('.'.join((self.tmp_filepath_stem, 'txt')), 'w') as ocr_file_p:
+                self.log_worker_stage(17)
+                BNIHocrDistiller(ocr_file_p).distill(hocr_file_p)
         self.log_worker_stage(18)
 
         return True
@@ -232,13 +404,6 @@ class BNIEncodingWorker(object):
     def log_encode_success(self):
         self.logger.info('Worker %s encoding surrogate of %s has succeeded.', self.worker_id,self.cur_tif)
 
-    def distill_hocr_to_ocr(self, hocr_string):
-        ocr_string=''
-        soup = BeautifulSoup(hocr_string)
-        for p_item in soup.findAll('p'):
-            ocr_string += ' '.join(p_item.getText().split()) + "\n"
-        return ocr_string
-
     def check_tif_size(self):
         cur_min_size = int(self.config.get('MinimumSizes', 'min_size_tif'))
         cur_tif_size = os.path.getsize(self.cur_tif)
@@ -279,12 +444,18 @@ class BNIEncodingWorker(object):
         self.log_worker_stage(25)
         return True
 
-    def remove_tempfiles(self):
+    def remove_working_files(self):
+        """Remove the source links and the surrogate, keeping any checkpointed outputs for a later attempt."""
         self.unlink_if_exists(self.tmp_tif)
         self.unlink_if_exists(self.tmp_jpg)
         self.unlink_if_exists(self.hocr_surrogate_filepath)
+
+    def remove_tempfiles(self):
+        self.remove_working_files()
         self.unlink_if_exists('.'.join((self.tmp_filepath_stem, 'hocr')))
         self.unlink_if_exists('.'.join((self.tmp_filepath_stem, 'txt')))
+        if self.checkpoint is not None:
+            self.checkpoint.remove()
 
     def unlink_if_exists(self, file_path):
         try:
@@ -296,8 +467,7 @@ class BNIEncodingWorker(object):
         # Get image from queue
         self.cur_tif = self.get_next_queue_item()
         if not self.cur_tif:
-            self.logger.info('Worker %s could not find any more queue items, retiring.', self.worker_id)
-            raise Exception("No queue items left!")
+            return False
 
         self.cur_tif = os.path.join(
             self.tree_base_path,
@@ -328,24 +498,13 @@ class BNIEncodingWorker(object):
         # Set the relative TmpFilePathStem
         self.relative_tmp_filepath_stem = '/'.join((self.tree_target_dir, self.file_stem))
 
-    def log_worker_stage(self, status_id, file_path=''):
-        if status_id is 2:
-            self.db_cur.execute("UPDATE images SET status_id=" + str(status_id) + ", start_datestamp=NOW(), latest_datestamp=NOW() WHERE filepath='" + file_path + "'")
-            self.db.commit()
-        else:
-            tree_filepath = self.tree_target_dir + '/' + self.file_stem + ".tif"
-            self.db_cur.execute("UPDATE images SET status_id=" + str(status_id) + ", latest_datestamp=NOW() WHERE filepath='" + tree_filepath + "'")
-            self.db.commit()
+        self.load_checkpoint()
         return True
 
-    def init_mysql(self):
-        return pymysql.connect(
-            host=self.config.get('MySQL', 'mysql_host'),
-            user=self.config.get('MySQL', 'mysql_user'),
-            passwd=self.config.get('MySQL', 'mysql_pw'),
-            db=self.config.get('MySQL', 'mysql_db'),
-            charset="utf8"
-        )
+    def log_worker_stage(self, status_id):
+        self.cur_status_id = status_id
+        self.status_writer.record(self.cur_image_id, status_id)
+        return True
 
     def init_tmp_path(self):
         self.tmp_file_dir = os.path.join(
@@ -384,9 +543,27 @@ class BNIEncodingWorker(object):
                 raise
 
     def get_next_queue_item(self):
-        self.db_cur.execute("SELECT filepath FROM images where status_id=1 ORDER BY id ASC LIMIT 1")
-        row = self.db_cur.fetchone()
-        if row is None:
+        self.cur_image_id = None
+        if not self.claimed_items:
+            # Every status of the images already worked on, terminal ones included, lands before a new claim.
+            self.status_writer.flush()
+            self.claim_queue_items()
+        if not self.claimed_items:
             return False
-        self.log_worker_stage(2, row[0])
-        return row[0]
+        self.cur_image_id, filepath = self.claimed_items.popleft()
+        self.lease_keeper.begin_attempt(self.cur_image_id)
+        return filepath
+
+    def claim_queue_items(self):
+        """Claim and lease the next batch of queued images for this worker."""
+        self.claimed_items.extend(self.lease_keeper.claim(self.images_per_claim))
+        self.logger.info('Worker %s claimed %s queue item(s).', self.worker_id, len(self.claimed_items))
+
+    def release_claimed_items(self):
+        """Return claimed but unstarted images to the queue when the worker retires."""
+        if not self.claimed_items:
+            return
+        image_ids = [image_id for image_id, filepath in self.claimed_items]
+        self.lease_keeper.release(image_ids)
+        self.logger.info('Worker %s released %s unstarted queue item(s).', self.worker_id, len(image_ids))
+        self.claimed_items.clear()
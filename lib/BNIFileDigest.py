@@ -0,0 +1,26 @@
+"""BNIFileDigest
+
+Buffered SHA1 of a file, shared by the page checkpoints and the OCR cache.
+
+The file is read unbuffered into one reusable buffer of sha1sum_buffer_size bytes, so hashing a large master
+does not allocate a new chunk on every read.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import hashlib
+import io
+
+
+def sha1_file(file_path, buffer_size=1048576):
+    sha1 = hashlib.sha1()
+    read_buffer = bytearray(buffer_size)
+    read_view = memoryview(read_buffer)
+    with io.open(file_path, 'rb', buffering=0) as file_p:
+        while True:
+            bytes_read = file_p.readinto(read_buffer)
+            if not bytes_read:
+                break
+            sha1.update(read_view[:bytes_read])
+    return sha1.hexdigest()
@@ -0,0 +1,54 @@
+"""BNIHocrDistiller
+
+Streaming extraction of plain OCR text from hOCR documents.
+
+Every <p> element becomes one line of whitespace-normalized text, matching what the earlier BeautifulSoup
+based distillation produced, but the document is parsed as it is read so it is never held in memory whole.
+Paragraphs are written in the order they start, so a paragraph nested in another is held back until the
+outermost one closes.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from html.parser import HTMLParser
+
+
+class BNIHocrDistiller(HTMLParser):
+    def __init__(self, ocr_file_p):
+        super(BNIHocrDistiller, self).__init__(convert_charrefs=True)
+        self.ocr_file_p = ocr_file_p
+        self.open_paragraphs = []
+        self.pending_paragraphs = []
+
+    def distill(self, hocr_file_p, chunk_size=65536):
+        for hocr_chunk in iter(lambda: hocr_file_p.read(chunk_size), ''):
+            # Newlines were always stripped before parsing, so words split only by one are joined as before.
+            self.feed(hocr_chunk.replace('\n', ''))
+        self.close()
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'p':
+            paragraph_text = []
+            self.open_paragraphs.append(paragraph_text)
+            self.pending_paragraphs.append(paragraph_text)
+
+    def handle_endtag(self, tag):
+        if tag == 'p' and self.open_paragraphs:
+            self.open_paragraphs.pop()
+            if not self.open_paragraphs:
+                self.write_pending_paragraphs()
+
+    def handle_data(self, data):
+        for paragraph_text in self.open_paragraphs:
+            paragraph_text.append(data)
+
+    def close(self):
+        super(BNIHocrDistiller, self).close()
+        self.open_paragraphs = []
+        self.write_pending_paragraphs()
+
+    def write_pending_paragraphs(self):
+        for paragraph_text in self.pending_paragraphs:
+            self.ocr_file_p.write(' '.join(''.join(paragraph_text).split()) + "\n")
+        self.pending_paragraphs = []
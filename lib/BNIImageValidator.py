@@ -0,0 +1,237 @@
+"""BNIImageValidator
+
+Pre-flight validation of a page's TIF and JPG from their headers, run by the daemon before pages are queued.
+
+Only the structures needed are read, typically a few KB per page: the TIFF header, first IFD and strip or tile
+tables, and the JPEG markers up to the frame header plus the tail holding the EOI marker. The TIF must have
+non-zero dimensions, an accepted bit depth and compression, and strips or tiles that all lie within the file, so
+a truncated master is caught here instead of after a full gm and tesseract run. The JPG must have a frame header
+and an EOI marker, and its dimensions must match the TIF's.
+
+Pages failing validation are queued directly with a failure status and are never claimed. A page whose files
+were modified within the last validate_settle_seconds may still be arriving, so it is deferred to a later pass
+instead.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import io
+import os
+import struct
+import time
+
+STATUS_QUEUED = 1
+STATUS_FAIL_JPG_EXIST = 5
+STATUS_FAIL_HEADER_TIF = 29
+STATUS_FAIL_HEADER_JPG = 30
+STATUS_FAIL_DIMENSIONS = 31
+
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 16: 8, 17: 8, 18: 8}
+TIFF_TYPE_FORMATS = {1: 'B', 3: 'H', 4: 'I', 16: 'Q'}
+TIFF_IMAGE_WIDTH = 256
+TIFF_IMAGE_LENGTH = 257
+TIFF_BITS_PER_SAMPLE = 258
+TIFF_COMPRESSION = 259
+TIFF_STRIP_OFFSETS = 273
+TIFF_SAMPLES_PER_PIXEL = 277
+TIFF_STRIP_BYTE_COUNTS = 279
+TIFF_TILE_OFFSETS = 324
+TIFF_TILE_BYTE_COUNTS = 325
+
+# Every SOFn marker except DHT (C4), JPG (C8) and DAC (CC), which share the range.
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - frozenset((0xC4, 0xC8, 0xCC))
+JPEG_EOI_TAIL_BYTES = 4096
+
+
+class BNIImageHeaderError(Exception):
+    pass
+
+
+class BNIImageValidator(object):
+    def __init__(self, config, logger):
+        self.logger = logger
+        self.relative_location_jpg = config.get('Locations', 'relative_location_jpg')
+        self.settle_seconds = config.getfloat('Validation', 'validate_settle_seconds', fallback=300.0)
+        self.tif_bits_per_sample = self.get_int_list(
+            config.get('Validation', 'tif_bits_per_sample', fallback='1,8,16')
+        )
+        self.tif_compressions = self.get_int_list(
+            config.get('Validation', 'tif_compressions', fallback='1,4,5,7,8,32773,32946')
+        )
+        self.dimension_match = config.get('Validation', 'jpg_dimension_match', fallback='aspect')
+        self.aspect_tolerance = config.getfloat('Validation', 'jpg_aspect_tolerance', fallback=0.01)
+
+    def get_int_list(self, list_string):
+        return frozenset(int(list_item) for list_item in list_string.replace(' ', '').split(',') if list_item)
+
+    def get_jpg_filepath(self, tif_filepath):
+        # As the worker locates the JPG for a TIF.
+        file_stem = os.path.basename(tif_filepath[0:tif_filepath.rindex('.')])
+        return os.path.normpath(
+            os.path.dirname(tif_filepath) + '/' + self.relative_location_jpg + '.'.join((file_stem, 'jpg'))
+        )
+
+    def validate(self, tif_filepath):
+        """Return the status to queue the page with, or None to defer a page that may still be arriving."""
+        jpg_filepath = self.get_jpg_filepath(tif_filepath)
+        status_id, reason = self.check_page(tif_filepath, jpg_filepath)
+        if status_id == STATUS_QUEUED:
+            return status_id
+        if self.is_settling(tif_filepath, jpg_filepath):
+            self.logger.info('Validator deferring %s, still being written : %s', tif_filepath, reason)
+            return None
+        self.logger.warning('Validator rejected %s : %s', tif_filepath, reason)
+        return status_id
+
+    def is_settling(self, *filepaths):
+        for filepath in filepaths:
+            try:
+                if time.time() - os.stat(filepath).st_mtime < self.settle_seconds:
+                    return True
+            except OSError:
+                pass
+        return False
+
+    def check_page(self, tif_filepath, jpg_filepath):
+        """Return (status_id, reason), status_id being STATUS_QUEUED when both files pass."""
+        try:
+            tif_width, tif_height = self.read_tiff_header(tif_filepath)
+        except (BNIImageHeaderError, IOError, OSError, struct.error) as e:
+            return STATUS_FAIL_HEADER_TIF, 'TIF %s' % e
+        if not os.path.isfile(jpg_filepath):
+            return STATUS_FAIL_JPG_EXIST, 'JPG %s does not exist' % jpg_filepath
+        try:
+            jpg_width, jpg_height = self.read_jpeg_header(jpg_filepath)
+        except (BNIImageHeaderError, IOError, OSError, struct.error) as e:
+            return STATUS_FAIL_HEADER_JPG, 'JPG %s' % e
+        if not self.dimensions_match((tif_width, tif_height), (jpg_width, jpg_height)):
+            return STATUS_FAIL_DIMENSIONS, 'TIF is %sx%s but JPG is %sx%s' % (tif_width, tif_height, jpg_width, jpg_height)
+        return STATUS_QUEUED, ''
+
+    def dimensions_match(self, tif_dimensions, jpg_dimensions):
+        if self.dimension_match == 'exact':
+            return tif_dimensions == jpg_dimensions
+        if self.dimension_match == 'aspect':
+            # Access JPGs may be downsampled, so only the shape has to agree.
+            tif_aspect = tif_dimensions[0] / tif_dimensions[1]
+            jpg_aspect = jpg_dimensions[0] / jpg_dimensions[1]
+            return abs(tif_aspect - jpg_aspect) <= tif_aspect * self.aspect_tolerance
+        return True
+
+    def read_tiff_header(self, tif_filepath):
+        """Check the TIF's first IFD and that its image data lies within the file. Returns (width, height)."""
+        with io.open(tif_filepath, 'rb') as tif_file_p:
+            file_size = os.fstat(tif_file_p.fileno()).st_size
+            header = tif_file_p.read(16)
+            if header[0:2] == b'II':
+                byte_order = '<'
+            elif header[0:2] == b'MM':
+                byte_order = '>'
+            else:
+                raise BNIImageHeaderError('has no TIFF byte order mark')
+            version = struct.unpack(byte_order + 'H', header[2:4])[0]
+            if version == 42:
+                ifd_offset = struct.unpack(byte_order + 'I', header[4:8])[0]
+                count_format, entry_size, value_size = 'H', 12, 4
+            elif version == 43:
+                ifd_offset = struct.unpack(byte_order + 'Q', header[8:16])[0]
+                count_format, entry_size, value_size = 'Q', 20, 8
+            else:
+                raise BNIImageHeaderError('has unknown TIFF version %s' % version)
+
+            count_size = struct.calcsize(count_format)
+            tif_file_p.seek(ifd_offset)
+            entry_count = struct.unpack(byte_order + count_format, self.read_exactly(tif_file_p, count_size))[0]
+            ifd_data = self.read_exactly(tif_file_p, entry_count * entry_size)
+            entry_format = byte_order + 'HH' + ('I' if value_size == 4 else 'Q')
+            tags = {}
+            for entry_start in range(0, len(ifd_data), entry_size):
+                tag, value_type, value_count = struct.unpack(
+                    entry_format, ifd_data[entry_start:entry_start + entry_size - value_size]
+                )
+                tags[tag] = (value_type, value_count, ifd_data[entry_start + entry_size - value_size:entry_start + entry_size])
+
+            def get_values(tag, default=None):
+                if tag not in tags:
+                    if default is None:
+                        raise BNIImageHeaderError('is missing TIFF tag %s' % tag)
+                    return default
+                value_type, value_count, value_field = tags[tag]
+                if value_type not in TIFF_TYPE_FORMATS:
+                    raise BNIImageHeaderError('has TIFF tag %s of unexpected type %s' % (tag, value_type))
+                value_bytes = TIFF_TYPE_SIZES[value_type] * value_count
+                if value_bytes > value_size:
+                    value_offset = struct.unpack(byte_order + ('I' if value_size == 4 else 'Q'), value_field)[0]
+                    if value_offset + value_bytes > file_size:
+                        raise BNIImageHeaderError('is truncated within TIFF tag %s' % tag)
+                    tif_file_p.seek(value_offset)
+                    value_field = self.read_exactly(tif_file_p, value_bytes)
+                return struct.unpack(
+                    byte_order + TIFF_TYPE_FORMATS[value_type] * value_count, value_field[0:value_bytes]
+                )
+
+            width = get_values(TIFF_IMAGE_WIDTH)[0]
+            height = get_values(TIFF_IMAGE_LENGTH)[0]
+            if width == 0 or height == 0:
+                raise BNIImageHeaderError('has empty dimensions %sx%s' % (width, height))
+            bits_per_sample = get_values(TIFF_BITS_PER_SAMPLE, (1,))
+            if not bits_per_sample or any(sample_bits not in self.tif_bits_per_sample for sample_bits in bits_per_sample):
+                raise BNIImageHeaderError('has unaccepted bit depth %s' % (bits_per_sample,))
+            compression = get_values(TIFF_COMPRESSION, (1,))[0]
+            if compression not in self.tif_compressions:
+                raise BNIImageHeaderError('has unaccepted compression %s' % compression)
+
+            if TIFF_TILE_OFFSETS in tags:
+                data_offsets = get_values(TIFF_TILE_OFFSETS)
+                data_byte_counts = get_values(TIFF_TILE_BYTE_COUNTS)
+            else:
+                data_offsets = get_values(TIFF_STRIP_OFFSETS)
+                data_byte_counts = get_values(TIFF_STRIP_BYTE_COUNTS)
+                if compression == 1:
+                    samples_per_pixel = get_values(TIFF_SAMPLES_PER_PIXEL, (1,))[0]
+                    row_bytes = (width * samples_per_pixel * bits_per_sample[0] + 7) // 8
+                    if sum(data_byte_counts) < row_bytes * height:
+                        raise BNIImageHeaderError('has %s bytes of strips for %s expected' % (sum(data_byte_counts), row_bytes * height))
+        if not data_offsets or len(data_offsets) != len(data_byte_counts):
+            raise BNIImageHeaderError('has inconsistent strip or tile tables')
+        data_end = max(data_offset + data_byte_count for data_offset, data_byte_count in zip(data_offsets, data_byte_counts))
+        if data_end > file_size:
+            raise BNIImageHeaderError('is truncated, its image data ends at %s of %s bytes' % (data_end, file_size))
+        return width, height
+
+    def read_jpeg_header(self, jpg_filepath):
+        """Check the JPG has a frame header and an EOI marker. Returns (width, height)."""
+        with io.open(jpg_filepath, 'rb') as jpg_file_p:
+            file_size = os.fstat(jpg_file_p.fileno()).st_size
+            if jpg_file_p.read(2) != b'\xff\xd8':
+                raise BNIImageHeaderError('has no SOI marker')
+            while True:
+                marker = self.read_exactly(jpg_file_p, 2)
+                if marker[0] != 0xFF:
+                    raise BNIImageHeaderError('has a corrupt marker at byte %s' % (jpg_file_p.tell() - 2))
+                marker_type = marker[1]
+                while marker_type == 0xFF:
+                    # Fill bytes may pad a marker.
+                    marker_type = self.read_exactly(jpg_file_p, 1)[0]
+                if marker_type == 0x01 or 0xD0 <= marker_type <= 0xD7:
+                    continue
+                if marker_type in (0xD9, 0xDA):
+                    raise BNIImageHeaderError('has no frame header')
+                segment_length = struct.unpack('>H', self.read_exactly(jpg_file_p, 2))[0]
+                if marker_type in JPEG_SOF_MARKERS:
+                    height, width = struct.unpack('>xHH', self.read_exactly(jpg_file_p, 5))
+                    break
+                jpg_file_p.seek(segment_length - 2, io.SEEK_CUR)
+            if width == 0 or height == 0:
+                raise BNIImageHeaderError('has empty dimensions %sx%s' % (width, height))
+            jpg_file_p.seek(max(0, file_size - JPEG_EOI_TAIL_BYTES))
+            if jpg_file_p.read().rfind(b'\xff\xd9') == -1:
+                raise BNIImageHeaderError('is truncated, it has no EOI marker')
+        return width, height
+
+    def read_exactly(self, file_p, size):
+        file_data = file_p.read(size)
+        if len(file_data) != size:
+            raise BNIImageHeaderError('is truncated at byte %s' % (file_p.tell()))
+        return file_data
@@ -0,0 +1,171 @@
+"""BNIInotifyIntake
+
+Event driven intake of new TIFs from the input tree, using Linux inotify.
+
+Every directory below the input path is watched, and new directories are watched as they arrive. A TIF
+becomes a candidate once it is closed after writing or moved into place, and is only handed back for queueing
+once its size has been stable for the settle time and its matching JPG exists. The daemon keeps running a
+periodic reconciling scan, which covers anything missed (queue overflows, exhausted watch limits, files that
+existed before the watch was placed). Once the watch limit has been hit, part of the tree is only covered by
+those scans, so watches_exhausted tells the daemon to reconcile as often as scan intake would.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class BNIInotifyIntake(object):
+    def __init__(self, config, logger, input_path):
+        self.logger = logger
+        self.input_path = input_path
+        self.relative_location_jpg = config.get('Locations', 'relative_location_jpg')
+        self.settle_seconds = config.getfloat('Intake', 'settle_seconds', fallback=5.0)
+        self.inotify_fd = None
+        self.libc = None
+        self.watched_dirs = {}
+        self.pending_files = {}
+        self.needs_reconcile = False
+        self.watches_exhausted = False
+
+    def start(self):
+        """Begin watching the input tree. Returns False if inotify is unavailable on this system."""
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            inotify_fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            self.logger.warning('Intake cannot use inotify, falling back to scanning. Exception : %s', e)
+            return False
+        if inotify_fd < 0:
+            self.logger.warning('Intake cannot use inotify, falling back to scanning : %s', os.strerror(ctypes.get_errno()))
+            return False
+        self.inotify_fd = inotify_fd
+        self.watch_tree(self.input_path, False)
+        self.logger.info('Intake watching %s directories below %s.', len(self.watched_dirs), self.input_path)
+        return True
+
+    def stop(self):
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+            self.watched_dirs = {}
+
+    def watch_tree(self, dir_path, add_existing_files):
+        """Watch dir_path and every directory below it.
+
+        Directories that appear after startup may already hold files written before their watch existed, so
+        add_existing_files makes those TIFs candidates too.
+        """
+        dir_paths = [dir_path]
+        while dir_paths:
+            cur_dir_path = dir_paths.pop()
+            watch_descriptor = self.libc.inotify_add_watch(self.inotify_fd, os.fsencode(cur_dir_path), WATCH_MASK)
+            if watch_descriptor < 0:
+                watch_errno = ctypes.get_errno()
+                if watch_errno == errno.ENOSPC:
+                    self.logger.warning('Intake ran out of inotify watches at %s, relying on scans for the rest.', cur_dir_path)
+                    self.needs_reconcile = True
+                    self.watches_exhausted = True
+                    return
+                continue
+            self.watched_dirs[watch_descriptor] = cur_dir_path
+            try:
+                dir_entries = list(os.scandir(cur_dir_path))
+            except OSError:
+                continue
+            for dir_entry in dir_entries:
+                if dir_entry.is_dir(follow_symlinks=False):
+                    dir_paths.append(dir_entry.path)
+                elif add_existing_files and dir_entry.name.endswith('.tif'):
+                    self.add_candidate(dir_entry.path)
+
+    def poll(self, timeout):
+        """Wait up to timeout seconds for events, then return the TIFs that are ready to be queued."""
+        readable, writable, exceptional = select.select([self.inotify_fd], [], [], timeout)
+        if readable:
+            self.read_events()
+        return self.get_ready_files()
+
+    def read_events(self):
+        while True:
+            try:
+                event_buffer = os.read(self.inotify_fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            buffer_offset = 0
+            while buffer_offset < len(event_buffer):
+                watch_descriptor, event_mask, cookie, name_length = EVENT_HEADER.unpack_from(event_buffer, buffer_offset)
+                buffer_offset += EVENT_HEADER.size
+                event_name = os.fsdecode(event_buffer[buffer_offset:buffer_offset + name_length].rstrip(b'\0'))
+                buffer_offset += name_length
+                self.handle_event(watch_descriptor, event_mask, event_name)
+
+    def handle_event(self, watch_descriptor, event_mask, event_name):
+        if event_mask & IN_Q_OVERFLOW:
+            self.logger.warning('Intake inotify queue overflowed, requesting a reconciling scan.')
+            self.needs_reconcile = True
+            return
+        if event_mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+            self.watched_dirs.pop(watch_descriptor, None)
+            return
+        dir_path = self.watched_dirs.get(watch_descriptor)
+        if dir_path is None or not event_name:
+            return
+        event_path = os.path.join(dir_path, event_name)
+        if event_mask & IN_ISDIR:
+            if event_mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(event_path, True)
+        elif event_mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and event_name.endswith('.tif'):
+            self.add_candidate(event_path)
+
+    def add_candidate(self, tif_filepath):
+        try:
+            tif_size = os.path.getsize(tif_filepath)
+        except OSError:
+            return
+        self.pending_files[tif_filepath] = (tif_size, time.monotonic())
+
+    def get_ready_files(self):
+        ready_files = []
+        for tif_filepath, (recorded_size, recorded_time) in list(self.pending_files.items()):
+            try:
+                tif_size = os.path.getsize(tif_filepath)
+            except OSError:
+                del self.pending_files[tif_filepath]
+                continue
+            if tif_size != recorded_size:
+                self.pending_files[tif_filepath] = (tif_size, time.monotonic())
+            elif time.monotonic() - recorded_time >= self.settle_seconds and os.path.isfile(self.get_jpg_path(tif_filepath)):
+                del self.pending_files[tif_filepath]
+                ready_files.append(tif_filepath)
+        return ready_files
+
+    def get_jpg_path(self, tif_filepath):
+        file_stem = os.path.basename(tif_filepath[0:tif_filepath.rindex('.')])
+        return os.path.normpath(
+            os.path.dirname(tif_filepath) + '/' +
+            self.relative_location_jpg +
+            '.'.join((file_stem, 'jpg'))
+        )
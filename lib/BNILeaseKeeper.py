@@ -0,0 +1,249 @@
+"""BNILeaseKeeper
+
+Lease-based ownership of claimed images, so several processing hosts can share one queue.
+
+Every claimed image carries its owner (the daemon run's config_id and the worker id) and a lease expiry. While
+a worker is alive, a heartbeat thread keeps extending the leases of everything it holds. Reaching a terminal
+status clears the lease. When a worker or a whole host dies, its leases run out and reap_expired_leases(),
+called periodically by every daemon, returns those images to the queue.
+
+Claims are scheduled by reel, highest priority first, with each worker kept on one reel until it is drained, so
+a reel's pages are processed and archived as a contiguous run rather than interleaved across every worker.
+
+Each time a worker starts work on an image counts as an attempt at it; images claimed alongside it but never
+started are not charged. An image taken back from a dead or failing worker after max_claim_attempts attempts
+is failed with FAILATTEMPTS instead of being queued again.
+
+A respawned worker reuses its predecessor's worker id, so on start it immediately re-queues anything still
+leased to its own identity rather than waiting for the leases to expire.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import threading
+import uuid
+
+
+STATUS_FAIL_ATTEMPTS = 32
+
+
+def return_leased_images(db_cur, lease_condition, lease_params, max_attempts):
+    """Take back the leased images matching lease_condition. Returns (re-queued, failed) counts.
+
+    Images that have already been started max_attempts times are given FAILATTEMPTS rather than another try,
+    so a page that takes its worker down every time cannot cycle through the queue forever.
+    """
+    failed_rows = db_cur.execute(
+        "UPDATE images SET status_id=%s, claim_token=NULL, latest_datestamp=NOW(), "
+        "lease_config_id=NULL, lease_worker_id=NULL, lease_expires=NULL "
+        "WHERE " + lease_condition + " AND attempts >= %s",
+        [STATUS_FAIL_ATTEMPTS] + list(lease_params) + [max_attempts]
+    )
+    requeued_rows = db_cur.execute(
+        "UPDATE images SET status_id=1, claim_token=NULL, start_datestamp=NULL, latest_datestamp=NOW(), "
+        "lease_config_id=NULL, lease_worker_id=NULL, lease_expires=NULL "
+        "WHERE " + lease_condition,
+        lease_params
+    )
+    return requeued_rows, failed_rows
+
+
+def reap_expired_leases(database, logger, max_attempts=3):
+    """Return images whose lease has expired to the queue. Returns the number re-queued."""
+    def reap(db):
+        db_cur = db.cursor()
+        reaped_rows = return_leased_images(db_cur, "lease_expires < NOW()", (), max_attempts)
+        db_cur.close()
+        return reaped_rows
+
+    reaped_rows, failed_rows = database.run_with_retry(reap, 'lease reap')
+    if reaped_rows > 0:
+        logger.warning('Daemon re-queued %s image(s) whose worker lease expired.', reaped_rows)
+    if failed_rows > 0:
+        logger.error('Daemon failed %s image(s) whose worker lease expired on their last attempt.', failed_rows)
+    return reaped_rows
+
+
+class BNILeaseKeeper(object):
+    def __init__(self, config, logger, database, config_id, worker_id):
+        self.logger = logger
+        self.database = database
+        self.config_id = config_id
+        self.worker_id = worker_id
+        self.lease_seconds = config.getint('Threading', 'lease_seconds', fallback=300)
+        self.heartbeat_interval = config.getfloat(
+            'Threading',
+            'lease_heartbeat_interval',
+            fallback=self.lease_seconds / 5.0
+        )
+        self.max_attempts = config.getint('Threading', 'max_claim_attempts', fallback=3)
+        self.directory_hash = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.recover_predecessor_leases()
+        self.stopped.clear()
+        self.thread = threading.Thread(name='leaseheartbeat', target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopped.wait(self.heartbeat_interval):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                self.logger.error('Worker %s failed to renew its leases, will retry. Exception : %s', self.worker_id, e)
+
+    def heartbeat(self):
+        def renew(db):
+            db_cur = db.cursor()
+            db_cur.execute(
+                "UPDATE images SET lease_expires = NOW() + INTERVAL %s SECOND "
+                "WHERE lease_config_id=%s AND lease_worker_id=%s AND lease_expires IS NOT NULL",
+                (self.lease_seconds, self.config_id, self.worker_id)
+            )
+            db_cur.close()
+
+        self.database.run_with_retry(renew, 'lease heartbeat')
+
+    def claim(self, images_per_claim):
+        """Atomically claim and lease the next batch of queued images. Returns (id, filepath) rows.
+
+        The UPDATE both selects and marks the rows, so two workers can never claim the same image. The rows
+        are tagged with a token unique to this claim, which is then used to read back what was won. Retrying
+        after a lost connection reuses the token, so images claimed by an attempt whose commit did land are
+        still read back.
+
+        Claims never span reels. A worker keeps claiming from its current reel, in page order, until that reel
+        is drained or a higher priority reel is queued. It then moves to the oldest queued reel of the highest
+        priority that no other worker holds leases in, or shares one if every such reel is already taken.
+        """
+        claim_token = uuid.uuid4().hex
+
+        def claim(db):
+            db_cur = db.cursor()
+            for claim_attempt in range(3):
+                db_cur.execute("SELECT MAX(priority) FROM images WHERE status_id=1")
+                top_priority = db_cur.fetchone()[0]
+                if top_priority is None:
+                    break
+                if self.directory_hash is not None and self.claim_directory(
+                        db_cur, claim_token, self.directory_hash, top_priority, images_per_claim):
+                    break
+                directory_hash = self.select_directory(db_cur, top_priority)
+                if directory_hash is not None and self.claim_directory(
+                        db_cur, claim_token, directory_hash, top_priority, images_per_claim):
+                    self.directory_hash = directory_hash
+                    break
+            db_cur.execute(
+                "SELECT id, filepath FROM images WHERE claim_token=%s AND status_id=2 ORDER BY id ASC",
+                (claim_token,)
+            )
+            claimed_rows = db_cur.fetchall()
+            db_cur.close()
+            return claimed_rows
+
+        return list(self.database.run_with_retry(claim, 'claim'))
+
+    def claim_directory(self, db_cur, claim_token, directory_hash, priority, images_per_claim):
+        return db_cur.execute(
+            "UPDATE images SET status_id=2, claim_token=%s, start_datestamp=NOW(), latest_datestamp=NOW(), "
+            "lease_config_id=%s, lease_worker_id=%s, lease_expires = NOW() + INTERVAL %s SECOND "
+            "WHERE status_id=1 AND directory_hash=%s AND priority=%s ORDER BY id ASC LIMIT %s",
+            (claim_token, self.config_id, self.worker_id, self.lease_seconds, directory_hash, priority,
+             images_per_claim)
+        ) > 0
+
+    def select_directory(self, db_cur, priority):
+        """Return the reel to claim from next, preferring one no worker holds leases in."""
+        db_cur.execute(
+            "SELECT queued.directory_hash FROM images AS queued "
+            "WHERE queued.status_id=1 AND queued.priority=%s AND NOT EXISTS ("
+            "SELECT 1 FROM images AS leased WHERE leased.directory_hash = queued.directory_hash "
+            "AND leased.lease_expires IS NOT NULL) "
+            "ORDER BY queued.id ASC LIMIT 1",
+            (priority,)
+        )
+        directory_row = db_cur.fetchone()
+        if directory_row is None:
+            db_cur.execute(
+                "SELECT directory_hash FROM images WHERE status_id=1 AND priority=%s ORDER BY id ASC LIMIT 1",
+                (priority,)
+            )
+            directory_row = db_cur.fetchone()
+        return bytes(directory_row[0]) if directory_row is not None else None
+
+    def begin_attempt(self, image_id):
+        """Count an attempt at a claimed image, before the worker starts on it."""
+        def begin_attempt(db):
+            db_cur = db.cursor()
+            db_cur.execute(
+                "UPDATE images SET attempts = attempts + 1 "
+                "WHERE id=%s AND lease_config_id=%s AND lease_worker_id=%s AND lease_expires IS NOT NULL",
+                (image_id, self.config_id, self.worker_id)
+            )
+            db_cur.close()
+
+        self.database.run_with_retry(begin_attempt, 'begin attempt')
+
+    def release(self, image_ids):
+        """Return claimed but unstarted images to the queue."""
+        def release(db):
+            db_cur = db.cursor()
+            db_cur.execute(
+                "UPDATE images SET status_id=1, claim_token=NULL, start_datestamp=NULL, latest_datestamp=NOW(), "
+                "lease_config_id=NULL, lease_worker_id=NULL, lease_expires=NULL "
+                "WHERE status_id=2 AND lease_config_id=%s AND lease_worker_id=%s AND id IN (" +
+                ','.join(['%s'] * len(image_ids)) + ")",
+                [self.config_id, self.worker_id] + list(image_ids)
+            )
+            db_cur.close()
+
+        self.database.run_with_retry(release, 'release')
+
+    def abandon(self, image_id):
+        """Take back an image this worker failed on. Returns True if it was re-queued, False if it was failed."""
+        def abandon(db):
+            db_cur = db.cursor()
+            abandoned_rows = return_leased_images(
+                db_cur,
+                "id=%s AND lease_config_id=%s AND lease_worker_id=%s AND lease_expires IS NOT NULL",
+                (image_id, self.config_id, self.worker_id),
+                self.max_attempts
+            )
+            db_cur.close()
+            return abandoned_rows
+
+        requeued_rows, failed_rows = self.database.run_with_retry(abandon, 'abandon')
+        return failed_rows == 0
+
+    def recover_predecessor_leases(self):
+        def recover(db):
+            db_cur = db.cursor()
+            recovered_rows = return_leased_images(
+                db_cur,
+                "lease_config_id=%s AND lease_worker_id=%s AND lease_expires IS NOT NULL",
+                (self.config_id, self.worker_id),
+                self.max_attempts
+            )
+            db_cur.close()
+            return recovered_rows
+
+        recovered_rows, failed_rows = self.database.run_with_retry(recover, 'lease recovery')
+        if recovered_rows > 0:
+            self.logger.warning(
+                'Worker %s re-queued %s image(s) left leased by its previous process.', self.worker_id, recovered_rows
+            )
+        if failed_rows > 0:
+            self.logger.error(
+                'Worker %s failed %s image(s) left leased by its previous process on their last attempt.',
+                self.worker_id, failed_rows
+            )
@@ -0,0 +1,172 @@
+"""BNIMetricsServer
+
+Local HTTP endpoint exposing live processing metrics in the Prometheus text format.
+
+Workers run in separate processes (and possibly on other hosts), so the metrics are read back from the shared
+database rather than collected in memory: queue depth, pages completed over the metrics window, and per-stage
+duration quantiles from the stage_timings table. Results are cached briefly so scrapes stay cheap. When the OCR
+cache is enabled, its hit, miss and eviction counts and size are read from the host's cache index.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import math
+import threading
+import time
+
+
+class BNIMetricsHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class BNIMetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        try:
+            metrics_body = self.server.metrics.get_metrics_text().encode('utf-8')
+        except Exception as e:
+            self.server.metrics.logger.error('Metrics collection failed. Exception : %s', e)
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(metrics_body)))
+        self.end_headers()
+        self.wfile.write(metrics_body)
+
+    def log_message(self, format, *args):
+        self.server.metrics.logger.debug('Metrics request : ' + format, *args)
+
+
+class BNIMetricsServer(object):
+    QUANTILES = (0.5, 0.95)
+
+    def __init__(self, config, logger, database, ocr_cache=None, admission_controller=None):
+        self.logger = logger
+        self.database = database
+        self.ocr_cache = ocr_cache
+        self.admission_controller = admission_controller
+        self.bind_address = config.get('Metrics', 'metrics_bind', fallback='127.0.0.1')
+        self.port = config.getint('Metrics', 'metrics_port', fallback=0)
+        self.window_seconds = config.getint('Metrics', 'metrics_window_seconds', fallback=3600)
+        self.cache_seconds = config.getfloat('Metrics', 'metrics_cache_seconds', fallback=10.0)
+        self.cache_lock = threading.Lock()
+        self.cached_text = None
+        self.cached_time = 0.0
+        self.httpd = None
+
+    def start(self):
+        self.httpd = BNIMetricsHTTPServer((self.bind_address, self.port), BNIMetricsRequestHandler)
+        self.httpd.metrics = self
+        metrics_thread = threading.Thread(name='metricsserver', target=self.httpd.serve_forever)
+        metrics_thread.daemon = True
+        metrics_thread.start()
+        self.logger.info('Metrics available at http://%s:%s/metrics', self.bind_address, self.port)
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def get_metrics_text(self):
+        with self.cache_lock:
+            if self.cached_text is None or time.monotonic() - self.cached_time > self.cache_seconds:
+                self.cached_text = self.collect_metrics()
+                self.cached_time = time.monotonic()
+            return self.cached_text
+
+    def collect_metrics(self):
+        with self.database.connection() as db:
+            db_cur = db.cursor()
+            db_cur.execute("SELECT COUNT(1) FROM images WHERE status_id=1")
+            queue_depth = db_cur.fetchone()[0]
+            db_cur.execute(
+                "SELECT COUNT(1) FROM images WHERE status_id=26 AND latest_datestamp > NOW() - INTERVAL %s SECOND",
+                (self.window_seconds,)
+            )
+            pages_completed = db_cur.fetchone()[0]
+            db_cur.execute(
+                "SELECT status.status_string, stage_timings.duration_ms FROM stage_timings "
+                "JOIN status ON status.status_id = stage_timings.status_id "
+                "WHERE stage_timings.recorded_datestamp > NOW() - INTERVAL %s SECOND "
+                "ORDER BY status.status_id, stage_timings.duration_ms",
+                (self.window_seconds,)
+            )
+            stage_durations = {}
+            stage_order = []
+            for status_string, duration_ms in db_cur.fetchall():
+                if status_string not in stage_durations:
+                    stage_durations[status_string] = []
+                    stage_order.append(status_string)
+                stage_durations[status_string].append(duration_ms)
+            db_cur.close()
+
+        metrics_lines = [
+            '# HELP bni_queue_depth Images queued and not yet claimed.',
+            '# TYPE bni_queue_depth gauge',
+            'bni_queue_depth %d' % queue_depth,
+            '# HELP bni_pages_per_hour Pages completed over the metrics window, scaled to one hour.',
+            '# TYPE bni_pages_per_hour gauge',
+            'bni_pages_per_hour %.2f' % (pages_completed * 3600.0 / self.window_seconds),
+            '# HELP bni_stage_duration_milliseconds Duration of processing stages, by the status they ended in.',
+            '# TYPE bni_stage_duration_milliseconds summary',
+        ]
+        for status_string in stage_order:
+            durations = stage_durations[status_string]
+            for quantile in self.QUANTILES:
+                metrics_lines.append('bni_stage_duration_milliseconds{stage="%s",quantile="%s"} %d' % (
+                    status_string, quantile, self.get_quantile(durations, quantile)
+                ))
+            metrics_lines.append('bni_stage_duration_milliseconds_sum{stage="%s"} %d' % (status_string, sum(durations)))
+            metrics_lines.append('bni_stage_duration_milliseconds_count{stage="%s"} %d' % (status_string, len(durations)))
+        if self.ocr_cache is not None and self.ocr_cache.enabled:
+            metrics_lines.extend(self.collect_ocr_cache_metrics())
+        if self.admission_controller is not None:
+            metrics_lines.extend(self.collect_admission_metrics())
+        return '\n'.join(metrics_lines) + '\n'
+
+    def collect_ocr_cache_metrics(self):
+        cache_stats = self.ocr_cache.get_stats()
+        return [
+            '# HELP bni_ocr_cache_lookups_total OCR cache lookups, by result.',
+            '# TYPE bni_ocr_cache_lookups_total counter',
+            'bni_ocr_cache_lookups_total{result="hit"} %d' % cache_stats.get('hits', 0),
+            'bni_ocr_cache_lookups_total{result="miss"} %d' % cache_stats.get('misses', 0),
+            '# HELP bni_ocr_cache_evictions_total OCR cache entries evicted to stay within the size limit.',
+            '# TYPE bni_ocr_cache_evictions_total counter',
+            'bni_ocr_cache_evictions_total %d' % cache_stats.get('evictions', 0),
+            '# HELP bni_ocr_cache_entries OCR results held in the cache.',
+            '# TYPE bni_ocr_cache_entries gauge',
+            'bni_ocr_cache_entries %d' % cache_stats['entries'],
+            '# HELP bni_ocr_cache_bytes Size of the OCR results held in the cache.',
+            '# TYPE bni_ocr_cache_bytes gauge',
+            'bni_ocr_cache_bytes %d' % cache_stats['bytes'],
+        ]
+
+    def collect_admission_metrics(self):
+        admission_stats = self.admission_controller.get_stats()
+        return [
+            '# HELP bni_admitted_pages Pages admitted to hOCR generation, by lane.',
+            '# TYPE bni_admitted_pages gauge',
+            'bni_admitted_pages{lane="normal"} %d' % (admission_stats['pages'] - admission_stats['large_pages']),
+            'bni_admitted_pages{lane="large"} %d' % admission_stats['large_pages'],
+            '# HELP bni_admission_reserved_megabytes Memory and scratch space reserved by admitted pages.',
+            '# TYPE bni_admission_reserved_megabytes gauge',
+            'bni_admission_reserved_megabytes{resource="memory"} %d' % admission_stats['memory_mb'],
+            'bni_admission_reserved_megabytes{resource="scratch"} %d' % admission_stats['scratch_mb'],
+            '# HELP bni_admission_budget_megabytes Memory and scratch space budgets for admitted pages.',
+            '# TYPE bni_admission_budget_megabytes gauge',
+            'bni_admission_budget_megabytes{resource="memory"} %d' % self.admission_controller.memory_budget_mb,
+            'bni_admission_budget_megabytes{resource="scratch"} %d' % self.admission_controller.scratch_budget_mb,
+        ]
+
+    def get_quantile(self, sorted_values, quantile):
+        # Nearest-rank quantile of an already sorted list.
+        rank = max(1, int(math.ceil(quantile * len(sorted_values))))
+        return sorted_values[rank - 1]
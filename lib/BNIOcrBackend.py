@@ -0,0 +1,367 @@
+"""BNIOcrBackend
+
+OCR backends used by BNIEncodingWorker to turn a TIF into an hOCR file.
+
+A backend is selected with the 'ocr_backend' option of the [OCR] config section:
+
+- subprocess : Run GraphicsMagick to generate a bilevel surrogate, then run the tesseract binary on it.
+- tesserocr : Preprocess the TIF with Pillow and recognize it with a Tesseract engine that stays initialized
+              for the life of the worker, avoiding two forks and a traineddata reload on every page.
+
+Backends report their progress through the worker's status ids 9 to 15, exactly as the subprocess pipeline
+always has.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import abc
+import io
+import os
+import re
+import subprocess
+import threading
+
+try:
+    import tesserocr
+    from PIL import Image
+except ImportError:
+    tesserocr = None
+    Image = None
+
+
+def init_ocr_backend(config, logger):
+    backend_name = config.get('OCR', 'ocr_backend', fallback='subprocess')
+    if backend_name not in OCR_BACKENDS:
+        raise ValueError('Unknown OCR backend ' + backend_name)
+    return OCR_BACKENDS[backend_name](config, logger)
+
+
+class BNIOcrBackend(abc.ABC):
+    def __init__(self, config, logger):
+        self.config = config
+        self.logger = logger
+
+    @abc.abstractmethod
+    def generate_hocr(self, worker):
+        """Write the hOCR of worker.tmp_tif to worker.tmp_filepath_stem + '.hocr', logging stages 9 to 15."""
+
+    def get_surrogate_options(self):
+        surrogate_options = self.config.get('HOCR', 'gm_surrogate_convert_options')
+        if surrogate_options == '':
+            return []
+        return re.split("[ ,]+", surrogate_options)
+
+
+class BNISubprocessOcrBackend(BNIOcrBackend):
+    def __init__(self, config, logger):
+        super(BNISubprocessOcrBackend, self).__init__(config, logger)
+        self.surrogate_transport = self.config.get('HOCR', 'surrogate_transport', fallback='file')
+        self.large_page_options = re.split(
+            "[ ,]+",
+            self.config.get('Admission', 'gm_large_page_options', fallback='-limit memory 1024MB -limit map 2048MB')
+        )
+
+    def generate_hocr(self, worker):
+        if self.surrogate_transport == 'pipe':
+            return self.generate_hocr_piped(worker)
+        if self.surrogate_transport == 'memfd':
+            # An anonymous in-memory file both processes can open by path, so the surrogate never touches disk.
+            surrogate_fd = os.memfd_create(worker.file_stem + '-grayscale.tif')
+            try:
+                return self.generate_hocr_from_surrogate(
+                    worker,
+                    '/dev/fd/' + str(surrogate_fd),
+                    'tif:/dev/fd/' + str(surrogate_fd),
+                    (surrogate_fd,)
+                )
+            finally:
+                os.close(surrogate_fd)
+        worker.hocr_surrogate_filepath = os.path.join(
+            worker.tmp_root,
+            worker.tree_target_dir,
+            worker.file_stem + '-grayscale.tif'
+        )
+        return self.generate_hocr_from_surrogate(worker, worker.hocr_surrogate_filepath, worker.hocr_surrogate_filepath)
+
+    def generate_hocr_from_surrogate(self, worker, surrogate_filepath, gm_output, pass_fds=()):
+        worker.log_worker_stage(9)
+        gm_call = self.get_gm_surrogate_call(worker, gm_output)
+
+        try:
+            gm_return = subprocess.call(
+                gm_call,
+                pass_fds=pass_fds,
+                env=self.get_gm_environment(worker),
+                timeout=float(self.config.get('GraphicsMagick', 'gm_timeout'))
+            )
+        except Exception as e:
+            self.logger.info('Worker %s failed encoding HOCR surrogate to tesseract input file %s. Exception : %s',
+                             worker.worker_id,
+                             surrogate_filepath,
+                             e)
+            worker.log_worker_stage(11)
+            return False
+
+        if gm_return == 0:
+            worker.log_encode_success()
+            self.logger.info('Worker %s succeeded in encoding HOCR surrogate to tesseract input file %s.',
+                             worker.worker_id,
+                             surrogate_filepath)
+            worker.log_worker_stage(10)
+        else:
+            self.logger.info('Worker %s failed encoding HOCR surrogate to tesseract input file %s.',
+                             worker.worker_id,
+                             surrogate_filepath)
+            worker.log_worker_stage(11)
+            return False
+
+        worker.log_worker_stage(12)
+        tesseract_call = self.get_tesseract_call(worker, surrogate_filepath)
+
+        worker.log_encode_begin()
+
+        try:
+            tesseract_return = subprocess.call(tesseract_call, pass_fds=pass_fds, timeout=float(self.config.get('Tesseract', 'tesseract_timeout')))
+        except Exception as e:
+            worker.log_tesseract_fail(e)
+            worker.log_worker_stage(13)
+            return False
+
+        if tesseract_return == 0:
+            worker.log_worker_stage(15)
+            return True
+        worker.log_encode_fail()
+        worker.log_worker_stage(14)
+        return False
+
+    def generate_hocr_piped(self, worker):
+        """Stream the surrogate from GraphicsMagick's stdout straight into Tesseract's stdin."""
+        worker.log_worker_stage(9)
+        gm_call = self.get_gm_surrogate_call(worker, 'tif:-')
+        tesseract_call = self.get_tesseract_call(worker, 'stdin')
+        worker.log_encode_begin()
+
+        try:
+            gm_process = subprocess.Popen(gm_call, stdout=subprocess.PIPE, env=self.get_gm_environment(worker))
+        except Exception as e:
+            self.logger.info('Worker %s failed piping HOCR surrogate to tesseract. Exception : %s', worker.worker_id, e)
+            worker.log_worker_stage(11)
+            return False
+        try:
+            tesseract_process = subprocess.Popen(tesseract_call, stdin=gm_process.stdout)
+        except Exception as e:
+            self.kill_processes(gm_process)
+            worker.log_tesseract_fail(e)
+            worker.log_worker_stage(14)
+            return False
+        # Tesseract now holds the only read end, so GraphicsMagick sees a broken pipe if it dies.
+        gm_process.stdout.close()
+
+        try:
+            gm_return = gm_process.wait(timeout=float(self.config.get('GraphicsMagick', 'gm_timeout')))
+        except subprocess.TimeoutExpired as e:
+            self.kill_processes(gm_process, tesseract_process)
+            self.logger.info('Worker %s failed piping HOCR surrogate to tesseract. Exception : %s', worker.worker_id, e)
+            worker.log_worker_stage(11)
+            return False
+
+        if gm_return != 0:
+            self.kill_processes(tesseract_process)
+            self.logger.info('Worker %s failed piping HOCR surrogate to tesseract.', worker.worker_id)
+            worker.log_worker_stage(11)
+            return False
+        worker.log_encode_success()
+        worker.log_worker_stage(10)
+        worker.log_worker_stage(12)
+
+        try:
+            tesseract_return = tesseract_process.wait(timeout=float(self.config.get('Tesseract', 'tesseract_timeout')))
+        except subprocess.TimeoutExpired as e:
+            self.kill_processes(tesseract_process)
+            worker.log_tesseract_fail(e)
+            worker.log_worker_stage(13)
+            return False
+
+        if tesseract_return == 0:
+            worker.log_worker_stage(15)
+            return True
+        worker.log_encode_fail()
+        worker.log_worker_stage(14)
+        return False
+
+    def get_gm_surrogate_call(self, worker, gm_output):
+        gm_call = [
+            self.config.get('GraphicsMagick', 'gm_bin_path'),
+            "convert",
+        ]
+        if worker.large_page:
+            gm_call.extend(self.large_page_options)
+        gm_call.append(worker.tmp_tif)
+        worker.append_additional_encode_options(gm_call, 'gm_surrogate_convert_options', 'GraphicsMagick')
+        gm_call.append(gm_output)
+        return gm_call
+
+    def get_gm_environment(self, worker):
+        if not worker.large_page:
+            return None
+        # Large pages run under memory limits, so GraphicsMagick's pixel cache spills into the scratch space
+        # reserved for them instead of the system temporary directory.
+        return dict(os.environ, MAGICK_TMPDIR=worker.tmp_root)
+
+    def get_tesseract_call(self, worker, tesseract_input):
+        return [
+            self.config.get('Tesseract', 'tesseract_bin_path'),
+            tesseract_input,
+            worker.tmp_filepath_stem,
+            "-l", worker.language,
+            'hocr',
+        ]
+
+    def kill_processes(self, *processes):
+        for cur_process in processes:
+            if cur_process.poll() is None:
+                cur_process.kill()
+            cur_process.wait()
+
+
+class BNITesserocrOcrBackend(BNIOcrBackend):
+    HOCR_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"\n'
+                   '    "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">\n'
+                   '<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">\n'
+                   ' <head>\n'
+                   '  <title></title>\n'
+                   '  <meta http-equiv="Content-Type" content="text/html;charset=utf-8"/>\n'
+                   '  <meta name=\'ocr-system\' content=\'tesseract\'/>\n'
+                   ' </head>\n'
+                   ' <body>\n')
+    HOCR_FOOTER = ' </body>\n</html>\n'
+
+    def __init__(self, config, logger):
+        super(BNITesserocrOcrBackend, self).__init__(config, logger)
+        if tesserocr is None:
+            raise ImportError('The tesserocr OCR backend requires the tesserocr and Pillow packages.')
+        self.tessdata_path = self.config.get('Tesseract', 'tessdata_path', fallback='')
+        self.surrogate_steps = self.get_surrogate_steps(self.get_surrogate_options())
+        # Engines are created lazily, so each forked worker process (and each of its OCR threads) gets its own.
+        self.engines = threading.local()
+
+    def get_engine(self, language):
+        engine = getattr(self.engines, 'engine', None)
+        if engine is None:
+            if self.tessdata_path:
+                engine = tesserocr.PyTessBaseAPI(path=self.tessdata_path, lang=language)
+            else:
+                engine = tesserocr.PyTessBaseAPI(lang=language)
+            self.engines.engine = engine
+        return engine
+
+    def generate_hocr(self, worker):
+        worker.log_worker_stage(9)
+        try:
+            surrogate_image = self.generate_surrogate(worker)
+        except Exception as e:
+            self.logger.info('Worker %s failed encoding HOCR surrogate of %s in memory. Exception : %s',
+                             worker.worker_id,
+                             worker.tmp_tif,
+                             e)
+            worker.log_worker_stage(11)
+            return False
+        worker.log_encode_success()
+        worker.log_worker_stage(10)
+
+        worker.log_worker_stage(12)
+        worker.log_encode_begin()
+        tesseract_timeout = float(self.config.get('Tesseract', 'tesseract_timeout'))
+        try:
+            engine = self.get_engine(worker.language)
+            engine.SetImage(surrogate_image)
+            recognized = engine.Recognize(int(tesseract_timeout * 1000))
+        except Exception as e:
+            worker.log_tesseract_fail(e)
+            worker.log_encode_fail()
+            worker.log_worker_stage(14)
+            return False
+        if not recognized:
+            worker.log_tesseract_fail('Recognition did not finish within ' + str(tesseract_timeout) + ' seconds.')
+            worker.log_worker_stage(13)
+            return False
+
+        try:
+            with io.open('.'.join((worker.tmp_filepath_stem, 'hocr')), 'w', encoding='utf-8') as hocr_file_p:
+                hocr_file_p.write(self.HOCR_HEADER)
+                hocr_file_p.write(engine.GetHOCRText(0))
+                hocr_file_p.write(self.HOCR_FOOTER)
+        except Exception as e:
+            worker.log_tesseract_fail(e)
+            worker.log_worker_stage(14)
+            return False
+        worker.log_worker_stage(15)
+        return True
+
+    def get_surrogate_steps(self, surrogate_options):
+        """Translate the GraphicsMagick surrogate options into the Pillow steps that reproduce them.
+
+        Supports the options the surrogate definition uses: -colorspace Gray, -threshold, -depth 1 (or 8) and the
+        compression flags, which have no meaning for an in-memory image. Anything else raises ValueError, so a
+        surrogate the backend cannot reproduce stops the daemon at startup rather than changing the OCR output.
+        """
+        surrogate_steps = []
+        unsupported_options = []
+        option_index = 0
+        while option_index < len(surrogate_options):
+            cur_option = surrogate_options[option_index]
+            cur_value = surrogate_options[option_index + 1] if option_index + 1 < len(surrogate_options) else ''
+            option_index += 1
+            if cur_value[:1] in ('-', '+'):
+                # The next option follows straight on, so this one takes no value.
+                cur_value = ''
+            elif cur_value:
+                option_index += 1
+            if cur_option == '+compress':
+                continue
+            if cur_option == '-colorspace' and cur_value.lower() in ('gray', 'grey'):
+                surrogate_steps.append(('grayscale', None))
+            elif cur_option == '-threshold' and self.get_threshold(cur_value) is not None:
+                surrogate_steps.append(('threshold', self.get_threshold(cur_value)))
+            elif cur_option == '-depth' and cur_value in ('1', '8'):
+                if cur_value == '1':
+                    surrogate_steps.append(('bilevel', None))
+            elif cur_option != '-compress':
+                unsupported_options.append(' '.join((cur_option, cur_value)).strip())
+        if unsupported_options:
+            raise ValueError('The tesserocr OCR backend cannot apply the surrogate option(s) ' +
+                             ', '.join(unsupported_options) + '. Use the subprocess backend for this surrogate.')
+        return surrogate_steps
+
+    def get_threshold(self, threshold_value):
+        try:
+            if threshold_value.endswith('%'):
+                return float(threshold_value[:-1]) * 255.0 / 100.0
+            return float(threshold_value)
+        except ValueError:
+            return None
+
+    def generate_surrogate(self, worker):
+        """Apply the surrogate steps to the TIF in memory."""
+        surrogate_image = Image.open(worker.tmp_tif)
+        surrogate_image.load()
+        for step_name, step_value in self.surrogate_steps:
+            if step_name == 'grayscale':
+                surrogate_image = surrogate_image.convert('L')
+            elif step_name == 'threshold':
+                surrogate_image = self.threshold_image(surrogate_image, step_value)
+            elif step_name == 'bilevel':
+                surrogate_image = surrogate_image.convert('1', dither=Image.NONE)
+        return surrogate_image
+
+    def threshold_image(self, image, threshold):
+        # As in GraphicsMagick, pixels brighter than the threshold become white and the rest black.
+        return image.convert('L').point(lambda pixel_value: 255 if pixel_value > threshold else 0)
+
+
+OCR_BACKENDS = {
+    'subprocess': BNISubprocessOcrBackend,
+    'tesserocr': BNITesserocrOcrBackend,
+}
@@ -0,0 +1,150 @@
+"""BNIOcrCache
+
+Local content-addressed cache of OCR results.
+
+Rescans, re-queued failures and duplicate deliveries send byte-identical TIFs through OCR again. Results are
+stored under a key derived from the SHA1 of the TIF together with everything else that shapes the output: the
+surrogate conversion options, the tesseract language, the tesseract version and the OCR backend. A hit copies
+the stored hOCR and txt into place instead of running gm and tesseract.
+
+Entries are plain files below the cache path, indexed in a small SQLite database shared by every worker on
+the host. The index tracks each entry's size and last use, so the cache is trimmed least recently used first
+once it grows past its size limit, and counts hits and misses for the metrics endpoint.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from lib.BNIFileDigest import sha1_file
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+OCR_EXTENSIONS = ('hocr', 'txt')
+
+
+class BNIOcrCache(object):
+    def __init__(self, config, logger, tesseract_version=''):
+        self.logger = logger
+        self.cache_path = config.get('OCRCache', 'ocr_cache_path', fallback='')
+        self.max_bytes = config.getint('OCRCache', 'ocr_cache_max_mb', fallback=10240) * 1048576
+        self.hash_buffer_size = config.getint('SHA1Sum', 'sha1sum_buffer_size', fallback=1048576)
+        self.key_parts = [
+            config.get('HOCR', 'gm_surrogate_convert_options', fallback=''),
+            config.get('Tesseract', 'tesseract_language', fallback=''),
+            tesseract_version or '',
+            config.get('OCR', 'ocr_backend', fallback='subprocess'),
+        ]
+        self.index_local = threading.local()
+
+    @property
+    def enabled(self):
+        return self.cache_path != ''
+
+    def open_index(self):
+        # SQLite connections must not cross a fork or a thread, so each process and thread opens its own.
+        index_db = getattr(self.index_local, 'index_db', None)
+        if index_db is None or self.index_local.index_pid != os.getpid():
+            os.makedirs(os.path.join(self.cache_path, 'objects'), exist_ok=True)
+            index_db = sqlite3.connect(os.path.join(self.cache_path, 'index.sqlite'), timeout=30)
+            index_db.execute("PRAGMA journal_mode=WAL")
+            index_db.execute(
+                "CREATE TABLE IF NOT EXISTS entries (cache_key TEXT PRIMARY KEY, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            index_db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+            index_db.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            index_db.commit()
+            self.index_local.index_db = index_db
+            self.index_local.index_pid = os.getpid()
+        return index_db
+
+    def get_key(self, tif_filepath):
+        tif_sha1 = sha1_file(tif_filepath, self.hash_buffer_size)
+        return hashlib.sha1('\0'.join([tif_sha1] + self.key_parts).encode('utf-8')).hexdigest()
+
+    def get_entry_filepath(self, cache_key, extension):
+        return os.path.join(self.cache_path, 'objects', cache_key[0:2], '.'.join((cache_key, extension)))
+
+    def fetch(self, cache_key, output_filepath_stem):
+        """Place the cached hOCR and txt for cache_key at output_filepath_stem. Returns False on a miss."""
+        index_db = self.open_index()
+        with index_db:
+            cached_entry = index_db.execute("SELECT size FROM entries WHERE cache_key=?", (cache_key,)).fetchone()
+            if cached_entry is not None:
+                try:
+                    for extension in OCR_EXTENSIONS:
+                        self.place_file(
+                            self.get_entry_filepath(cache_key, extension),
+                            '.'.join((output_filepath_stem, extension))
+                        )
+                except (IOError, OSError) as e:
+                    self.logger.warning('OCR cache entry %s is unreadable, dropping it. Exception : %s', cache_key, e)
+                    index_db.execute("DELETE FROM entries WHERE cache_key=?", (cache_key,))
+                    cached_entry = None
+            if cached_entry is None:
+                self.count(index_db, 'misses')
+                return False
+            index_db.execute("UPDATE entries SET last_used=? WHERE cache_key=?", (time.time(), cache_key))
+            self.count(index_db, 'hits')
+        return True
+
+    def store(self, cache_key, output_filepath_stem):
+        entry_size = 0
+        for extension in OCR_EXTENSIONS:
+            entry_filepath = self.get_entry_filepath(cache_key, extension)
+            os.makedirs(os.path.dirname(entry_filepath), exist_ok=True)
+            self.place_file('.'.join((output_filepath_stem, extension)), entry_filepath)
+            entry_size += os.path.getsize(entry_filepath)
+        index_db = self.open_index()
+        with index_db:
+            index_db.execute(
+                "REPLACE INTO entries (cache_key, size, last_used) VALUES (?, ?, ?)",
+                (cache_key, entry_size, time.time())
+            )
+        self.evict()
+
+    def evict(self):
+        index_db = self.open_index()
+        with index_db:
+            cache_bytes = index_db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if cache_bytes <= self.max_bytes:
+                return
+            evicted_keys = []
+            for cache_key, entry_size in index_db.execute("SELECT cache_key, size FROM entries ORDER BY last_used"):
+                if cache_bytes <= self.max_bytes:
+                    break
+                evicted_keys.append(cache_key)
+                cache_bytes -= entry_size
+            for cache_key in evicted_keys:
+                index_db.execute("DELETE FROM entries WHERE cache_key=?", (cache_key,))
+                for extension in OCR_EXTENSIONS:
+                    try:
+                        os.unlink(self.get_entry_filepath(cache_key, extension))
+                    except OSError:
+                        pass
+            self.count(index_db, 'evictions', len(evicted_keys))
+
+    def place_file(self, source_filepath, target_filepath):
+        # Copied rather than hardlinked: tesseract and the distiller rewrite their outputs in place on a retry,
+        # which would corrupt an entry sharing the inode.
+        tmp_target_filepath = '%s.%d.tmp' % (target_filepath, os.getpid())
+        shutil.copyfile(source_filepath, tmp_target_filepath)
+        os.rename(tmp_target_filepath, target_filepath)
+
+    def count(self, index_db, stat_name, increment=1):
+        index_db.execute(
+            "INSERT INTO stats (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (stat_name, increment)
+        )
+
+    def get_stats(self):
+        """Return hit, miss and eviction counts with the entry count and total size of the cache."""
+        index_db = self.open_index()
+        cache_stats = dict(index_db.execute("SELECT name, value FROM stats").fetchall())
+        cache_stats['entries'], cache_stats['bytes'] = index_db.execute(
+            "SELECT COUNT(1), COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        return cache_stats
@@ -0,0 +1,101 @@
+"""BNIPageCheckpoint
+
+Per-page checkpoint file, kept in tmp_path next to the page's intermediate outputs.
+
+After each resumable stage (PASSHOCR 15, PASSOCR 18, ARCHIVEOK 20, PASSSHA1SUM 23) the worker records the
+status reached and the artifacts that stage produced. When a page is claimed again after its worker died, the
+checkpoint is verified before anything is reused: the source TIF and JPG must be unchanged, and every artifact
+must still exist with the recorded size and, where one was recorded, the same SHA1. The page then resumes
+after the last stage whose artifacts all verify. Archived outputs are checked by size only, since the archiver
+only ever renames complete files into place.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from lib.BNIFileDigest import sha1_file
+import io
+import json
+import os
+
+RESUMABLE_STATUSES = (15, 18, 20, 23)
+
+
+class BNIPageCheckpoint(object):
+    def __init__(self, checkpoint_filepath, source_filepaths, logger, hash_buffer_size=1048576):
+        self.checkpoint_filepath = checkpoint_filepath
+        self.source_filepaths = source_filepaths
+        self.logger = logger
+        self.hash_buffer_size = hash_buffer_size
+        self.stages = {}
+        self.stage_data = {}
+
+    def load(self):
+        """Return the last status whose artifacts verify, or 0 when the page must start from scratch."""
+        try:
+            with io.open(self.checkpoint_filepath, 'r') as checkpoint_file_p:
+                checkpoint = json.load(checkpoint_file_p)
+        except (IOError, OSError, ValueError):
+            return 0
+        if checkpoint.get('sources') != self.get_source_states():
+            self.logger.info('Checkpoint %s is for different source files, discarding it.', self.checkpoint_filepath)
+            self.remove()
+            return 0
+
+        resume_status_id = 0
+        for status_id in RESUMABLE_STATUSES:
+            stage = checkpoint['stages'].get(str(status_id))
+            if stage is None or not self.verify_artifacts(stage['artifacts']):
+                break
+            self.stages[str(status_id)] = stage
+            self.stage_data[status_id] = stage.get('data')
+            resume_status_id = status_id
+        return resume_status_id
+
+    def record(self, status_id, artifact_filepaths, data=None, hash_artifacts=True):
+        """Record that status_id was reached, producing the given artifacts."""
+        artifacts = {}
+        for artifact_filepath in artifact_filepaths:
+            artifacts[artifact_filepath] = [
+                os.path.getsize(artifact_filepath),
+                sha1_file(artifact_filepath, self.hash_buffer_size) if hash_artifacts else None
+            ]
+        self.stages[str(status_id)] = {'artifacts': artifacts, 'data': data}
+        self.stage_data[status_id] = data
+        self.write({'sources': self.get_source_states(), 'stages': self.stages})
+
+    def write(self, checkpoint):
+        tmp_checkpoint_filepath = self.checkpoint_filepath + '.tmp'
+        with io.open(tmp_checkpoint_filepath, 'w') as checkpoint_file_p:
+            json.dump(checkpoint, checkpoint_file_p)
+            checkpoint_file_p.flush()
+            os.fsync(checkpoint_file_p.fileno())
+        os.rename(tmp_checkpoint_filepath, self.checkpoint_filepath)
+
+    def remove(self):
+        for checkpoint_filepath in (self.checkpoint_filepath, self.checkpoint_filepath + '.tmp'):
+            try:
+                os.unlink(checkpoint_filepath)
+            except OSError:
+                pass
+
+    def get_source_states(self):
+        source_states = {}
+        for source_filepath in self.source_filepaths:
+            try:
+                source_stat = os.stat(source_filepath)
+                source_states[source_filepath] = [source_stat.st_size, source_stat.st_mtime_ns]
+            except OSError:
+                source_states[source_filepath] = None
+        return source_states
+
+    def verify_artifacts(self, artifacts):
+        for artifact_filepath, (artifact_size, artifact_sha1) in artifacts.items():
+            try:
+                if os.path.getsize(artifact_filepath) != artifact_size:
+                    return False
+            except OSError:
+                return False
+            if artifact_sha1 is not None and sha1_file(artifact_filepath, self.hash_buffer_size) != artifact_sha1:
+                return False
+        return True
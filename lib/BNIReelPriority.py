@@ -0,0 +1,68 @@
+"""BNIReelPriority
+
+Reel-level scheduling priority for the images queue.
+
+Every queued image carries the SHA1 of its reel directory (the directory holding Tiffs/, relative to the input
+path) and a priority, higher meaning sooner. Raising a reel's priority updates its queued images and records the
+priority in reel_priorities, so pages of that reel queued later inherit it.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import hashlib
+import os
+
+
+def get_directory_hash(typeless_relative_path):
+    # Matches the directory_hash computed by migration 0004 from images.filepath.
+    return hashlib.sha1(os.path.dirname(typeless_relative_path).encode('utf-8')).digest()
+
+
+def get_reel_path(reel_path, input_path):
+    """Normalize a reel given on the command line to its path relative to the input path."""
+    reel_path = os.path.normpath(reel_path)
+    input_path = os.path.normpath(input_path)
+    if reel_path.startswith(input_path + '/'):
+        reel_path = reel_path[len(input_path) + 1:]
+    if os.path.basename(reel_path) == 'Tiffs':
+        reel_path = os.path.dirname(reel_path)
+    return reel_path.strip('/')
+
+
+def get_reel_priorities(db_cur, directory_hashes, chunk_size=500):
+    """Return {directory_hash: priority} for the given reels that have a priority set."""
+    directory_hashes = list(directory_hashes)
+    reel_priorities = {}
+    for chunk_start in range(0, len(directory_hashes), chunk_size):
+        chunk = directory_hashes[chunk_start:chunk_start + chunk_size]
+        db_cur.execute(
+            "SELECT directory_hash, priority FROM reel_priorities WHERE directory_hash IN (" +
+            ','.join(['%s'] * len(chunk)) + ")",
+            chunk
+        )
+        reel_priorities.update((bytes(row[0]), row[1]) for row in db_cur.fetchall())
+    return reel_priorities
+
+
+def set_reel_priority(database, logger, reel_path, priority):
+    """Set the priority of a reel's queued and future images. Returns the number of queued images updated."""
+    directory_hash = hashlib.sha1(reel_path.encode('utf-8')).digest()
+
+    def prioritize(db):
+        db_cur = db.cursor()
+        db_cur.execute(
+            "REPLACE INTO reel_priorities (directory_hash, reel_path, priority, updated_datestamp) "
+            "VALUES (%s, %s, %s, NOW())",
+            (directory_hash, reel_path, priority)
+        )
+        updated_rows = db_cur.execute(
+            "UPDATE images SET priority=%s WHERE directory_hash=%s AND status_id=1",
+            (priority, directory_hash)
+        )
+        db_cur.close()
+        return updated_rows
+
+    updated_rows = database.run_with_retry(prioritize, 'reel priority')
+    logger.info('Reel %s set to priority %s, %s queued image(s) updated.', reel_path, priority, updated_rows)
+    return updated_rows
@@ -0,0 +1,98 @@
+"""BNISchemaMigrator
+
+Applies the versioned SQL migrations in the migrations directory to the processing database.
+
+Migrations are named NNNN_description.sql and applied in order. Each applied version is recorded in the
+schema_version table. A database without that table is treated as version 0, the schema as originally shipped.
+MySQL commits DDL implicitly, so a migration that fails part way through is not rolled back; the error is
+reported and the failed statement has to be fixed by hand before migrating again.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import io
+import os
+import re
+from lib.BNIDatabase import BNIDatabase
+
+MIGRATIONS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+
+
+class BNISchemaMigrator(object):
+    def __init__(self, config, logger, migrations_path=MIGRATIONS_PATH):
+        self.config = config
+        self.logger = logger
+        self.migrations_path = migrations_path
+        self.database = BNIDatabase(config, logger)
+
+    def get_migrations(self):
+        """Return (version, name, filepath) for every migration shipped, in version order."""
+        migrations = []
+        for migration_filename in sorted(os.listdir(self.migrations_path)):
+            migration_match = re.match(r'^(\d{4})_(\w+)\.sql$', migration_filename)
+            if migration_match:
+                migrations.append((
+                    int(migration_match.group(1)),
+                    migration_match.group(2),
+                    os.path.join(self.migrations_path, migration_filename)
+                ))
+        return migrations
+
+    def get_latest_version(self):
+        migrations = self.get_migrations()
+        return migrations[-1][0] if migrations else 0
+
+    def get_current_version(self, db_cur):
+        db_cur.execute(
+            "SELECT COUNT(1) FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = 'schema_version'"
+        )
+        if db_cur.fetchone()[0] == 0:
+            return 0
+        db_cur.execute("SELECT MAX(version) FROM schema_version")
+        current_version = db_cur.fetchone()[0]
+        return current_version if current_version is not None else 0
+
+    def get_pending_migrations(self):
+        with self.database.connection() as db:
+            db_cur = db.cursor()
+            current_version = self.get_current_version(db_cur)
+            db_cur.close()
+        return [migration for migration in self.get_migrations() if migration[0] > current_version]
+
+    def migrate(self):
+        """Apply every pending migration. Returns the number applied."""
+        with self.database.connection() as db:
+            db_cur = db.cursor()
+            db_cur.execute(
+                "CREATE TABLE IF NOT EXISTS schema_version ("
+                "version SMALLINT UNSIGNED NOT NULL PRIMARY KEY, name VARCHAR(128), applied_datestamp DATETIME"
+                ") ENGINE = InnoDB"
+            )
+            current_version = self.get_current_version(db_cur)
+            pending_migrations = [migration for migration in self.get_migrations() if migration[0] > current_version]
+            if not pending_migrations:
+                self.logger.info('Schema is up to date at version %s.', current_version)
+            for version, name, migration_filepath in pending_migrations:
+                self.logger.info('Applying schema migration %04d_%s.', version, name)
+                for statement in self.read_statements(migration_filepath):
+                    db_cur.execute(statement)
+                db_cur.execute(
+                    "INSERT INTO schema_version (version, name, applied_datestamp) VALUES (%s, %s, NOW())",
+                    (version, name)
+                )
+                db.commit()
+                self.logger.info('Schema now at version %s.', version)
+            db_cur.close()
+        return len(pending_migrations)
+
+    def read_statements(self, migration_filepath):
+        with io.open(migration_filepath, 'r') as migration_file_p:
+            migration_lines = [
+                cur_line for cur_line in migration_file_p
+                if not cur_line.lstrip().startswith('--')
+            ]
+        return [
+            statement.strip() for statement in re.split(r';\s*$', ''.join(migration_lines), flags=re.MULTILINE)
+            if statement.strip()
+        ]
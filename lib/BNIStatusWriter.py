@@ -0,0 +1,128 @@
+"""BNIStatusWriter
+
+Asynchronous, batched writer for image status transitions.
+
+Workers record each stage change here instead of issuing an UPDATE and a commit per transition. Only the
+latest status of each image matters to the images table, so transitions are collapsed per images.id and
+written by a background thread in grouped statements, either every flush interval or as soon as enough
+images are waiting. Callers flush explicitly before claiming new work, which guarantees every terminal state
+is stored before the worker moves on.
+
+Per-stage timings are buffered alongside the transitions and inserted into stage_timings on the same flush.
+
+Given a lease owner, updates only apply to images still leased to that worker, so a worker whose lease was
+reaped cannot overwrite the progress of the worker that took the image over. Terminal statuses clear the lease.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import collections
+import threading
+
+
+class BNIStatusWriter(object):
+    # Statuses that end an image's processing, successfully or not.
+    TERMINAL_STATUSES = frozenset((3, 5, 7, 11, 13, 14, 21, 24, 26, 29, 30, 31, 32))
+
+    def __init__(self, config, logger, database, lease_owner=None):
+        self.logger = logger
+        self.database = database
+        self.lease_owner = lease_owner
+        self.flush_interval = config.getfloat('MySQL', 'status_flush_interval', fallback=5.0)
+        self.flush_threshold = config.getint('MySQL', 'status_flush_threshold', fallback=50)
+        self.pending = collections.OrderedDict()
+        self.pending_timings = []
+        self.pending_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        self.stopped = False
+        self.thread = threading.Thread(name='statuswriter', target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def record(self, image_id, status_id):
+        with self.pending_lock:
+            self.pending.pop(image_id, None)
+            self.pending[image_id] = status_id
+            pending_count = len(self.pending)
+        if pending_count >= self.flush_threshold or status_id in self.TERMINAL_STATUSES:
+            self.wakeup.set()
+
+    def record_timing(self, image_id, status_id, duration_ms, worker_id, config_id):
+        with self.pending_lock:
+            self.pending_timings.append(
+                (image_id, status_id, duration_ms, worker_id, config_id)
+            )
+
+    def run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.error('Status writer failed to flush, will retry. Exception : %s', e)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.pending_lock:
+                pending = self.pending
+                self.pending = collections.OrderedDict()
+                pending_timings = self.pending_timings
+                self.pending_timings = []
+            if not pending and not pending_timings:
+                return
+
+            status_groups = collections.OrderedDict()
+            for image_id, status_id in pending.items():
+                status_groups.setdefault(status_id, []).append(image_id)
+
+            def write_statuses(db):
+                db_cur = db.cursor()
+                for status_id, image_ids in status_groups.items():
+                    # Datestamps come from the server clock, which every other query compares them against.
+                    status_query = "UPDATE images SET status_id=%s, latest_datestamp=NOW()"
+                    if status_id in self.TERMINAL_STATUSES:
+                        status_query += ", lease_config_id=NULL, lease_worker_id=NULL, lease_expires=NULL"
+                    status_query += " WHERE id IN (" + ','.join(['%s'] * len(image_ids)) + ")"
+                    status_params = [status_id] + image_ids
+                    if self.lease_owner is not None:
+                        status_query += " AND lease_config_id=%s AND lease_worker_id=%s"
+                        status_params.extend(self.lease_owner)
+                    db_cur.execute(status_query, status_params)
+                if pending_timings:
+                    # NOW() is read once and passed as a parameter, as a literal NOW() would stop executemany
+                    # from sending the timings as a single multi-row INSERT.
+                    db_cur.execute("SELECT NOW()")
+                    recorded_datestamp = db_cur.fetchone()[0]
+                    db_cur.executemany(
+                        "INSERT INTO stage_timings (image_id, status_id, duration_ms, worker_id, config_id, recorded_datestamp) "
+                        "VALUES (%s, %s, %s, %s, %s, %s)",
+                        [pending_timing + (recorded_datestamp,) for pending_timing in pending_timings]
+                    )
+                db_cur.close()
+
+            try:
+                # Status updates are idempotent; a retried timing insert can at worst duplicate a sample.
+                self.database.run_with_retry(write_statuses, 'status flush')
+            except Exception:
+                # Put the transitions back, unless a newer one for the same image arrived meanwhile.
+                with self.pending_lock:
+                    for image_id, pending_status in pending.items():
+                        if image_id not in self.pending:
+                            self.pending[image_id] = pending_status
+                    self.pending_timings[0:0] = pending_timings
+                raise
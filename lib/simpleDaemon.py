@@ -10,7 +10,7 @@ from __future__ import print_function
 from __future__ import unicode_literals
 import sys, os, time, atexit
 import io
-from signal import SIGTERM
+from signal import SIGTERM, signal
 
 class Daemon(object):
     def __init__(self, pidfile, stdin='/dev/null', stdout='/dev/null', stderr='/dev/null'):
@@ -64,6 +64,16 @@ class Daemon(object):
         pid = str(os.getpid())
         io.open(self.pidfile, 'w+').write("%s\n" % pid)
 
+        # route SIGTERM through the daemon so subclasses can shut down cleanly
+        signal(SIGTERM, self.handle_sigterm)
+
+    def handle_sigterm(self, signum, frame):
+        """
+        Called when stop() signals the daemon. Exits immediately by default; override this to drain work
+        before run() returns.
+        """
+        sys.exit(0)
+
     def delpid(self):
         os.remove(self.pidfile)
 
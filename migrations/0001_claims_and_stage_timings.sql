@@ -0,0 +1,23 @@
+-- Brings databases created from the original schema up to date with atomic claiming, host sizing and
+-- per-stage timing. Databases created from BNINewspaperProcessing.schema.sql already include this.
+ALTER TABLE configuration
+  ADD COLUMN omp_thread_limit SMALLINT UNSIGNED,
+  ADD COLUMN cpu_count SMALLINT UNSIGNED,
+  ADD COLUMN memory_mb INT UNSIGNED,
+  ADD COLUMN load_average FLOAT,
+  ADD COLUMN available_memory_mb INT UNSIGNED;
+
+ALTER TABLE images ADD COLUMN claim_token CHAR(32) AFTER status_id;
+ALTER TABLE images ADD INDEX (claim_token);
+
+CREATE TABLE stage_timings (
+  id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+  image_id INT NOT NULL,
+  status_id TINYINT UNSIGNED,
+  duration_ms INT UNSIGNED,
+  worker_id SMALLINT UNSIGNED,
+  config_id MEDIUMINT UNSIGNED,
+  recorded_datestamp DATETIME
+);
+ALTER TABLE stage_timings ADD INDEX (image_id);
+ALTER TABLE stage_timings ADD INDEX (recorded_datestamp);
@@ -0,0 +1,19 @@
+-- Moves images to InnoDB so status updates take row locks instead of locking the whole table, replaces the
+-- VARCHAR(512) filepath index with a unique fixed-width SHA1 of the path, and indexes (status_id, id) so
+-- claiming the next queued images reads only the index.
+--
+-- The unique index will not build if a filepath is queued twice; remove the duplicate rows first.
+ALTER TABLE images ENGINE = InnoDB;
+ALTER TABLE configuration ENGINE = InnoDB;
+ALTER TABLE stage_timings ENGINE = InnoDB;
+ALTER TABLE status ENGINE = InnoDB;
+
+ALTER TABLE images ADD COLUMN path_hash BINARY(20) AFTER filepath;
+UPDATE images SET path_hash = UNHEX(SHA1(filepath));
+ALTER TABLE images
+  MODIFY path_hash BINARY(20) NOT NULL,
+  ADD UNIQUE INDEX path_hash (path_hash),
+  ADD INDEX status_claim (status_id, id),
+  DROP INDEX filepath,
+  DROP INDEX status_id,
+  DROP INDEX id;
@@ -0,0 +1,13 @@
+-- Gives every claimed image an owner and a lease expiry, so images held by a crashed worker or host are
+-- returned to the queue instead of staying in progress forever.
+--
+-- Stop every daemon before migrating: images left in progress at that point have no live owner, so they are
+-- given an already expired lease and re-queued by the first daemon to start.
+ALTER TABLE images
+  ADD COLUMN lease_config_id MEDIUMINT UNSIGNED AFTER claim_token,
+  ADD COLUMN lease_worker_id SMALLINT UNSIGNED AFTER lease_config_id,
+  ADD COLUMN lease_expires DATETIME AFTER lease_worker_id,
+  ADD INDEX lease_expires (lease_expires),
+  ADD INDEX lease_owner (lease_config_id, lease_worker_id);
+
+UPDATE images SET lease_expires = NOW() WHERE status_id NOT IN (1,3,5,7,11,13,14,21,24,26,27,28);
@@ -0,0 +1,25 @@
+-- Schedules the queue by reel: every image records the SHA1 of its reel directory and a priority, and workers
+-- claim the highest priority queued reel, staying on one reel until it is drained. reel_priorities keeps
+-- priorities raised with --prioritize so pages of the reel queued later inherit them.
+CREATE TABLE reel_priorities (
+  directory_hash BINARY(20) NOT NULL PRIMARY KEY,
+  reel_path VARCHAR(512),
+  priority TINYINT UNSIGNED NOT NULL,
+  updated_datestamp DATETIME
+) ENGINE = InnoDB;
+
+ALTER TABLE images
+  ADD COLUMN directory_hash BINARY(20) AFTER path_hash,
+  ADD COLUMN priority TINYINT UNSIGNED NOT NULL DEFAULT 0 AFTER status_id;
+
+-- The directory part of filepath, as os.path.dirname() gives it.
+UPDATE images SET directory_hash = UNHEX(SHA1(
+  SUBSTRING(filepath, 1, GREATEST(CHAR_LENGTH(filepath) - CHAR_LENGTH(SUBSTRING_INDEX(filepath, '/', -1)) - 1, 0))
+));
+
+ALTER TABLE images
+  MODIFY COLUMN directory_hash BINARY(20) NOT NULL,
+  DROP INDEX status_claim,
+  ADD INDEX status_claim (status_id, priority, id),
+  ADD INDEX directory_claim (status_id, directory_hash, priority, id),
+  ADD INDEX directory_lease (directory_hash, lease_expires);
@@ -0,0 +1,6 @@
+-- Failure statuses given by the daemon's header validation to pages it queues without ever letting them be
+-- claimed: a TIF or JPG whose headers are corrupt or truncated, and a JPG whose dimensions do not match its TIF.
+INSERT INTO status (status_id,status_string) VALUES
+(29,'FAILHEADERTIF'),
+(30,'FAILHEADERJPG'),
+(31,'FAILDIMENSIONS');
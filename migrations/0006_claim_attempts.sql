@@ -0,0 +1,7 @@
+-- Counts the times a worker has started on each image, so an image that keeps taking its worker down is
+-- failed after max_claim_attempts attempts instead of being re-queued forever.
+ALTER TABLE images
+  ADD COLUMN attempts TINYINT UNSIGNED NOT NULL DEFAULT 0 AFTER lease_expires;
+
+INSERT INTO status (status_id,status_string) VALUES
+(32,'FAILATTEMPTS');
@@ -0,0 +1,26 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import configparser
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger('bni_tests')
+
+
+@pytest.fixture
+def make_config():
+    def make_config(**sections):
+        config = configparser.ConfigParser(interpolation=None)
+        config.read_dict(sections)
+        return config
+    return make_config
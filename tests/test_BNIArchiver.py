@@ -0,0 +1,168 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import errno
+import hashlib
+import os
+
+import pytest
+
+from lib import BNIArchiver as archiver_module
+from lib.BNIArchiver import BNIArchiveTimeout, BNIArchiver
+
+RELATIVE_PATHS = ['reel1/page01.tif', 'reel1/page01.jpg', 'reel1/page01.hocr']
+SOURCE_MTIME_NS = 1500000000123456789
+
+
+@pytest.fixture
+def source_root(tmp_path):
+    source_root = tmp_path / 'source'
+    (source_root / 'reel1').mkdir(parents=True)
+    for file_index, relative_path in enumerate(RELATIVE_PATHS):
+        source_filepath = source_root / relative_path
+        # Sizes around the small buffer used below, so partial and exact chunks are both copied.
+        source_filepath.write_bytes(os.urandom(4096 * (file_index + 1) + file_index * 7))
+        os.chmod(str(source_filepath), 0o640)
+        os.utime(str(source_filepath), ns=(SOURCE_MTIME_NS, SOURCE_MTIME_NS))
+    return source_root
+
+
+@pytest.fixture
+def make_archiver(make_config, logger):
+    archivers = []
+
+    def make_archiver(**archive_options):
+        archive_options.setdefault('archive_buffer_size', '4096')
+        archive_options.setdefault('archive_fsync', 'false')
+        archiver = BNIArchiver(make_config(Archive=archive_options), logger)
+        archivers.append(archiver)
+        return archiver
+    yield make_archiver
+    for archiver in archivers:
+        archiver.close()
+
+
+def get_sha1(filepath):
+    with open(str(filepath), 'rb') as file_p:
+        return hashlib.sha1(file_p.read()).hexdigest()
+
+
+def get_expected_digests(source_root):
+    return dict((relative_path, get_sha1(source_root / relative_path)) for relative_path in RELATIVE_PATHS)
+
+
+def assert_archived(source_root, output_path):
+    for relative_path in RELATIVE_PATHS:
+        archived_filepath = output_path / relative_path
+        assert archived_filepath.read_bytes() == (source_root / relative_path).read_bytes()
+        archived_stat = os.stat(str(archived_filepath))
+        assert archived_stat.st_mode & 0o7777 == 0o640
+        assert archived_stat.st_mtime_ns == SOURCE_MTIME_NS
+    assert not [name for name in os.listdir(str(output_path / 'reel1')) if name.endswith('.tmp')]
+
+
+@pytest.mark.parametrize('copy_method', ['auto', 'buffered'])
+def test_archive_returns_digests_of_the_copied_files(tmp_path, source_root, make_archiver, copy_method):
+    archiver = make_archiver(archive_copy_method=copy_method)
+
+    digests = archiver.archive(str(source_root), RELATIVE_PATHS, str(tmp_path / 'output'), 60)
+
+    assert digests == get_expected_digests(source_root)
+    assert_archived(source_root, tmp_path / 'output')
+
+
+@pytest.mark.parametrize('link_mode', ['reflink', 'hardlink', 'copy'])
+def test_fanout_digests_match_in_every_link_mode(tmp_path, source_root, make_archiver, link_mode):
+    archiver = make_archiver(archive_link_mode=link_mode)
+
+    bni_digests, lib_digests = archiver.archive_fanout(
+        str(source_root),
+        [(str(tmp_path / 'bni'), RELATIVE_PATHS), (str(tmp_path / 'lib'), RELATIVE_PATHS[0:2])],
+        60
+    )
+
+    expected_digests = get_expected_digests(source_root)
+    assert bni_digests == expected_digests
+    assert lib_digests == dict((relative_path, expected_digests[relative_path]) for relative_path in RELATIVE_PATHS[0:2])
+    assert_archived(source_root, tmp_path / 'bni')
+    for relative_path in RELATIVE_PATHS[0:2]:
+        assert (tmp_path / 'lib' / relative_path).read_bytes() == (source_root / relative_path).read_bytes()
+
+
+def test_hardlink_mode_shares_one_inode(tmp_path, source_root, make_archiver):
+    archiver = make_archiver(archive_link_mode='hardlink')
+
+    archiver.archive_fanout(str(source_root), [(str(tmp_path / 'bni'), RELATIVE_PATHS), (str(tmp_path / 'lib'), RELATIVE_PATHS)], 60)
+
+    for relative_path in RELATIVE_PATHS:
+        assert os.stat(str(tmp_path / 'bni' / relative_path)).st_ino == os.stat(str(tmp_path / 'lib' / relative_path)).st_ino
+
+
+def test_copy_mode_writes_separate_files(tmp_path, source_root, make_archiver):
+    archiver = make_archiver(archive_link_mode='copy')
+
+    archiver.archive_fanout(str(source_root), [(str(tmp_path / 'bni'), RELATIVE_PATHS), (str(tmp_path / 'lib'), RELATIVE_PATHS)], 60)
+
+    for relative_path in RELATIVE_PATHS:
+        assert os.stat(str(tmp_path / 'bni' / relative_path)).st_ino != os.stat(str(tmp_path / 'lib' / relative_path)).st_ino
+
+
+def test_unsupported_reflinks_fall_back_to_hardlinks(tmp_path, source_root, make_archiver, monkeypatch):
+    def ioctl(fd, request, arg):
+        raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+    monkeypatch.setattr(archiver_module.fcntl, 'ioctl', ioctl)
+    archiver = make_archiver(archive_link_mode='reflink')
+
+    digests = archiver.archive_fanout(
+        str(source_root), [(str(tmp_path / 'bni'), RELATIVE_PATHS), (str(tmp_path / 'lib'), RELATIVE_PATHS)], 60
+    )
+
+    assert archiver.link_mode == 'hardlink'
+    assert digests == [get_expected_digests(source_root)] * 2
+    for relative_path in RELATIVE_PATHS:
+        assert os.stat(str(tmp_path / 'bni' / relative_path)).st_ino == os.stat(str(tmp_path / 'lib' / relative_path)).st_ino
+
+
+def test_failed_hardlinks_fall_back_to_copies(tmp_path, source_root, make_archiver, monkeypatch):
+    def link(*args, **kwargs):
+        raise OSError(errno.EPERM, os.strerror(errno.EPERM))
+    monkeypatch.setattr(archiver_module.os, 'link', link)
+    archiver = make_archiver(archive_link_mode='hardlink')
+
+    digests = archiver.archive_fanout(
+        str(source_root), [(str(tmp_path / 'bni'), RELATIVE_PATHS), (str(tmp_path / 'lib'), RELATIVE_PATHS)], 60
+    )
+
+    assert archiver.link_mode == 'copy'
+    assert digests == [get_expected_digests(source_root)] * 2
+    assert_archived(source_root, tmp_path / 'bni')
+    assert_archived(source_root, tmp_path / 'lib')
+
+
+def test_nothing_is_renamed_into_place_when_a_file_fails(tmp_path, source_root, make_archiver):
+    archiver = make_archiver()
+
+    with pytest.raises(OSError):
+        archiver.archive(str(source_root), RELATIVE_PATHS + ['reel1/missing.txt'], str(tmp_path / 'output'), 60)
+
+    assert os.listdir(str(tmp_path / 'output' / 'reel1')) == []
+
+
+def test_timeout_discards_the_partial_copy(tmp_path, source_root, make_archiver):
+    archiver = make_archiver()
+
+    with pytest.raises(BNIArchiveTimeout):
+        archiver.archive(str(source_root), RELATIVE_PATHS, str(tmp_path / 'output'), -1)
+
+    assert os.listdir(str(tmp_path / 'output' / 'reel1')) == []
+
+
+def test_archiving_replaces_existing_files(tmp_path, source_root, make_archiver):
+    (tmp_path / 'output' / 'reel1').mkdir(parents=True)
+    (tmp_path / 'output' / RELATIVE_PATHS[0]).write_bytes(b'stale')
+    archiver = make_archiver()
+
+    archiver.archive(str(source_root), RELATIVE_PATHS, str(tmp_path / 'output'), 60)
+
+    assert_archived(source_root, tmp_path / 'output')
@@ -0,0 +1,153 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import os
+import time
+
+import pytest
+
+from lib.BNIDirectoryScanner import BNIDirectoryScanner
+
+SETTLED_MTIME = time.time() - 3600
+
+
+def write_page(dir_path, name):
+    os.makedirs(dir_path, exist_ok=True)
+    with open(os.path.join(dir_path, name), 'wb') as page_p:
+        page_p.write(b'II*\0')
+
+
+def settle(*dir_paths):
+    # Directories modified within MTIME_GRANULARITY_NS are never cached.
+    for dir_path in dir_paths:
+        os.utime(dir_path, (SETTLED_MTIME, SETTLED_MTIME))
+
+
+class RecordingQueue(object):
+    """Stands in for the daemon's images table: remembers what was queued and which directories were listed."""
+
+    def __init__(self):
+        self.queued = set()
+        self.listed_dirs = []
+
+    def select_new_files(self, filepaths):
+        self.listed_dirs.append(os.path.dirname(filepaths[0]))
+        return [filepath for filepath in filepaths if filepath not in self.queued]
+
+    def queue(self, filepaths):
+        self.queued.update(filepaths)
+
+
+@pytest.fixture
+def scanner(tmp_path, make_config, logger):
+    scanner = BNIDirectoryScanner(
+        make_config(Intake={'scan_cache_path': str(tmp_path / 'scan_cache.sqlite')}),
+        logger,
+        str(tmp_path / 'input')
+    )
+    yield scanner
+    scanner.close()
+
+
+def test_scan_stops_at_the_batch_limit_and_resumes(tmp_path, scanner):
+    reel_path = str(tmp_path / 'input' / 'reel1' / 'Tiffs')
+    for page_number in range(5):
+        write_page(reel_path, 'page%02d.tif' % page_number)
+    settle(reel_path, str(tmp_path / 'input' / 'reel1'), str(tmp_path / 'input'))
+    queue = RecordingQueue()
+
+    first_batch = scanner.scan(queue.select_new_files, 3)
+    queue.queue(first_batch)
+    scanner.save_changes()
+    second_batch = scanner.scan(queue.select_new_files, 3)
+
+    assert [os.path.basename(filepath) for filepath in first_batch] == ['page00.tif', 'page01.tif', 'page02.tif']
+    assert [os.path.basename(filepath) for filepath in second_batch] == ['page03.tif', 'page04.tif']
+
+
+def test_scan_walks_directories_in_sorted_order(tmp_path, scanner):
+    for reel_name in ('reel2', 'reel1', 'reel3'):
+        write_page(str(tmp_path / 'input' / reel_name), 'page.tif')
+
+    new_files = scanner.scan(RecordingQueue().select_new_files, 10)
+
+    assert [os.path.basename(os.path.dirname(filepath)) for filepath in new_files] == ['reel1', 'reel2', 'reel3']
+
+
+def test_unchanged_directories_are_not_listed_again(tmp_path, scanner):
+    reel_path = str(tmp_path / 'input' / 'reel1')
+    write_page(reel_path, 'page01.tif')
+    settle(reel_path, str(tmp_path / 'input'))
+    queue = RecordingQueue()
+    queue.queue(scanner.scan(queue.select_new_files, 10))
+    scanner.save_changes()
+    queue.listed_dirs = []
+
+    assert scanner.scan(queue.select_new_files, 10) == []
+    assert queue.listed_dirs == []
+
+
+def test_changed_directories_are_listed_again(tmp_path, scanner):
+    reel_path = str(tmp_path / 'input' / 'reel1')
+    write_page(reel_path, 'page01.tif')
+    settle(reel_path, str(tmp_path / 'input'))
+    queue = RecordingQueue()
+    queue.queue(scanner.scan(queue.select_new_files, 10))
+    scanner.save_changes()
+
+    write_page(reel_path, 'page02.tif')
+
+    assert [os.path.basename(filepath) for filepath in scanner.scan(queue.select_new_files, 10)] == ['page02.tif']
+
+
+def test_unchanged_parents_still_lead_to_changed_subdirectories(tmp_path, scanner):
+    reel_path = str(tmp_path / 'input' / 'title' / 'reel1')
+    write_page(reel_path, 'page01.tif')
+    settle(reel_path, str(tmp_path / 'input' / 'title'), str(tmp_path / 'input'))
+    queue = RecordingQueue()
+    queue.queue(scanner.scan(queue.select_new_files, 10))
+    scanner.save_changes()
+
+    write_page(reel_path, 'page02.tif')
+
+    assert [os.path.basename(filepath) for filepath in scanner.scan(queue.select_new_files, 10)] == ['page02.tif']
+
+
+def test_recently_modified_directories_are_not_cached(tmp_path, scanner):
+    write_page(str(tmp_path / 'input' / 'reel1'), 'page01.tif')
+    queue = RecordingQueue()
+    queue.queue(scanner.scan(queue.select_new_files, 10))
+    scanner.save_changes()
+    queue.listed_dirs = []
+
+    scanner.scan(queue.select_new_files, 10)
+
+    assert queue.listed_dirs == [str(tmp_path / 'input' / 'reel1')]
+
+
+def test_discarded_changes_are_listed_again(tmp_path, scanner):
+    reel_path = str(tmp_path / 'input' / 'reel1')
+    write_page(reel_path, 'page01.tif')
+    settle(reel_path, str(tmp_path / 'input'))
+    queue = RecordingQueue()
+
+    scanner.scan(queue.select_new_files, 10)
+    scanner.discard_changes()
+
+    assert [os.path.basename(filepath) for filepath in scanner.scan(queue.select_new_files, 10)] == ['page01.tif']
+
+
+def test_forgotten_directories_are_listed_again(tmp_path, scanner):
+    reel_path = str(tmp_path / 'input' / 'reel1')
+    write_page(reel_path, 'page01.tif')
+    settle(reel_path, str(tmp_path / 'input'))
+    queue = RecordingQueue()
+    queue.queue(scanner.scan(queue.select_new_files, 10))
+    scanner.save_changes()
+    queue.listed_dirs = []
+
+    scanner.forget_directory(reel_path)
+
+    scanner.scan(queue.select_new_files, 10)
+    assert queue.listed_dirs == [reel_path]
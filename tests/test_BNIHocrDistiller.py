@@ -0,0 +1,101 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import io
+
+import pytest
+
+from lib.BNIHocrDistiller import BNIHocrDistiller
+
+HOCR_PAGE = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"
+    "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
+ <head>
+  <title></title>
+  <meta http-equiv="Content-Type" content="text/html;charset=utf-8"/>
+  <meta name='ocr-system' content='tesseract 4.1.1' />
+ </head>
+ <body>
+  <div class='ocr_page' id='page_1' title='image "page01.tif"; bbox 0 0 5000 7000; ppageno 0'>
+   <div class='ocr_carea' id='block_1_1' title="bbox 120 140 2400 900">
+    <p class='ocr_par' id='par_1_1' lang='eng' title="bbox 120 140 2400 900">
+     <span class='ocr_line' id='line_1_1' title="bbox 120 140 2400 220; baseline 0 -12">
+      <span class='ocrx_word' id='word_1_1' title='bbox 120 140 600 220; x_wconf 91'>THE</span>
+      <span class='ocrx_word' id='word_1_2' title='bbox 640 140 1400 220; x_wconf 88'>GLEANER</span>
+     </span>
+     <span class='ocr_line' id='line_1_2' title="bbox 120 240 2400 320; baseline 0 -10">
+      <span class='ocrx_word' id='word_1_3' title='bbox 120 240 500 320; x_wconf 80'>Fredericton,</span>
+      <span class='ocrx_word' id='word_1_4' title='bbox 540 240 900 320; x_wconf 75'>N.&amp;B.</span>
+      <span class='ocrx_word' id='word_1_5' title='bbox 940 240 1300 320; x_wconf 71'>&quot;Price&quot;</span>
+      <span class='ocrx_word' id='word_1_6' title='bbox 1340 240 1700 320; x_wconf 66'>5&#162;</span>
+     </span>
+    </p>
+    <p class='ocr_par' id='par_1_2' lang='eng' title="bbox 120 400 2400 900">
+     <span class='ocr_line' id='line_1_3' title="bbox 120 400 2400 480; baseline 0 -10">
+      <span class='ocrx_word' id='word_1_7' title='bbox 120 400 700 480; x_wconf 93'><strong>Caf&eacute;</strong></span>
+      <span class='ocrx_word' id='word_1_8' title='bbox 740 400 1200 480; x_wconf 90'><em>opens</em></span>
+      <span class='ocrx_word' id='word_1_9' title='bbox 1240 400 1600 480; x_wconf 12'>&lt;sic&gt;</span>
+     </span>
+    </p>
+    <p class='ocr_par' id='par_1_3' lang='eng' title="bbox 120 920 2400 960">
+    </p>
+   </div>
+  </div>
+ </body>
+</html>
+'''
+
+EXPECTED_TEXT = 'THE GLEANER Fredericton, N.&B. "Price" 5¢\nCafé opens <sic>\n\n'
+
+
+def distill(hocr_string, chunk_size=65536):
+    ocr_file_p = io.StringIO()
+    BNIHocrDistiller(ocr_file_p).distill(io.StringIO(hocr_string), chunk_size)
+    return ocr_file_p.getvalue()
+
+
+def test_distills_each_paragraph_to_one_line():
+    assert distill(HOCR_PAGE) == EXPECTED_TEXT
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, 1000])
+def test_output_does_not_depend_on_chunk_boundaries(chunk_size):
+    assert distill(HOCR_PAGE, chunk_size) == EXPECTED_TEXT
+
+
+def test_words_split_only_by_a_newline_are_joined():
+    # The hOCR was always read with its newlines stripped, so this is what earlier text files contain.
+    assert distill('<p>news\npaper</p>') == 'newspaper\n'
+
+
+def test_nested_paragraphs_are_written_in_document_order():
+    assert distill('<p>outer <p>inner</p> tail</p><p>next</p>') == 'outer inner tail\ninner\nnext\n'
+
+
+def test_unclosed_paragraphs_are_written_at_the_end():
+    assert distill('<p>first<p>second') == 'firstsecond\nsecond\n'
+
+
+def test_text_outside_paragraphs_is_dropped():
+    assert distill('<html><title>page</title><body>stray<p>kept</p></body></html>') == 'kept\n'
+
+
+def test_empty_document_gives_empty_text():
+    assert distill('') == ''
+
+
+@pytest.mark.parametrize('hocr_page', [
+    HOCR_PAGE,
+    '<p>outer <p>inner</p> tail</p><p>next</p>',
+    '<p>first<p>second',
+    '<div>stray</div><p>a&amp;b <b>c</b></p></p>',
+], ids=['page', 'nested', 'unclosed', 'stray'])
+def test_matches_the_beautifulsoup_distillation(hocr_page):
+    bs4 = pytest.importorskip('bs4')
+    hocr_string = hocr_page.replace('\n', '')
+    expected_text = ''
+    for p_item in bs4.BeautifulSoup(hocr_string, 'html.parser').find_all('p'):
+        expected_text += ' '.join(p_item.get_text().split()) + '\n'
+    assert distill(hocr_page) == expected_text
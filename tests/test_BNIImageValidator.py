@@ -0,0 +1,155 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import os
+import struct
+import time
+
+import pytest
+
+from lib.BNIImageValidator import (
+    BNIImageValidator, STATUS_FAIL_DIMENSIONS, STATUS_FAIL_HEADER_JPG, STATUS_FAIL_HEADER_TIF,
+    STATUS_FAIL_JPG_EXIST, STATUS_QUEUED
+)
+
+SETTLED_MTIME = time.time() - 3600
+
+
+def build_tiff(width=80, height=100, bits_per_sample=8, compression=1, byte_order='<', strip_bytes=None,
+               pixel_data=None):
+    """Build a single strip classic TIFF, with the pixel data following the IFD."""
+    if strip_bytes is None:
+        strip_bytes = (width * bits_per_sample + 7) // 8 * height
+    if pixel_data is None:
+        pixel_data = b'\0' * strip_bytes
+    tags = [
+        (256, 3, 1, width),
+        (257, 3, 1, height),
+        (258, 3, 1, bits_per_sample),
+        (259, 3, 1, compression),
+        (273, 4, 1, 0),
+        (277, 3, 1, 1),
+        (279, 4, 1, strip_bytes),
+    ]
+    ifd_offset = 8
+    data_offset = ifd_offset + 2 + len(tags) * 12 + 4
+    ifd = struct.pack(byte_order + 'H', len(tags))
+    for tag, value_type, value_count, value in tags:
+        if tag == 273:
+            value = data_offset
+        value_field = struct.pack(byte_order + ('H' if value_type == 3 else 'I'), value).ljust(4, b'\0')
+        ifd += struct.pack(byte_order + 'HHI', tag, value_type, value_count) + value_field
+    ifd += struct.pack(byte_order + 'I', 0)
+    byte_order_mark = b'II' if byte_order == '<' else b'MM'
+    return byte_order_mark + struct.pack(byte_order + 'HI', 42, ifd_offset) + ifd + pixel_data
+
+
+def build_jpeg(width=80, height=100, with_eoi=True, with_frame=True):
+    jpeg_data = b'\xff\xd8'
+    jpeg_data += b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\0\x01\x01\0\0\x01\0\x01\0\0'
+    if with_frame:
+        jpeg_data += b'\xff\xc0' + struct.pack('>HBHHB', 11, 8, height, width, 1) + b'\x01\x11\0'
+    jpeg_data += b'\xff\xda' + struct.pack('>H', 8) + b'\x01\x01\0\0\x3f\0' + b'\x12\x34' * 32
+    if with_eoi:
+        jpeg_data += b'\xff\xd9'
+    return jpeg_data
+
+
+@pytest.fixture
+def validator(make_config, logger):
+    return BNIImageValidator(
+        make_config(Locations={'relative_location_jpg': '../Jpgs/'}, Validation={'validate_settle_seconds': '300'}),
+        logger
+    )
+
+
+@pytest.fixture
+def write_page(tmp_path):
+    def write_page(tif_data, jpg_data=None, settled=True):
+        tif_filepath = tmp_path / 'reel1' / 'Tiffs' / 'page01.tif'
+        jpg_filepath = tmp_path / 'reel1' / 'Jpgs' / 'page01.jpg'
+        tif_filepath.parent.mkdir(parents=True, exist_ok=True)
+        jpg_filepath.parent.mkdir(parents=True, exist_ok=True)
+        tif_filepath.write_bytes(tif_data)
+        if jpg_data is not None:
+            jpg_filepath.write_bytes(jpg_data)
+        if settled:
+            for filepath in (tif_filepath, jpg_filepath):
+                if filepath.exists():
+                    os.utime(str(filepath), (SETTLED_MTIME, SETTLED_MTIME))
+        return str(tif_filepath)
+    return write_page
+
+
+@pytest.mark.parametrize('byte_order', ['<', '>'])
+def test_valid_page_is_queued(validator, write_page, byte_order):
+    assert validator.validate(write_page(build_tiff(byte_order=byte_order), build_jpeg())) == STATUS_QUEUED
+
+
+def test_jpg_is_located_as_the_worker_does(validator):
+    assert validator.get_jpg_filepath('/input/reel1/Tiffs/page01.tif') == '/input/reel1/Jpgs/page01.jpg'
+
+
+def test_tiff_header_reports_dimensions(validator, tmp_path):
+    tif_filepath = tmp_path / 'page.tif'
+    tif_filepath.write_bytes(build_tiff(width=120, height=90))
+    assert validator.read_tiff_header(str(tif_filepath)) == (120, 90)
+
+
+def test_jpeg_header_reports_dimensions(validator, tmp_path):
+    jpg_filepath = tmp_path / 'page.jpg'
+    jpg_filepath.write_bytes(build_jpeg(width=120, height=90))
+    assert validator.read_jpeg_header(str(jpg_filepath)) == (120, 90)
+
+
+@pytest.mark.parametrize('tif_data', [
+    b'GIF89a' + b'\0' * 64,
+    b'II' + struct.pack('<HI', 41, 8) + b'\0' * 64,
+    build_tiff()[:40],
+    build_tiff()[:-10],
+    build_tiff(width=0),
+    build_tiff(bits_per_sample=4),
+    build_tiff(compression=34712),
+    build_tiff(strip_bytes=100, pixel_data=b'\0' * 100),
+], ids=[
+    'not a tiff', 'unknown version', 'truncated ifd', 'truncated strip', 'empty dimensions', 'unaccepted bit depth',
+    'unaccepted compression', 'short strips',
+])
+def test_bad_tif_fails_its_header_check(validator, write_page, tif_data):
+    assert validator.validate(write_page(tif_data, build_jpeg())) == STATUS_FAIL_HEADER_TIF
+
+
+def test_missing_jpg_fails(validator, write_page):
+    assert validator.validate(write_page(build_tiff())) == STATUS_FAIL_JPG_EXIST
+
+
+@pytest.mark.parametrize('jpg_data', [
+    b'\x89PNG' + b'\0' * 64,
+    build_jpeg(with_frame=False),
+    build_jpeg(with_eoi=False),
+    build_jpeg()[:30],
+], ids=['not a jpeg', 'no frame header', 'no eoi', 'truncated'])
+def test_bad_jpg_fails_its_header_check(validator, write_page, jpg_data):
+    assert validator.validate(write_page(build_tiff(), jpg_data)) == STATUS_FAIL_HEADER_JPG
+
+
+def test_downsampled_jpg_of_the_same_shape_passes(validator, write_page):
+    assert validator.validate(write_page(build_tiff(width=800, height=1000), build_jpeg(width=80, height=100))) == STATUS_QUEUED
+
+
+def test_jpg_of_another_shape_fails(validator, write_page):
+    assert validator.validate(write_page(build_tiff(width=80, height=100), build_jpeg(width=100, height=80))) == STATUS_FAIL_DIMENSIONS
+
+
+def test_exact_dimension_match(make_config, logger, write_page):
+    validator = BNIImageValidator(
+        make_config(Locations={'relative_location_jpg': '../Jpgs/'}, Validation={'jpg_dimension_match': 'exact'}),
+        logger
+    )
+    tif_filepath = write_page(build_tiff(width=800, height=1000), build_jpeg(width=80, height=100))
+    assert validator.validate(tif_filepath) == STATUS_FAIL_DIMENSIONS
+
+
+def test_failing_page_still_being_written_is_deferred(validator, write_page):
+    assert validator.validate(write_page(build_tiff()[:-10], build_jpeg(), settled=False)) is None
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""benchmark_hocr_distill
+
+Compares the streaming hOCR distiller with the BeautifulSoup implementation it replaced.
+
+Both implementations are run over each given .hocr file (or a synthetic dense newspaper page when none are
+given); the script reports wall time and peak Python memory of each, and fails if their text output differs.
+
+    python3 tools/benchmark_hocr_distill.py [--repeat N] [file.hocr ...]
+
+Requires beautifulsoup4 for the reference implementation.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from optparse import OptionParser
+import io
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib.BNIHocrDistiller import BNIHocrDistiller
+
+
+def distill_with_beautifulsoup(hocr_filepath):
+    # The implementation used by BNIEncodingWorker before the streaming distiller.
+    from bs4 import BeautifulSoup
+    with io.open(hocr_filepath, "r") as hocr_file_p:
+        hocr_string = hocr_file_p.read().replace('\n', '')
+    ocr_string = ''
+    soup = BeautifulSoup(hocr_string)
+    for p_item in soup.findAll('p'):
+        ocr_string += ' '.join(p_item.getText().split()) + "\n"
+    return ocr_string
+
+
+def distill_streaming(hocr_filepath):
+    ocr_file_p = io.StringIO()
+    with io.open(hocr_filepath, "r") as hocr_file_p:
+        BNIHocrDistiller(ocr_file_p).distill(hocr_file_p)
+    return ocr_file_p.getvalue()
+
+
+def write_synthetic_hocr(hocr_filepath, columns=8, paragraphs=60, lines=6, words=9):
+    random.seed(1)
+    vocabulary = ['the', 'council', 'Fredericton', 'St.', 'John', 'river', '&amp;', 'Co.', 'sold', '1887',
+                  'steamer', 'wharf', 'notice', 'Mrs.', 'barrels', 'flour', '&quot;Gleaner&quot;', 'W.', 'at']
+    with io.open(hocr_filepath, 'w') as hocr_file_p:
+        hocr_file_p.write('<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE html>\n'
+                          '<html xmlns="http://www.w3.org/1999/xhtml">\n <head>\n  <title></title>\n </head>\n'
+                          ' <body>\n  <div class=\'ocr_page\' id=\'page_1\'>\n')
+        word_id = 0
+        for column in range(columns):
+            hocr_file_p.write('   <div class=\'ocr_carea\' id=\'block_1_%d\'>\n' % column)
+            for paragraph in range(paragraphs):
+                hocr_file_p.write('    <p class=\'ocr_par\' id=\'par_%d_%d\' lang=\'eng\'>\n' % (column, paragraph))
+                for line in range(lines):
+                    hocr_file_p.write('     <span class=\'ocr_line\' title="bbox 1 2 3 4">\n')
+                    for word in range(words):
+                        word_id += 1
+                        hocr_file_p.write(
+                            '      <span class=\'ocrx_word\' id=\'word_%d\' title=\'bbox 1 2 3 4; x_wconf 90\'>%s</span>\n'
+                            % (word_id, random.choice(vocabulary))
+                        )
+                    hocr_file_p.write('     </span>\n')
+                hocr_file_p.write('    </p>\n')
+            hocr_file_p.write('   </div>\n')
+        hocr_file_p.write('  </div>\n </body>\n</html>\n')
+
+
+def measure(distill_function, hocr_filepath, repeat):
+    best_time = None
+    for cur_run in range(repeat):
+        start_time = time.perf_counter()
+        distill_function(hocr_filepath)
+        elapsed = time.perf_counter() - start_time
+        if best_time is None or elapsed < best_time:
+            best_time = elapsed
+    tracemalloc.start()
+    ocr_string = distill_function(hocr_filepath)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return ocr_string, best_time, peak_memory
+
+
+if __name__ == "__main__":
+    option_parser = OptionParser(usage="%prog [options] [file.hocr ...]")
+    option_parser.add_option("--repeat", dest="repeat", type="int", default=3, help="Timed runs per file (Default: 3).")
+    (options, hocr_filepaths) = option_parser.parse_args()
+
+    if not hocr_filepaths:
+        hocr_filepaths = ['/tmp/bni-benchmark-synthetic.hocr']
+        write_synthetic_hocr(hocr_filepaths[0])
+
+    outputs_match = True
+    for hocr_filepath in hocr_filepaths:
+        reference_string, reference_time, reference_memory = measure(distill_with_beautifulsoup, hocr_filepath, options.repeat)
+        streaming_string, streaming_time, streaming_memory = measure(distill_streaming, hocr_filepath, options.repeat)
+        print("%s (%d bytes)" % (hocr_filepath, os.path.getsize(hocr_filepath)))
+        print("  beautifulsoup : %8.3fs  peak %8.1f MiB" % (reference_time, reference_memory / 1048576.0))
+        print("  streaming     : %8.3fs  peak %8.1f MiB" % (streaming_time, streaming_memory / 1048576.0))
+        if reference_string == streaming_string:
+            print("  output identical (%d lines)" % reference_string.count("\n"))
+        else:
+            print("  OUTPUT DIFFERS")
+            outputs_match = False
+
+    sys.exit(0 if outputs_match else 1)
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""benchmark_pipeline
+
+End-to-end throughput benchmark of the encoding daemon and its workers.
+
+A tree of synthetic newspaper-sized pages (uncompressed greyscale TIFs in Tiffs/ with JPGs in ../Jpgs/, the
+layout setup_next_image expects) is generated once. For each configuration variant the database is reset, the
+pages are hardlinked into a fresh input tree, and a non-persistent BNIEncodingDaemon is run in a child process
+until its workers have drained the queue. Each variant reports:
+
+  - throughput, as pages completed per hour of wall time
+  - p50/p95 latency of every stage, from the stage_timings table
+  - database round trips, from the server's Questions counter
+  - bytes read and written by the block layer, and CPU time, from the rusage of the daemon and all its children
+  - peak RSS of the largest single process
+
+    python3 tools/benchmark_pipeline.py --config bench.conf --workdir /scratch/bni-bench --stub-binaries \\
+        --variant serial:Threading.worker_mode=serial \\
+        --variant 'pipelined:Threading.worker_mode=pipelined;Threading.pipeline_ocr_threads=4'
+
+The [MySQL] section of the config must point at a scratch MySQL or MariaDB database: every table is dropped
+and recreated from BNINewspaperProcessing.schema.sql before each variant. The queue relies on MySQL-specific SQL
+(UPDATE ... ORDER BY ... LIMIT, INTERVAL arithmetic, UNHEX(SHA1())), so SQLite cannot stand in for it. Since the
+Questions counter is server-wide, nothing else should be using the server during a run.
+
+With --stub-binaries, gm and tesseract are replaced by shell stubs that copy the image and write a small hOCR
+page after sleeping --stub-ocr-seconds, which isolates the pipeline's own overhead from OCR cost. Without it,
+the gm and tesseract paths from the config are used.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from optparse import OptionParser
+import configparser
+import io
+import json
+import logging
+import math
+import os
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib.BNIDatabase import BNIDatabase
+from lib.BNISchemaMigrator import BNISchemaMigrator
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'BNINewspaperProcessing.schema.sql')
+COMPLETE_STATUS = 26
+
+STUB_GM = """#!/bin/sh
+# gm convert [-limit <type> <value> ...] <input> [options] <output>
+shift
+while [ "$1" = "-limit" ]; do shift 3; done
+input="$1"; for argument; do output="$argument"; done
+output="${output#tif:}"
+if [ "$output" = "-" ]; then cat "$input"; else cat "$input" > "$output"; fi
+"""
+
+STUB_TESSERACT = """#!/bin/sh
+# tesseract <input|stdin> <output stem> -l <language> hocr
+if [ "$1" = "--version" ]; then echo "tesseract 0.0.0-benchmark-stub"; exit 0; fi
+if [ "$1" = "stdin" ]; then cat > /dev/null; fi
+sleep "${BNI_STUB_OCR_SECONDS:-0}"
+{
+  echo '<html><body><div class="ocr_page">'
+  for paragraph in 1 2 3 4 5 6 7 8; do
+    echo "<p class='ocr_par'><span class='ocrx_word'>Synthetic</span> <span class='ocrx_word'>paragraph</span> <span class='ocrx_word'>$paragraph</span></p>"
+  done
+  echo '</div></body></html>'
+} > "$2.hocr"
+"""
+
+
+def write_tif(tif_filepath, width, height):
+    """Write an uncompressed 8-bit greyscale baseline TIFF with a pattern of dark text-like bands."""
+    strip_offset = 8
+    strip_bytes = width * height
+    ifd_offset = strip_offset + strip_bytes
+    with io.open(tif_filepath, 'wb') as tif_file_p:
+        tif_file_p.write(b'II' + struct.pack('<HI', 42, ifd_offset))
+        white_row = b'\xff' * width
+        text_row = (b'\x20' * 6 + b'\xff' * 4) * (width // 10) + b'\xff' * (width % 10)
+        for row in range(height):
+            tif_file_p.write(text_row if row % 40 < 12 else white_row)
+        ifd_entries = [
+            (256, 4, 1, width),          # ImageWidth
+            (257, 4, 1, height),         # ImageLength
+            (258, 3, 1, 8),              # BitsPerSample
+            (259, 3, 1, 1),              # Compression: none
+            (262, 3, 1, 1),              # PhotometricInterpretation: black is zero
+            (273, 4, 1, strip_offset),   # StripOffsets
+            (277, 3, 1, 1),              # SamplesPerPixel
+            (278, 4, 1, height),         # RowsPerStrip
+            (279, 4, 1, strip_bytes),    # StripByteCounts
+        ]
+        tif_file_p.write(struct.pack('<H', len(ifd_entries)))
+        for tag, field_type, count, value in ifd_entries:
+            if field_type == 3:
+                tif_file_p.write(struct.pack('<HHIHH', tag, field_type, count, value, 0))
+            else:
+                tif_file_p.write(struct.pack('<HHII', tag, field_type, count, value))
+        tif_file_p.write(struct.pack('<I', 0))
+
+
+def write_jpg(jpg_filepath, width, height):
+    try:
+        from PIL import Image
+    except ImportError:
+        # Not decodable, but carries the SOI/EOI markers and a realistic size for the size checks.
+        with io.open(jpg_filepath, 'wb') as jpg_file_p:
+            jpg_file_p.write(b'\xff\xd8' + b'\x00' * (width * height // 20) + b'\xff\xd9')
+        return
+    Image.new('L', (width // 4, height // 4), 230).save(jpg_filepath, 'JPEG', quality=85)
+
+
+def generate_template(template_path, options):
+    """Generate the synthetic pages once; every variant hardlinks them into its own input tree."""
+    if os.path.isdir(template_path):
+        return
+    building_path = template_path + '.partial'
+    shutil.rmtree(building_path, ignore_errors=True)
+    for page_number in range(options.pages):
+        reel_path = os.path.join(building_path, 'reel%03d' % (page_number // options.pages_per_reel))
+        os.makedirs(os.path.join(reel_path, 'Tiffs'), exist_ok=True)
+        os.makedirs(os.path.join(reel_path, 'Jpgs'), exist_ok=True)
+        page_stem = 'page%05d' % page_number
+        write_tif(os.path.join(reel_path, 'Tiffs', page_stem + '.tif'), options.tif_width, options.tif_height)
+        write_jpg(os.path.join(reel_path, 'Jpgs', page_stem + '.jpg'), options.tif_width, options.tif_height)
+    os.rename(building_path, template_path)
+
+
+def link_tree(template_path, input_path):
+    shutil.rmtree(input_path, ignore_errors=True)
+    for dir_path, dir_names, file_names in os.walk(template_path):
+        target_dir_path = os.path.join(input_path, os.path.relpath(dir_path, template_path))
+        os.makedirs(target_dir_path, exist_ok=True)
+        for file_name in file_names:
+            os.link(os.path.join(dir_path, file_name), os.path.join(target_dir_path, file_name))
+
+
+def write_stub_binaries(stub_path):
+    os.makedirs(stub_path, exist_ok=True)
+    for stub_name, stub_script in (('gm', STUB_GM), ('tesseract', STUB_TESSERACT)):
+        with io.open(os.path.join(stub_path, stub_name), 'w') as stub_file_p:
+            stub_file_p.write(stub_script)
+        os.chmod(os.path.join(stub_path, stub_name), 0o755)
+
+
+def write_variant_config(base_config_file, variant_path, overrides, options):
+    config = configparser.ConfigParser()
+    config.read(base_config_file)
+    settings = [
+        ('Locations', 'input_path', os.path.join(variant_path, 'input')),
+        ('Locations', 'tmp_path', os.path.join(variant_path, 'tmp')),
+        ('Locations', 'bni_output_path', os.path.join(variant_path, 'bni_output')),
+        ('Locations', 'lib_output_path', os.path.join(variant_path, 'lib_output')),
+        ('Locations', 'relative_location_jpg', '../Jpgs/'),
+        ('Threading', 'persistent', 'false'),
+        ('Threading', 'images_per_batch', str(options.pages)),
+        ('Intake', 'intake_mode', 'scan'),
+        ('Intake', 'scan_cache_path', ''),
+        ('Metrics', 'metrics_port', '0'),
+        ('Logging', 'log_file', os.path.join(variant_path, 'daemon.log')),
+        ('MinimumSizes', 'min_size_tif', '0'),
+        ('MinimumSizes', 'min_size_jpg', '0'),
+    ]
+    if options.stub_binaries:
+        settings.extend([
+            ('GraphicsMagick', 'gm_bin_path', os.path.join(options.workdir, 'stubs', 'gm')),
+            ('Tesseract', 'tesseract_bin_path', os.path.join(options.workdir, 'stubs', 'tesseract')),
+        ])
+    settings.extend(overrides)
+    for section, option, value in settings:
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, option, value.replace('%', '%%'))
+    for output_dir in ('tmp', 'bni_output', 'lib_output'):
+        shutil.rmtree(os.path.join(variant_path, output_dir), ignore_errors=True)
+        os.makedirs(os.path.join(variant_path, output_dir))
+    variant_config_file = os.path.join(variant_path, 'benchmark.conf')
+    with io.open(variant_config_file, 'w') as config_file_p:
+        config.write(config_file_p)
+    return variant_config_file
+
+
+def parse_variant(variant_string):
+    """Parse 'name:Section.option=value;Section.option=value' into a name and config overrides.
+
+    Overrides are separated by semicolons, as several options (gm_surrogate_convert_options) contain commas.
+    """
+    variant_name, separator, override_string = variant_string.partition(':')
+    overrides = []
+    for override in filter(None, override_string.split(';')):
+        option_path, value = override.split('=', 1)
+        section, option = option_path.split('.', 1)
+        overrides.append((section, option, value))
+    return variant_name, overrides
+
+
+def reset_database(config, logger, database):
+    statements = BNISchemaMigrator(config, logger).read_statements(SCHEMA_PATH)
+    with database.connection() as db:
+        db_cur = db.cursor()
+        for table_name in ('images', 'configuration', 'stage_timings', 'status', 'reel_priorities', 'schema_version'):
+            db_cur.execute("DROP TABLE IF EXISTS " + table_name)
+        for statement in statements:
+            db_cur.execute(statement)
+        db.commit()
+        db_cur.close()
+
+
+def get_questions(database):
+    with database.connection() as db:
+        db_cur = db.cursor()
+        db_cur.execute("SHOW GLOBAL STATUS LIKE 'Questions'")
+        questions = int(db_cur.fetchone()[1])
+        db_cur.close()
+    return questions
+
+
+def get_results(database):
+    with database.connection() as db:
+        db_cur = db.cursor()
+        db_cur.execute("SELECT COUNT(1) FROM images WHERE status_id=%s", (COMPLETE_STATUS,))
+        completed_pages = db_cur.fetchone()[0]
+        db_cur.execute(
+            "SELECT status.status_string, stage_timings.duration_ms FROM stage_timings "
+            "JOIN status ON status.status_id = stage_timings.status_id "
+            "ORDER BY status.status_id, stage_timings.duration_ms"
+        )
+        stage_durations = {}
+        stage_order = []
+        for status_string, duration_ms in db_cur.fetchall():
+            if status_string not in stage_durations:
+                stage_durations[status_string] = []
+                stage_order.append(status_string)
+            stage_durations[status_string].append(duration_ms)
+        db_cur.close()
+    return completed_pages, [(stage, stage_durations[stage]) for stage in stage_order]
+
+
+def get_quantile(sorted_values, quantile):
+    rank = max(1, int(math.ceil(quantile * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+def run_daemon(variant_config_file):
+    """Child process entry point: run one non-persistent daemon pass and print its resource usage as JSON."""
+    from lib.BNIEncodingDaemon import BNIEncodingDaemon
+    start_time = time.monotonic()
+    daemon = BNIEncodingDaemon('/dev/null', config_file=variant_config_file)
+    daemon.run()
+    wall_seconds = time.monotonic() - start_time
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    print(json.dumps({
+        'wall_seconds': wall_seconds,
+        'cpu_seconds': sum((
+            self_usage.ru_utime, self_usage.ru_stime, children_usage.ru_utime, children_usage.ru_stime
+        )),
+        'read_bytes': (self_usage.ru_inblock + children_usage.ru_inblock) * 512,
+        'written_bytes': (self_usage.ru_oublock + children_usage.ru_oublock) * 512,
+        'peak_rss_kb': max(self_usage.ru_maxrss, children_usage.ru_maxrss),
+    }))
+
+
+def run_variant(variant_name, overrides, options, logger):
+    variant_path = os.path.join(options.workdir, 'variants', variant_name)
+    os.makedirs(variant_path, exist_ok=True)
+    variant_config_file = write_variant_config(options.config_file, variant_path, overrides, options)
+    variant_config = configparser.ConfigParser()
+    variant_config.read(variant_config_file)
+    database = BNIDatabase(variant_config, logger)
+    reset_database(variant_config, logger, database)
+    link_tree(options.template_path, os.path.join(variant_path, 'input'))
+
+    child_environment = dict(os.environ, BNI_STUB_OCR_SECONDS=str(options.stub_ocr_seconds))
+    questions_before = get_questions(database)
+    daemon_output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--run-daemon', variant_config_file],
+        env=child_environment
+    )
+    questions_after = get_questions(database)
+    usage = json.loads(daemon_output.decode('utf-8').strip().splitlines()[-1])
+    completed_pages, stage_durations = get_results(database)
+    database.close()
+    # The second Questions probe counts itself.
+    usage['db_round_trips'] = questions_after - questions_before - 1
+    usage['completed_pages'] = completed_pages
+    usage['stage_durations'] = stage_durations
+    return usage
+
+
+def print_report(results, options):
+    print()
+    print("%-20s %7s %9s %11s %10s %10s %10s %10s %9s" % (
+        'variant', 'pages', 'wall s', 'pages/hour', 'db trips', 'trips/page', 'read MiB', 'write MiB', 'peak MiB'
+    ))
+    for variant_name, usage in results:
+        pages_per_hour = usage['completed_pages'] * 3600.0 / usage['wall_seconds'] if usage['wall_seconds'] else 0.0
+        print("%-20s %7d %9.1f %11.0f %10d %10.1f %10.1f %10.1f %9.1f" % (
+            variant_name,
+            usage['completed_pages'],
+            usage['wall_seconds'],
+            pages_per_hour,
+            usage['db_round_trips'],
+            usage['db_round_trips'] / float(max(1, usage['completed_pages'])),
+            usage['read_bytes'] / 1048576.0,
+            usage['written_bytes'] / 1048576.0,
+            usage['peak_rss_kb'] / 1024.0,
+        ))
+    for variant_name, usage in results:
+        print()
+        print("%s stage latency (ms)" % variant_name)
+        print("  %-20s %8s %8s %8s" % ('stage', 'count', 'p50', 'p95'))
+        for stage, durations in usage['stage_durations']:
+            print("  %-20s %8d %8d %8d" % (stage, len(durations), get_quantile(durations, 0.5), get_quantile(durations, 0.95)))
+    if options.json_output:
+        with io.open(options.json_output, 'w') as json_file_p:
+            json.dump(dict(results), json_file_p, indent=2)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == '--run-daemon':
+        run_daemon(sys.argv[2])
+        sys.exit(0)
+
+    option_parser = OptionParser(usage="%prog --config FILE --workdir DIR [options]")
+    option_parser.add_option("-c", "--config", dest="config_file", help="Base config; [MySQL] must name a scratch database.")
+    option_parser.add_option("--workdir", dest="workdir", help="Scratch directory for the pages and outputs.")
+    option_parser.add_option("--pages", dest="pages", type="int", default=20, help="Synthetic pages (Default: 20).")
+    option_parser.add_option("--pages-per-reel", dest="pages_per_reel", type="int", default=10,
+                             help="Pages per reel directory (Default: 10).")
+    option_parser.add_option("--tif-width", dest="tif_width", type="int", default=7200,
+                             help="TIF width in pixels (Default: 7200, a broadsheet page at 400 dpi).")
+    option_parser.add_option("--tif-height", dest="tif_height", type="int", default=9600,
+                             help="TIF height in pixels (Default: 9600).")
+    option_parser.add_option("--stub-binaries", dest="stub_binaries", action="store_true", default=False,
+                             help="Use stub gm and tesseract binaries instead of the configured ones.")
+    option_parser.add_option("--stub-ocr-seconds", dest="stub_ocr_seconds", type="float", default=0.0,
+                             help="Time the stub tesseract spends per page (Default: 0).")
+    option_parser.add_option("--variant", dest="variants", action="append", default=[],
+                             help="name:Section.option=value;... (repeatable; Default: the base config as is).")
+    option_parser.add_option("--json", dest="json_output", help="Also write the results to this JSON file.")
+    (options, args) = option_parser.parse_args()
+    if not options.config_file or not os.path.exists(options.config_file) or not options.workdir:
+        option_parser.error('a readable --config and a --workdir are required')
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger('benchmark_pipeline')
+    os.makedirs(options.workdir, exist_ok=True)
+    options.template_path = os.path.join(
+        options.workdir,
+        'template-%dx%d-%d-%d' % (options.tif_width, options.tif_height, options.pages, options.pages_per_reel)
+    )
+    generate_template(options.template_path, options)
+    if options.stub_binaries:
+        write_stub_binaries(os.path.join(options.workdir, 'stubs'))
+
+    results = []
+    for variant_string in options.variants or ['base:']:
+        variant_name, overrides = parse_variant(variant_string)
+        print("Running %s ..." % variant_name)
+        results.append((variant_name, run_variant(variant_name, overrides, options, logger)))
+    print_report(results, options)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""simulate_node_crashes
+
+Exercises lease-based claiming against a real MySQL/MariaDB server by running several simulated processing
+nodes and killing them at random.
+
+Each node registers a configuration row like a daemon run and starts its workers. The workers claim pages
+through BNILeaseKeeper, step them through the processing statuses with BNIStatusWriter and heartbeat their
+leases, but do no image work. Every crash interval a random node is killed with SIGKILL, workers and all, and
+restarted under a new config_id, as a rebooted host would be. Meanwhile this script reaps expired leases the
+way the daemon does.
+
+The run passes when every page ends up PROCESSINGCOMPLETE and no leases remain. Pages completed more than once
+(a worker finishing a page after its lease was reaped) are reported separately.
+
+    python3 tools/simulate_node_crashes.py --config test.conf --reset [--nodes 3] [--workers 2] [--pages 200]
+
+The [MySQL] section of the config must point at a scratch database: --reset drops and recreates every table
+from BNINewspaperProcessing.schema.sql.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from optparse import OptionParser
+import configparser
+import hashlib
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib.BNIDatabase import BNIDatabase
+from lib.BNILeaseKeeper import BNILeaseKeeper, reap_expired_leases
+from lib.BNIReelPriority import get_directory_hash
+from lib.BNISchemaMigrator import BNISchemaMigrator
+from lib.BNIStatusWriter import BNIStatusWriter
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'BNINewspaperProcessing.schema.sql')
+PAGE_STATUSES = (4, 6, 8, 9, 10, 12, 15, 16, 17, 18, 19, 20, 22, 23, 25)
+COMPLETE_STATUS = 26
+CRASH_JOIN_TIMEOUT = 10.0
+
+
+def reset_database(config, logger, database):
+    statements = BNISchemaMigrator(config, logger).read_statements(SCHEMA_PATH)
+    with database.connection() as db:
+        db_cur = db.cursor()
+        for table_name in ('images', 'configuration', 'stage_timings', 'status', 'reel_priorities', 'schema_version'):
+            db_cur.execute("DROP TABLE IF EXISTS " + table_name)
+        for statement in statements:
+            db_cur.execute(statement)
+        db.commit()
+        db_cur.close()
+
+
+def queue_pages(database, page_count):
+    with database.connection() as db:
+        db_cur = db.cursor()
+        page_rows = []
+        for page_number in range(page_count):
+            page_filepath = 'simulated/reel%03d/page%05d.tif' % (page_number // 100, page_number)
+            page_rows.append((
+                page_filepath,
+                hashlib.sha1(page_filepath.encode('utf-8')).digest(),
+                get_directory_hash(page_filepath)
+            ))
+        db_cur.executemany(
+            "INSERT INTO images (filepath, path_hash, directory_hash, status_id, queue_datestamp, latest_datestamp) "
+            "VALUES (%s, %s, %s, 1, NOW(), NOW())",
+            page_rows
+        )
+        db.commit()
+        db_cur.close()
+
+
+def register_node(database, node_number):
+    with database.connection() as db:
+        db_cur = db.cursor()
+        db_cur.execute("INSERT INTO configuration (hostname) VALUES (%s)", ('simulated-node-%d' % node_number,))
+        config_id = db_cur.lastrowid
+        db.commit()
+        db_cur.close()
+    return config_id
+
+
+def run_node(config, node_number, worker_count, stage_seconds):
+    # Own process group, so a crash can take the node down together with its workers.
+    os.setpgrp()
+    logger = logging.getLogger('simulated_node')
+    config_id = register_node(BNIDatabase(config, logger), node_number)
+    worker_processes = [
+        multiprocessing.Process(target=run_worker, args=(config, config_id, worker_id, stage_seconds))
+        for worker_id in range(worker_count)
+    ]
+    for worker_process in worker_processes:
+        worker_process.start()
+    for worker_process in worker_processes:
+        worker_process.join()
+
+
+def run_worker(config, config_id, worker_id, stage_seconds):
+    logger = logging.getLogger('simulated_node')
+    database = BNIDatabase(config, logger)
+    lease_keeper = BNILeaseKeeper(config, logger, database, config_id, worker_id)
+    status_writer = BNIStatusWriter(config, logger, database, (config_id, worker_id))
+    status_writer.start()
+    lease_keeper.start()
+    images_per_claim = config.getint('Threading', 'images_per_claim', fallback=1)
+    while True:
+        status_writer.flush()
+        claimed_rows = lease_keeper.claim(images_per_claim)
+        if not claimed_rows:
+            time.sleep(0.2)
+            continue
+        for image_id, filepath in claimed_rows:
+            lease_keeper.begin_attempt(image_id)
+            for status_id in PAGE_STATUSES:
+                status_writer.record(image_id, status_id)
+                time.sleep(random.uniform(0, 2 * stage_seconds))
+            status_writer.record_timing(image_id, COMPLETE_STATUS, 0, worker_id, config_id)
+            status_writer.record(image_id, COMPLETE_STATUS)
+
+
+def start_node(config, node_number, options):
+    node_process = multiprocessing.Process(
+        target=run_node,
+        args=(config, node_number, options.workers, options.stage_seconds)
+    )
+    node_process.start()
+    return node_process
+
+
+def crash_node(node_process):
+    try:
+        os.killpg(node_process.pid, signal.SIGKILL)
+    except OSError:
+        # The node has not called setpgrp() yet, so there is no group to signal.
+        node_process.kill()
+    node_process.join(CRASH_JOIN_TIMEOUT)
+    try:
+        # Workers a node started just before it was killed on its own are still in its group.
+        os.killpg(node_process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    if node_process.is_alive():
+        print("Node process %d did not exit after SIGKILL." % node_process.pid)
+
+
+def get_progress(database):
+    with database.connection() as db:
+        db_cur = db.cursor()
+        db_cur.execute("SELECT COUNT(1) FROM images WHERE status_id=%s", (COMPLETE_STATUS,))
+        completed_pages = db_cur.fetchone()[0]
+        db_cur.execute("SELECT COUNT(1) FROM images WHERE lease_expires IS NOT NULL")
+        leased_pages = db_cur.fetchone()[0]
+        db_cur.close()
+    return completed_pages, leased_pages
+
+
+def get_duplicate_completions(database):
+    with database.connection() as db:
+        db_cur = db.cursor()
+        db_cur.execute(
+            "SELECT COUNT(1) FROM (SELECT image_id FROM stage_timings WHERE status_id=%s "
+            "GROUP BY image_id HAVING COUNT(1) > 1) AS duplicates",
+            (COMPLETE_STATUS,)
+        )
+        duplicate_pages = db_cur.fetchone()[0]
+        db_cur.close()
+    return duplicate_pages
+
+
+if __name__ == "__main__":
+    option_parser = OptionParser(usage="%prog --config FILE [options]")
+    option_parser.add_option("-c", "--config", dest="config_file", help="Config file with the [MySQL] settings.")
+    option_parser.add_option("--reset", dest="reset", action="store_true", default=False,
+                             help="Drop and recreate every table first. Required unless the schema is already loaded.")
+    option_parser.add_option("--nodes", dest="nodes", type="int", default=3, help="Simulated nodes (Default: 3).")
+    option_parser.add_option("--workers", dest="workers", type="int", default=2, help="Workers per node (Default: 2).")
+    option_parser.add_option("--pages", dest="pages", type="int", default=200, help="Pages to queue (Default: 200).")
+    option_parser.add_option("--stage-seconds", dest="stage_seconds", type="float", default=0.02,
+                             help="Mean time spent in each processing status (Default: 0.02).")
+    option_parser.add_option("--crash-interval", dest="crash_interval", type="float", default=3.0,
+                             help="Seconds between node crashes (Default: 3).")
+    option_parser.add_option("--lease-seconds", dest="lease_seconds", type="int", default=5,
+                             help="Lease length given to claims (Default: 5).")
+    option_parser.add_option("--max-attempts", dest="max_attempts", type="int", default=100,
+                             help="Attempts allowed per page before it is failed (Default: 100).")
+    option_parser.add_option("--timeout", dest="timeout", type="float", default=600.0,
+                             help="Give up after this many seconds (Default: 600).")
+    (options, args) = option_parser.parse_args()
+    if not options.config_file or not os.path.exists(options.config_file):
+        option_parser.error('a readable --config is required')
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(processName)s %(levelname)s %(message)s')
+    logger = logging.getLogger('simulate_node_crashes')
+    config = configparser.ConfigParser()
+    config.read(options.config_file)
+    for section in ('Threading', 'MySQL'):
+        if not config.has_section(section):
+            config.add_section(section)
+    config.set('Threading', 'lease_seconds', str(options.lease_seconds))
+    config.set('Threading', 'lease_heartbeat_interval', str(options.lease_seconds / 5.0))
+    config.set('Threading', 'max_claim_attempts', str(options.max_attempts))
+    config.set('MySQL', 'status_flush_interval', '0.5')
+
+    database = BNIDatabase(config, logger)
+    if options.reset:
+        reset_database(config, logger, database)
+    queue_pages(database, options.pages)
+
+    node_processes = [start_node(config, node_number, options) for node_number in range(options.nodes)]
+    start_time = time.monotonic()
+    next_crash_time = start_time + options.crash_interval
+    crashes = 0
+    reaped_pages = 0
+    completed_pages, leased_pages = 0, 0
+    while time.monotonic() - start_time < options.timeout:
+        time.sleep(1)
+        reaped_pages += reap_expired_leases(database, logger, options.max_attempts)
+        completed_pages, leased_pages = get_progress(database)
+        print("%6.1fs  completed %d/%d  leased %d  crashes %d  reaped %d" % (
+            time.monotonic() - start_time, completed_pages, options.pages, leased_pages, crashes, reaped_pages
+        ))
+        if completed_pages == options.pages:
+            break
+        if time.monotonic() >= next_crash_time:
+            node_number = random.randrange(options.nodes)
+            crash_node(node_processes[node_number])
+            crashes += 1
+            node_processes[node_number] = start_node(config, node_number, options)
+            next_crash_time = time.monotonic() + options.crash_interval
+
+    for node_process in node_processes:
+        crash_node(node_process)
+    completed_pages, leased_pages = get_progress(database)
+    duplicate_pages = get_duplicate_completions(database)
+    print("Completed %d of %d pages after %d crashes; %d pages re-queued by the reaper." % (
+        completed_pages, options.pages, crashes, reaped_pages
+    ))
+    print("Leases left: %d. Pages completed more than once: %d." % (leased_pages, duplicate_pages))
+    sys.exit(0 if completed_pages == options.pages and leased_pages == 0 else 1)